@@ -0,0 +1,54 @@
+"""Add persisted plaintext/ciphertext size columns to file
+
+Revision ID: 3c9d4e2a7b15
+Revises: 1ae2431b529a
+Create Date: 2026-10-18 10:05:12.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9d4e2a7b15'
+down_revision = '1ae2431b529a'
+branch_labels = None
+depends_on = None
+
+# Segmented (v2) container layout, see vault/crypto_utils.py
+HEADER_SIZE = 16
+SEALED_SEGMENT_SIZE = 64 * 1024 + 16
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+
+
+def upgrade():
+    # create_app() may already have added the columns on a deploy that booted first
+    existing = {col['name'] for col in sa.inspect(op.get_bind()).get_columns('file')}
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        if 'size' not in existing:
+            batch_op.add_column(sa.Column('size', sa.BigInteger(), nullable=True))
+        if 'encrypted_size' not in existing:
+            batch_op.add_column(sa.Column('encrypted_size', sa.BigInteger(), nullable=True))
+
+    # Backfill in SQL so the blobs never leave the database.
+    op.execute("UPDATE file SET encrypted_size = length(data) WHERE data IS NOT NULL AND encrypted_size IS NULL")
+    # Segmented blobs: plaintext = ciphertext - header - one tag per segment.
+    op.execute(
+        f"UPDATE file SET size = encrypted_size - {HEADER_SIZE} - {TAG_SIZE} * "
+        f"((encrypted_size - {HEADER_SIZE} + {SEALED_SEGMENT_SIZE - 1}) / {SEALED_SEGMENT_SIZE}) "
+        f"WHERE encrypted_size IS NOT NULL AND size IS NULL AND length(iv) = {NONCE_PREFIX_SIZE}"
+    )
+    # Legacy CBC blobs: the exact length is only known after unpadding, so record the padded
+    # length (at most 16 bytes over), which is what the listing pages showed before.
+    # a9d4b7e1c352 later replaces it with the real size (it needs the owners' keys).
+    op.execute(
+        "UPDATE file SET size = encrypted_size "
+        "WHERE encrypted_size IS NOT NULL AND size IS NULL"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_column('encrypted_size')
+        batch_op.drop_column('size')
@@ -0,0 +1,31 @@
+"""Add storage backend column to file
+
+Revision ID: 8f2b61c0d4a9
+Revises: 3c9d4e2a7b15
+Create Date: 2026-10-18 11:42:37.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f2b61c0d4a9'
+down_revision = '3c9d4e2a7b15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # create_app() may already have added the column on a deploy that booted first
+    existing = {col['name'] for col in sa.inspect(op.get_bind()).get_columns('file')}
+    if 'storage' not in existing:
+        with op.batch_alter_table('file', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('storage', sa.String(length=20), nullable=True, server_default='db'))
+    # Every blob written before this revision lives in file.data
+    op.execute("UPDATE file SET storage = 'db' WHERE storage IS NULL")
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_column('storage')
@@ -0,0 +1,123 @@
+"""Record the real plaintext size of legacy CBC files
+
+Revision ID: a9d4b7e1c352
+Revises: f4a7c2e9b813
+Create Date: 2026-10-19 09:14:27.630518
+
+"""
+import hashlib
+import os
+
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d4b7e1c352'
+down_revision = 'f4a7c2e9b813'
+branch_labels = None
+depends_on = None
+
+BLOCK_SIZE = 16
+LEGACY_IV_SIZE = 16
+
+
+def _private_key(pem):
+    from cryptography.hazmat.primitives import serialization
+    return serialization.load_pem_private_key(pem, password=None)
+
+
+def _unwrap(private_key, encrypted_aes_key):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    return private_key.decrypt(encrypted_aes_key, padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None))
+
+
+def _padding_length(aes_key, iv, tail):
+    """PKCS7 padding length, from the last CBC block (tail: the block before it, if any, and the last)."""
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    previous, last = (tail[:BLOCK_SIZE], tail[BLOCK_SIZE:]) if len(tail) == 2 * BLOCK_SIZE else (iv, tail)
+    decryptor = Cipher(algorithms.AES(aes_key), modes.CBC(previous)).decryptor()
+    block = decryptor.update(last) + decryptor.finalize()
+    pad = block[-1]
+    if not 1 <= pad <= BLOCK_SIZE or block[-pad:] != bytes([pad]) * pad:
+        raise ValueError('invalid padding')
+    return pad
+
+
+def _blob_path(root, name):
+    # Filesystem backend layout (vault/storage.py as of this revision)
+    digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+    return os.path.join(root, digest[:2], digest[2:4], name)
+
+
+def _read_tail(bind, file, row, length):
+    if (row.storage or 'db') == 'db':
+        return bind.execute(
+            sa.select(sa.func.substr(file.c.data, row.encrypted_size - length + 1, length))
+            .where(file.c.id == row.id)
+        ).scalar()
+    root = current_app.config.get('BLOB_STORAGE_PATH')
+    with open(_blob_path(root, row.encrypted_name), 'rb') as f:
+        f.seek(row.encrypted_size - length)
+        return f.read(length)
+
+
+def upgrade():
+    """Legacy (AES-CBC) files were backfilled with their padded length (size = encrypted_size).
+
+    Only the last block is decrypted, with the owner's key, so blobs are never read in full.
+    Rows that can't be fixed (no key, blob missing) keep the padded length and are reported.
+    """
+    bind = op.get_bind()
+    file = sa.table('file', sa.column('id'), sa.column('user_id'), sa.column('company_id'),
+                    sa.column('encrypted_name'), sa.column('encrypted_aes_key', sa.LargeBinary),
+                    sa.column('iv', sa.LargeBinary), sa.column('size'), sa.column('encrypted_size'),
+                    sa.column('storage'), sa.column('data', sa.LargeBinary))
+    user = sa.table('user', sa.column('id'), sa.column('rsa_private_key', sa.LargeBinary))
+    rows = bind.execute(
+        sa.select(file.c.id, file.c.user_id, file.c.company_id, file.c.encrypted_name, file.c.encrypted_aes_key,
+                  file.c.iv, file.c.encrypted_size, file.c.storage)
+        .where(sa.func.length(file.c.iv) == LEGACY_IV_SIZE, file.c.encrypted_size >= BLOCK_SIZE,
+               sa.or_(file.c.size.is_(None), file.c.size == file.c.encrypted_size))
+        .order_by(file.c.user_id)
+    ).all()
+
+    keys = {}
+    companies = set()
+    fixed = 0
+    for row in rows:
+        try:
+            if row.user_id not in keys:
+                pem = bind.execute(sa.select(user.c.rsa_private_key).where(user.c.id == row.user_id)).scalar()
+                keys[row.user_id] = _private_key(pem) if pem else None
+            if keys[row.user_id] is None:
+                raise ValueError('owner has no private key')
+            length = 2 * BLOCK_SIZE if row.encrypted_size >= 2 * BLOCK_SIZE else BLOCK_SIZE
+            tail = _read_tail(bind, file, row, length)
+            pad = _padding_length(_unwrap(keys[row.user_id], row.encrypted_aes_key), bytes(row.iv), bytes(tail))
+        except Exception as e:
+            print(f"[SCHEMA] File {row.id}: kept padded size {row.encrypted_size} ({e})")
+            continue
+        bind.execute(file.update().where(file.c.id == row.id).values(size=row.encrypted_size - pad))
+        fixed += 1
+        if row.company_id is not None:
+            companies.add(row.company_id)
+
+    # The stats counters were built from the padded sizes
+    if companies and 'company_stats' in sa.inspect(bind).get_table_names():
+        stats = sa.table('company_stats', sa.column('company_id'), sa.column('plaintext_bytes'))
+        for company_id in companies:
+            total = sa.select(sa.func.coalesce(sa.func.sum(file.c.size), 0))\
+                .where(file.c.company_id == company_id).scalar_subquery()
+            bind.execute(stats.update().where(stats.c.company_id == company_id).values(plaintext_bytes=total))
+    if rows:
+        print(f"[SCHEMA] Legacy file sizes: {fixed} of {len(rows)} corrected")
+
+
+def downgrade():
+    # The corrected sizes are still right for the older code
+    pass
@@ -0,0 +1,32 @@
+"""Add composite index for activity log pagination
+
+Revision ID: b47e0c9d2f31
+Revises: 8f2b61c0d4a9
+Create Date: 2026-10-18 14:05:12.418907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b47e0c9d2f31'
+down_revision = '8f2b61c0d4a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() already builds it on fresh databases
+    existing = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('activity_log')}
+    if 'ix_activity_log_company_timestamp_id' not in existing:
+        op.create_index(
+            'ix_activity_log_company_timestamp_id',
+            'activity_log',
+            ['company_id', sa.text('timestamp DESC'), sa.text('id DESC')],
+            unique=False
+        )
+
+
+def downgrade():
+    op.drop_index('ix_activity_log_company_timestamp_id', table_name='activity_log')
@@ -0,0 +1,73 @@
+"""Add memberships primary key and indexes for hot query paths
+
+Revision ID: c5a1e7f03b28
+Revises: b47e0c9d2f31
+Create Date: 2026-10-18 15:31:48.207655
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a1e7f03b28'
+down_revision = 'b47e0c9d2f31'
+branch_labels = None
+depends_on = None
+
+# activity_log(company_id, timestamp) is already served by ix_activity_log_company_timestamp_id
+INDEXES = [
+    ('ix_memberships_company_id', 'memberships', ['company_id']),
+    ('ix_company_owner_id', 'company', ['owner_id']),
+    ('ix_file_company_upload_date', 'file', ['company_id', 'upload_date']),
+    ('ix_file_user_company', 'file', ['user_id', 'company_id']),
+    ('ix_file_encrypted_name', 'file', ['encrypted_name']),
+]
+
+
+def _dedupe_memberships(bind):
+    """Collapse duplicate (user_id, company_id) rows so the primary key can be created.
+
+    The surviving row keeps a role if any of the duplicates had one.
+    """
+    memberships = sa.table('memberships', sa.column('user_id'), sa.column('company_id'), sa.column('role_id'))
+    bind.execute(memberships.delete().where(
+        sa.or_(memberships.c.user_id.is_(None), memberships.c.company_id.is_(None))
+    ))
+    duplicates = bind.execute(
+        sa.select(memberships.c.user_id, memberships.c.company_id, sa.func.max(memberships.c.role_id))
+        .group_by(memberships.c.user_id, memberships.c.company_id)
+        .having(sa.func.count() > 1)
+    ).all()
+    for user_id, company_id, role_id in duplicates:
+        match = sa.and_(memberships.c.user_id == user_id, memberships.c.company_id == company_id)
+        bind.execute(memberships.delete().where(match))
+        bind.execute(memberships.insert().values(user_id=user_id, company_id=company_id, role_id=role_id))
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    # db.create_all() already builds all of this on fresh databases
+    if not inspector.get_pk_constraint('memberships').get('constrained_columns'):
+        _dedupe_memberships(bind)
+        with op.batch_alter_table('memberships', schema=None) as batch_op:
+            batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=False)
+            batch_op.alter_column('company_id', existing_type=sa.Integer(), nullable=False)
+            batch_op.create_primary_key('memberships_pkey', ['user_id', 'company_id'])
+
+    for name, table, columns in INDEXES:
+        existing = {index['name'] for index in sa.inspect(bind).get_indexes(table)}
+        if name not in existing:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+
+    with op.batch_alter_table('memberships', schema=None) as batch_op:
+        batch_op.drop_constraint('memberships_pkey', type_='primary')
+        batch_op.alter_column('company_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=True)
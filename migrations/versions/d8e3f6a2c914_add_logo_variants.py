@@ -0,0 +1,108 @@
+"""Add logo variants and content-addressed logo names
+
+Revision ID: d8e3f6a2c914
+Revises: c5a1e7f03b28
+Create Date: 2026-10-18 17:12:40.093118
+
+"""
+import hashlib
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8e3f6a2c914'
+down_revision = 'c5a1e7f03b28'
+branch_labels = None
+depends_on = None
+
+
+# Copies of the vault/logos.py helpers as of this revision: the migration must keep doing
+# exactly this, whatever later happens to the app's naming or sniffing rules.
+DEFAULT_LOGO = 'logo.svg'
+_DIGEST_LENGTH = 32
+_LOGO_NAME = re.compile(r'^logos/([0-9a-f]{%d})\.[a-z]+$' % _DIGEST_LENGTH)
+_EXTENSIONS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+    'image/webp': 'webp',
+    'image/svg+xml': 'svg',
+    'image/x-icon': 'ico',
+}
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'\x00\x00\x01\x00', 'image/x-icon'),
+)
+
+
+def sniff_mimetype(data):
+    for signature, mimetype in _SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    head = data[:1024].lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if head.startswith(b'<') and b'<svg' in head:
+        return 'image/svg+xml'
+    return None
+
+
+def logo_name(data, mimetype):
+    digest = hashlib.sha256(data).hexdigest()[:_DIGEST_LENGTH]
+    return f"logos/{digest}.{_EXTENSIONS[mimetype]}"
+
+
+def logo_digest(logo):
+    match = _LOGO_NAME.match(logo or '')
+    return match.group(1) if match else None
+
+
+def _rename_logos(bind):
+    """'logos/<uuid>_<upload name>' -> 'logos/<digest>.<ext>', so logo URLs can be cached forever.
+
+    Variants are not built here; run `flask vault logo-variants` afterwards (needs Pillow).
+    """
+    company = sa.table('company', sa.column('id'), sa.column('logo'), sa.column('logo_data', sa.LargeBinary))
+    rows = bind.execute(
+        sa.select(company.c.id, company.c.logo).where(company.c.logo.like('logos/%'))
+    ).all()
+    for company_id, logo in rows:
+        if logo_digest(logo):
+            continue
+        data = bind.execute(sa.select(company.c.logo_data).where(company.c.id == company_id)).scalar()
+        mimetype = sniff_mimetype(data) if data else None
+        if mimetype is None:
+            # Nothing stored, or not an image: it never displayed properly anyway
+            print(f"[SCHEMA] Company {company_id}: logo {logo!r} is not a usable image; reset to default")
+            values = {'logo': DEFAULT_LOGO, 'logo_data': None}
+        else:
+            values = {'logo': logo_name(data, mimetype)}
+        bind.execute(company.update().where(company.c.id == company_id).values(**values))
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # db.create_all() already builds it on fresh databases
+    if 'logo_variant' not in sa.inspect(bind).get_table_names():
+        op.create_table(
+            'logo_variant',
+            sa.Column('company_id', sa.Integer(), sa.ForeignKey('company.id'), nullable=False),
+            sa.Column('size', sa.Integer(), nullable=False),
+            sa.Column('mimetype', sa.String(length=50), nullable=False),
+            sa.Column('data', sa.LargeBinary(), nullable=False),
+            sa.PrimaryKeyConstraint('company_id', 'size')
+        )
+
+    _rename_logos(bind)
+
+
+def downgrade():
+    # Content-addressed names keep working with the old lookup, so they are left as they are
+    op.drop_table('logo_variant')
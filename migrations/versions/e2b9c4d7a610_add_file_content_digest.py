@@ -0,0 +1,29 @@
+"""Add file content digest (HTTP validator)
+
+Revision ID: e2b9c4d7a610
+Revises: d8e3f6a2c914
+Create Date: 2026-10-18 18:02:55.561204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b9c4d7a610'
+down_revision = 'd8e3f6a2c914'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing files keep NULL and use encrypted_name as their ETag, see vault/streaming.py
+    existing = {col['name'] for col in sa.inspect(op.get_bind()).get_columns('file')}
+    if 'content_digest' not in existing:
+        with op.batch_alter_table('file', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('content_digest', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_column('content_digest')
@@ -0,0 +1,64 @@
+"""Add per-company counters for the stats API
+
+Revision ID: f4a7c2e9b813
+Revises: e2b9c4d7a610
+Create Date: 2026-10-18 19:26:11.482035
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a7c2e9b813'
+down_revision = 'e2b9c4d7a610'
+branch_labels = None
+depends_on = None
+
+
+def _backfill(bind):
+    """One counters row per company that has none, computed from its files and activity log."""
+    company = sa.table('company', sa.column('id'))
+    file = sa.table('file', sa.column('company_id'), sa.column('size'), sa.column('encrypted_size'))
+    log = sa.table('activity_log', sa.column('company_id'), sa.column('timestamp'))
+    stats = sa.table('company_stats', sa.column('company_id'), sa.column('file_count'), sa.column('plaintext_bytes'),
+                     sa.column('ciphertext_bytes'), sa.column('activity_count'), sa.column('last_activity_at'))
+
+    def per_company(table, expression):
+        return sa.select(expression).where(table.c.company_id == company.c.id).scalar_subquery()
+
+    rows = sa.select(
+        company.c.id,
+        per_company(file, sa.func.count()),
+        per_company(file, sa.func.coalesce(sa.func.sum(file.c.size), 0)),
+        per_company(file, sa.func.coalesce(sa.func.sum(file.c.encrypted_size), 0)),
+        per_company(log, sa.func.count()),
+        per_company(log, sa.func.max(log.c.timestamp)),
+    ).where(~sa.exists().where(stats.c.company_id == company.c.id))
+    bind.execute(stats.insert().from_select(
+        ['company_id', 'file_count', 'plaintext_bytes', 'ciphertext_bytes', 'activity_count', 'last_activity_at'],
+        rows
+    ))
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # db.create_all() already builds it on fresh databases
+    if 'company_stats' not in sa.inspect(bind).get_table_names():
+        op.create_table(
+            'company_stats',
+            sa.Column('company_id', sa.Integer(), sa.ForeignKey('company.id'), nullable=False),
+            sa.Column('file_count', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('plaintext_bytes', sa.BigInteger(), nullable=False, server_default='0'),
+            sa.Column('ciphertext_bytes', sa.BigInteger(), nullable=False, server_default='0'),
+            sa.Column('activity_count', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('last_activity_at', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('company_id')
+        )
+
+    _backfill(bind)
+
+
+def downgrade():
+    op.drop_table('company_stats')
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# Fixed settings, not defaults: a local .env or shell must not change what the tests see
+_workdir = tempfile.mkdtemp(prefix='vault-tests-')
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(_workdir, 'test.db')}",
+    'BLOB_STORAGE': 'db',
+    'BLOB_STORAGE_PATH': os.path.join(_workdir, 'blobs'),
+    'SCHEMA_ON_BOOT': 'migrate',
+    'KEY_POOL_SIZE': '0',
+    'ACTIVITY_LOG_MODE': 'sync',
+    'MAIL_DELIVERY': 'queue',
+    'MAIL_SERVER': 'localhost',
+    'MAIL_PORT': '1',
+    'MAIL_USE_TLS': 'false',
+    'BOOT_TIMING': '0',
+    'METRICS': 'off',
+    'QUERY_GUARD': 'raise',
+})
+
+
+@pytest.fixture(scope='session')
+def app():
+    from vault import create_app
+
+    app = create_app()
+    app.config['TESTING'] = True
+    # The test client posts forms without tokens
+    app.config['WTF_CSRF_ENABLED'] = False
+    return app
+
+
+@pytest.fixture(scope='session')
+def user_keys():
+    from vault.crypto_utils import generate_user_keys
+
+    return generate_user_keys()
+
+
+@pytest.fixture(scope='session')
+def legacy_cbc():
+    """legacy_cbc(plaintext, public_key_pem) -> (ciphertext, encrypted_aes_key, iv) as written
+    before the segmented format: AES-256-CBC + PKCS7, 16 byte IV."""
+    def encrypt(plain, public_key_pem):
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        from vault.crypto_utils import wrap_aes_key
+
+        aes_key, iv = os.urandom(32), os.urandom(16)
+        padder = padding.PKCS7(128).padder()
+        encryptor = Cipher(algorithms.AES(aes_key), modes.CBC(iv)).encryptor()
+        data = encryptor.update(padder.update(plain) + padder.finalize()) + encryptor.finalize()
+        return data, wrap_aes_key(aes_key, public_key_pem), iv
+    return encrypt
+
+
+@pytest.fixture
+def login(app):
+    """login(user_id) -> a test client already past login + OTP."""
+    def client_for(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        return client
+    return client_for
+
+
+@pytest.fixture
+def make_company(app, user_keys):
+    """make_company() -> (owner id, company id): a new company whose owner holds an all-permissions role."""
+    def create():
+        from vault.companies.services import PERMISSIONS
+        from vault.extensions import db
+        from vault.models import Company, CompanyStats, Role, User, memberships
+
+        tag = uuid.uuid4().hex[:8]
+        with app.app_context():
+            owner = User(email=f"owner-{tag}@example.com", password='x',
+                         rsa_private_key=user_keys[0], rsa_public_key=user_keys[1])
+            db.session.add(owner)
+            db.session.flush()
+            company = Company(name=f"Company {tag}", password='company', owner_id=owner.id)
+            db.session.add(company)
+            db.session.flush()
+            db.session.add(CompanyStats(company_id=company.id))  # as create_company does
+            role = Role(name='Administrator', company_id=company.id, **{perm: True for perm in PERMISSIONS})
+            db.session.add(role)
+            db.session.flush()
+            db.session.execute(memberships.insert().values(user_id=owner.id, company_id=company.id, role_id=role.id))
+            db.session.commit()
+            return owner.id, company.id
+    return create
@@ -0,0 +1,88 @@
+"""The activity log buffer: bad records are dropped without blocking the rest, nothing is written twice."""
+import uuid
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import vault.activity_log as activity_log_module
+from vault.activity_log import MAX_ACTION_LENGTH, activity_log
+from vault.company_stats import reconcile
+from vault.extensions import db
+from vault.models import ActivityLog, Company, User
+
+
+@pytest.fixture
+def company_id(app, user_keys):
+    tag = uuid.uuid4().hex[:8]
+    with app.app_context():
+        owner = User(email=f"log-owner-{tag}@example.com", password='x',
+                     rsa_private_key=user_keys[0], rsa_public_key=user_keys[1])
+        db.session.add(owner)
+        db.session.flush()
+        company = Company(name=f"Log Co {tag}", password='company', owner_id=owner.id)
+        db.session.add(company)
+        db.session.commit()
+        return company.id
+
+
+@pytest.fixture
+def buffered(monkeypatch):
+    """Records stay queued until the test calls flush()."""
+    monkeypatch.setattr(activity_log, 'mode', 'buffered')
+    monkeypatch.setattr(activity_log, 'flush_size', 1000)
+    monkeypatch.setattr(activity_log, '_ensure_thread', lambda: None)
+    yield activity_log
+    activity_log.flush()
+
+
+def _actions(app, company_id):
+    with app.app_context():
+        return [row.action for row in ActivityLog.query.filter_by(company_id=company_id).order_by(ActivityLog.id)]
+
+
+def test_long_filename_does_not_block_later_records(app, company_id, buffered):
+    buffered.record(company_id, 'a@example.com', f"Uploaded file: {'x' * 300}.pdf")
+    buffered.flush()
+    buffered.record(company_id, 'a@example.com', 'Downloaded file: b.pdf')
+    buffered.flush()
+
+    actions = _actions(app, company_id)
+    assert len(actions) == 2 and buffered.depth == 0
+    assert len(actions[0]) == MAX_ACTION_LENGTH and actions[0].endswith('…')
+    assert actions[1] == 'Downloaded file: b.pdf'
+
+
+def test_rejected_record_is_dropped_and_the_rest_written(app, company_id, buffered):
+    dropped = buffered.dropped_records
+    buffered.record(company_id, 'a@example.com', 'first')
+    buffered.record(company_id, 'a@example.com', 'unbindable', ip_address=object())  # not a DataError, still rejected
+    buffered.record(company_id, 'a@example.com', 'third')
+    buffered.flush()
+
+    assert _actions(app, company_id) == ['first', 'third']
+    assert buffered.dropped_records == dropped + 1 and buffered.depth == 0
+
+
+def test_connection_loss_mid_fallback_requeues_only_unwritten_rows(app, company_id, buffered, monkeypatch):
+    real_activity_added = activity_log_module.activity_added
+    calls = []
+
+    def flaky_activity_added(conn, entries):
+        calls.append(entries)
+        if len(calls) == 2:
+            raise OperationalError('INSERT', {}, Exception('server closed the connection'))
+        real_activity_added(conn, entries)
+
+    monkeypatch.setattr(activity_log_module, 'activity_added', flaky_activity_added)
+    buffered.record(company_id, 'a@example.com', 'first')
+    buffered.record(company_id, 'a@example.com', 'unbindable', ip_address=object())
+    buffered.record(company_id, 'a@example.com', 'third')
+    assert buffered.flush() == 2  # 'first' written, 'unbindable' dropped, then the connection "fails"
+    assert buffered.depth == 1
+
+    monkeypatch.setattr(activity_log_module, 'activity_added', real_activity_added)
+    buffered.flush()
+    assert _actions(app, company_id) == ['first', 'third']
+    with app.app_context():
+        assert reconcile(company_id) == []  # activity_count counted 'first' once
+        db.session.rollback()
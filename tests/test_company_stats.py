@@ -0,0 +1,84 @@
+"""CompanyStats counters stay equal to a COUNT/SUM over the file and activity_log tables."""
+import io
+
+from vault import company_stats
+from vault.activity_log import activity_log
+from vault.extensions import db
+from vault.models import File
+
+
+def _upload(client, company_id, *files):
+    """One file through the form upload, several through /upload/batch."""
+    if len(files) == 1:
+        name, body = files[0]
+        return client.post(f'/companies/{company_id}/upload', data={'file': (io.BytesIO(body), name)},
+                           content_type='multipart/form-data')
+    return client.post(f'/companies/{company_id}/upload/batch',
+                       data={'files': [(io.BytesIO(body), name) for name, body in files]},
+                       content_type='multipart/form-data')
+
+
+def _assert_in_step(app, company_id):
+    activity_log.flush()
+    with app.app_context():
+        _, _, counters = company_stats.read(company_id)
+        assert counters == company_stats.computed_values(db.session.connection(), company_id)
+        assert company_stats.reconcile(company_id) == []
+        db.session.rollback()
+        return counters
+
+
+def _file_ids(app, company_id):
+    with app.app_context():
+        return [f.id for f in File.query.filter_by(company_id=company_id).order_by(File.id)]
+
+
+def test_counters_follow_uploads_deletes_and_logs(app, make_company, login):
+    owner_id, company_id = make_company()
+    client = login(owner_id)
+
+    _upload(client, company_id, ('a.txt', b'a' * 100))
+    counters = _assert_in_step(app, company_id)
+    assert (counters['file_count'], counters['plaintext_bytes'], counters['activity_count']) == (1, 100, 1)
+
+    response = _upload(client, company_id, ('b.txt', b'b' * 200), ('c.pdf', b'c' * 300), ('bad.exe', b'x'))
+    assert response.status_code in (200, 207)
+    counters = _assert_in_step(app, company_id)
+    assert (counters['file_count'], counters['plaintext_bytes'], counters['activity_count']) == (3, 600, 2)
+
+    client.post(f'/companies/{company_id}/delete/{_file_ids(app, company_id)[0]}')
+    counters = _assert_in_step(app, company_id)
+    assert (counters['file_count'], counters['plaintext_bytes'], counters['activity_count']) == (2, 500, 3)
+
+    client.get(f'/companies/{company_id}/download/{_file_ids(app, company_id)[0]}').get_data()
+    counters = _assert_in_step(app, company_id)
+    assert counters['activity_count'] == 4 and counters['last_activity_at'] is not None
+
+
+def test_size_change_and_move_out_of_company(app, make_company):
+    owner_id, company_id = make_company()
+    with app.app_context():
+        record = File(filename='d.txt', encrypted_name='stats-d', data=b'\0' * 64, size=40, encrypted_size=64,
+                      encrypted_aes_key=b'k', iv=b'\0' * 7, user_id=owner_id, company_id=company_id)
+        db.session.add(record)
+        db.session.commit()
+        file_id = record.id
+    assert _assert_in_step(app, company_id)['plaintext_bytes'] == 40
+
+    with app.app_context():
+        File.query.get(file_id).size = 45
+        db.session.commit()
+    assert _assert_in_step(app, company_id)['plaintext_bytes'] == 45
+
+    with app.app_context():
+        File.query.get(file_id).company_id = None
+        db.session.commit()
+    counters = _assert_in_step(app, company_id)
+    assert (counters['file_count'], counters['plaintext_bytes'], counters['ciphertext_bytes']) == (0, 0, 0)
+
+
+def test_personal_uploads_leave_company_counters_alone(app, make_company, login):
+    owner_id, company_id = make_company()
+    login(owner_id).post('/upload', data={'file': (io.BytesIO(b'p' * 10), 'p.txt')}, content_type='multipart/form-data')
+    counters = _assert_in_step(app, company_id)
+    assert (counters['file_count'], counters['activity_count']) == (0, 0)
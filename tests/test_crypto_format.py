@@ -0,0 +1,155 @@
+"""The segmented AES-256-GCM container (v2), its tamper checks, and legacy CBC blobs."""
+import io
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from vault.crypto_utils import (HEADER_SIZE, SEGMENT_SIZE, TAG_SIZE, FileEncryptor, decrypt_file_data,
+                                encrypt_file_data, encrypted_size, iter_decrypt, iter_decrypt_range,
+                                new_decryptor, plaintext_size)
+
+SIZES = [0, 1, SEGMENT_SIZE - 1, SEGMENT_SIZE, SEGMENT_SIZE + 1, 3 * SEGMENT_SIZE]
+SEALED = SEGMENT_SIZE + TAG_SIZE
+REJECTED = (InvalidTag, ValueError)
+
+
+@pytest.fixture(scope='module')
+def sealed(user_keys):
+    """{plaintext size: (plaintext, container, encrypted_aes_key, iv)}"""
+    out = {}
+    for size in SIZES:
+        plain = os.urandom(size)
+        out[size] = (plain,) + encrypt_file_data(plain, user_keys[1])
+    return out
+
+
+def _decrypt(user_keys, data, key, iv, chunk_size=SEGMENT_SIZE):
+    decryptor = new_decryptor(key, iv, user_keys[0])
+    chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    return b''.join(iter_decrypt(decryptor, chunks))
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_round_trip_at_segment_boundaries(user_keys, sealed, size):
+    plain, data, key, iv = sealed[size]
+    assert len(data) == encrypted_size(size)
+    assert plaintext_size(len(data)) == size
+    assert decrypt_file_data(data, key, iv, user_keys[0]) == plain
+    # Ciphertext chunks that don't line up with segments
+    assert _decrypt(user_keys, data, key, iv, chunk_size=7919) == plain
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_streaming_encryptor_matches_size(user_keys, size):
+    plain = os.urandom(size)
+    encryptor = FileEncryptor(user_keys[1])
+    out = []
+    for i in range(0, size, 1000):
+        out.append(encryptor.update(plain[i:i + 1000]))
+    out.append(encryptor.finalize())
+    data = b''.join(out)
+    assert encryptor.plaintext_size == size and encryptor.ciphertext_size == len(data) == encrypted_size(size)
+    assert decrypt_file_data(data, encryptor.encrypted_aes_key, encryptor.iv, user_keys[0]) == plain
+
+
+@pytest.mark.parametrize('start, end', [
+    (0, 0), (0, 1), (SEGMENT_SIZE - 1, SEGMENT_SIZE + 1), (SEGMENT_SIZE, 2 * SEGMENT_SIZE),
+    (2 * SEGMENT_SIZE - 5, 3 * SEGMENT_SIZE), (0, 3 * SEGMENT_SIZE),
+])
+def test_range_decryption(user_keys, sealed, start, end):
+    plain, data, key, iv = sealed[3 * SEGMENT_SIZE]
+
+    def read_range(offset, stop):
+        return [data[i:min(i + 5000, stop)] for i in range(offset, stop, 5000)]
+
+    decryptor = new_decryptor(key, iv, user_keys[0])
+    assert b''.join(iter_decrypt_range(decryptor, read_range, len(data), start, end)) == plain[start:end]
+
+
+def test_tampered_segment_is_rejected(user_keys, sealed):
+    plain, data, key, iv = sealed[3 * SEGMENT_SIZE]
+    tampered = bytearray(data)
+    tampered[HEADER_SIZE + SEALED + 10] ^= 0x01
+    with pytest.raises(REJECTED):
+        _decrypt(user_keys, bytes(tampered), key, iv)
+
+
+def test_tampered_header_is_rejected(user_keys, sealed):
+    plain, data, key, iv = sealed[SEGMENT_SIZE + 1]
+    tampered = bytearray(data)
+    tampered[HEADER_SIZE - 1] ^= 0x01  # nonce prefix no longer matches File.iv
+    with pytest.raises(REJECTED):
+        _decrypt(user_keys, bytes(tampered), key, iv)
+
+
+@pytest.mark.parametrize('cut', [
+    1,                        # inside the last segment's tag
+    SEGMENT_SIZE + TAG_SIZE,  # the whole last segment: the previous one wasn't sealed as last
+])
+def test_truncated_file_is_rejected(user_keys, sealed, cut):
+    plain, data, key, iv = sealed[3 * SEGMENT_SIZE]
+    with pytest.raises(REJECTED):
+        _decrypt(user_keys, data[:-cut], key, iv)
+
+
+def test_header_only_is_rejected(user_keys, sealed):
+    plain, data, key, iv = sealed[0]
+    with pytest.raises(REJECTED):
+        _decrypt(user_keys, data[:HEADER_SIZE], key, iv)
+
+
+def test_reordered_segments_are_rejected(user_keys, sealed):
+    plain, data, key, iv = sealed[3 * SEGMENT_SIZE]
+    body = data[HEADER_SIZE:]
+    segments = [body[i:i + SEALED] for i in range(0, len(body), SEALED)]
+    assert len(segments) == 3
+    swapped = data[:HEADER_SIZE] + segments[1] + segments[0] + segments[2]
+    with pytest.raises(REJECTED):
+        _decrypt(user_keys, swapped, key, iv)
+
+
+@pytest.mark.parametrize('size', [0, 15, 16, SEGMENT_SIZE + 1])
+def test_legacy_cbc_files_still_decrypt(user_keys, legacy_cbc, size):
+    plain = os.urandom(size)
+    data, key, iv = legacy_cbc(plain, user_keys[1])
+    assert decrypt_file_data(data, key, iv, user_keys[0]) == plain
+    assert _decrypt(user_keys, data, key, iv, chunk_size=1000) == plain
+
+
+def test_db_blob_store_writes_in_pieces(app, user_keys):
+    from vault.extensions import db
+    from vault.models import File
+    from vault.storage import DatabaseBlobStore
+
+    plain = os.urandom(3 * SEGMENT_SIZE)
+    encryptor = FileEncryptor(user_keys[1])
+    store = DatabaseBlobStore(write_size=50000)
+    with app.app_context():
+        record = File(filename='big.bin', encrypted_name=os.urandom(16).hex(),
+                      encrypted_aes_key=encryptor.encrypted_aes_key, iv=encryptor.iv)
+        db.session.add(record)
+        db.session.flush()
+        written = store.put(record.encrypted_name, encryptor.iter_encrypt(io.BytesIO(plain), chunk_size=4096))
+        assert written == encrypted_size(len(plain)) == store.size(record.encrypted_name)
+        data = store.get(record.encrypted_name)
+        assert decrypt_file_data(data, record.encrypted_aes_key, record.iv, user_keys[0]) == plain
+        db.session.rollback()
+
+
+
+def test_encrypt_file_data_peak_memory_is_one_ciphertext(user_keys):
+    import tracemalloc
+
+    plain = os.urandom(4 * 1024 * 1024)
+    encrypt_file_data(plain, user_keys[1])  # warm the key cache
+    tracemalloc.start()
+    try:
+        data, key, iv = encrypt_file_data(plain, user_keys[1])
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert len(data) == encrypted_size(len(plain))
+    # One ciphertext plus per-segment temporaries; joining the chunks needed about twice this
+    assert peak < len(data) + 1024 * 1024
+    assert decrypt_file_data(data, key, iv, user_keys[0]) == plain
@@ -0,0 +1,124 @@
+"""Download responses: Content-Length and Range for segmented and legacy CBC files, conditional GETs."""
+import os
+
+import vault.streaming
+
+from vault.crypto_utils import SEGMENT_SIZE, encrypt_file_data
+from vault.extensions import db
+from vault.models import ActivityLog, File, User
+from vault.storage import put_new_blob
+
+
+def _owner(app, keys, email):
+    with app.app_context():
+        user = User(email=email, password='x', rsa_private_key=keys[0], rsa_public_key=keys[1])
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def _store(app, user_id, filename, ciphertext, encrypted_aes_key, iv, size, company_id=None):
+    with app.app_context():
+        record = File(filename=filename, encrypted_name=os.urandom(16).hex(), encrypted_aes_key=encrypted_aes_key,
+                      iv=iv, user_id=user_id, company_id=company_id)
+        put_new_blob(record, [ciphertext])
+        record.size = size
+        db.session.commit()
+        return record.id
+
+
+def test_segmented_download_has_length_and_ranges(app, user_keys, login):
+    user_id = _owner(app, user_keys, 'segmented@example.com')
+    plain = os.urandom(SEGMENT_SIZE + 10)
+    file_id = _store(app, user_id, 'report.pdf', *encrypt_file_data(plain, user_keys[1]), size=len(plain))
+    client = login(user_id)
+
+    response = client.get(f'/download/{file_id}')
+    assert response.headers['Content-Length'] == str(len(plain))
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.get_data() == plain
+
+    response = client.get(f'/download/{file_id}', headers={'Range': f'bytes={SEGMENT_SIZE - 2}-{SEGMENT_SIZE + 1}'})
+    assert response.status_code == 206
+    assert response.get_data() == plain[SEGMENT_SIZE - 2:SEGMENT_SIZE + 2]
+
+
+def test_legacy_download_has_content_length(app, user_keys, login, legacy_cbc):
+    user_id = _owner(app, user_keys, 'legacy@example.com')
+    client = login(user_id)
+    for size in (0, 5, 16, 1000):
+        plain = os.urandom(size)
+        file_id = _store(app, user_id, 'old.txt', *legacy_cbc(plain, user_keys[1]), size=size)
+        response = client.get(f'/download/{file_id}')
+        assert response.headers['Content-Length'] == str(size)
+        assert response.get_data() == plain
+
+
+def test_legacy_download_with_padded_size_omits_content_length(app, user_keys, login, legacy_cbc):
+    # A row a9d4b7e1c352 couldn't correct still records the padded length
+    user_id = _owner(app, user_keys, 'padded@example.com')
+    plain = os.urandom(20)
+    data, encrypted_aes_key, iv = legacy_cbc(plain, user_keys[1])
+    file_id = _store(app, user_id, 'old.txt', data, encrypted_aes_key, iv, size=len(data))
+
+    response = login(user_id).get(f'/download/{file_id}')
+    assert 'Content-Length' not in response.headers
+    assert response.get_data() == plain
+
+
+def test_non_ascii_filename_gets_utf8_disposition(app, user_keys, login):
+    user_id = _owner(app, user_keys, 'disposition@example.com')
+    plain = b'hello'
+    file_id = _store(app, user_id, 'résumé.pdf', *encrypt_file_data(plain, user_keys[1]), size=len(plain))
+
+    disposition = login(user_id).get(f'/download/{file_id}').headers['Content-Disposition']
+    assert disposition == "attachment; filename=resume.pdf; filename*=UTF-8''r%C3%A9sum%C3%A9.pdf"
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError('a 304 must not read the blob or unwrap the key')
+
+
+def test_conditional_get_returns_304_without_touching_blob_or_key(app, user_keys, login, monkeypatch):
+    user_id = _owner(app, user_keys, 'conditional@example.com')
+    plain = b'cached'
+    file_id = _store(app, user_id, 'c.txt', *encrypt_file_data(plain, user_keys[1]), size=len(plain))
+    client = login(user_id)
+    first = client.get(f'/download/{file_id}')
+    etag, last_modified = first.headers['ETag'], first.headers['Last-Modified']
+    assert first.get_data() == plain and first.headers['Cache-Control'] == 'private, no-cache'
+
+    monkeypatch.setattr(vault.streaming, 'store_for', _fail)
+    monkeypatch.setattr(vault.streaming, 'new_decryptor', _fail)
+    for headers in ({'If-None-Match': etag}, {'If-Modified-Since': last_modified},
+                    # If-None-Match wins, even with a date that would match
+                    {'If-None-Match': etag, 'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'}):
+        response = client.get(f'/download/{file_id}', headers=headers)
+        assert response.status_code == 304, headers
+        assert response.get_data() == b'' and response.headers['ETag'] == etag
+
+
+def test_stale_validators_get_the_file(app, user_keys, login):
+    user_id = _owner(app, user_keys, 'stale@example.com')
+    plain = b'fresh'
+    file_id = _store(app, user_id, 'f.txt', *encrypt_file_data(plain, user_keys[1]), size=len(plain))
+    client = login(user_id)
+    for headers in ({'If-None-Match': '"something-else"'}, {'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'}):
+        response = client.get(f'/download/{file_id}', headers=headers)
+        assert response.status_code == 200 and response.get_data() == plain
+
+
+def test_company_download_304_is_still_logged(app, user_keys, login, make_company):
+    owner_id, company_id = make_company()
+    plain = b'company'
+    file_id = _store(app, owner_id, 'q.pdf', *encrypt_file_data(plain, user_keys[1]), size=len(plain),
+                     company_id=company_id)
+    client = login(owner_id)
+    url = f'/companies/{company_id}/download/{file_id}'
+    etag = client.get(url).headers['ETag']
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    with app.app_context():
+        actions = [row.action for row in ActivityLog.query.filter_by(company_id=company_id)]
+    assert actions == ['Downloaded file: q.pdf'] * 2
@@ -0,0 +1,93 @@
+"""The activity feed: polling on servers that run one request at a time, and access re-checks."""
+import time
+from datetime import datetime
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from vault.extensions import db
+from vault.live_feed import _serves_concurrently, live_feed
+from vault.models import ActivityLog, Company, Role, User, memberships
+
+
+@pytest.fixture(scope='module')
+def feed_company(app, user_keys):
+    """(owner id, company id, id of its one log entry)"""
+    with app.app_context():
+        owner = User(email='feed-owner@example.com', password=generate_password_hash('password', method='pbkdf2:sha256:1'),
+                     rsa_private_key=user_keys[0], rsa_public_key=user_keys[1])
+        db.session.add(owner)
+        db.session.flush()
+        company = Company(name='Feed Co', password='company', owner_id=owner.id)
+        db.session.add(company)
+        db.session.flush()
+        role = Role(name='Administrator', company_id=company.id, perm_admin=True, perm_view=True, perm_logs=True)
+        db.session.add(role)
+        db.session.flush()
+        db.session.execute(memberships.insert().values(user_id=owner.id, company_id=company.id, role_id=role.id))
+        entry = ActivityLog(company_id=company.id, user_email=owner.email, action='Uploaded file: a.pdf',
+                            ip_address='127.0.0.1', timestamp=datetime.utcnow())
+        db.session.add(entry)
+        db.session.commit()
+        return owner.id, company.id, entry.id
+
+
+def test_single_threaded_server_gets_polling(feed_company, login):
+    owner_id, company_id, entry_id = feed_company
+    response = login(owner_id).get(f'/api/v1/logs/{company_id}/stream?last_id=0',
+                                   environ_overrides={'wsgi.multithread': False})
+    body = response.get_data(as_text=True)  # returns: the stream closed after catching up
+    assert body.startswith(f"retry: {int(live_feed.poll_interval * 1000)}\n\n")
+    assert f"id: {entry_id}\n" in body
+    assert live_feed.subscriber_count == 0 and live_feed._thread is None
+
+
+@pytest.mark.parametrize('env_args, argv, expected', [
+    ('', ['wsgi:app'], False),
+    ('', ['-w', '4', 'wsgi:app'], False),
+    ('', ['--worker-class', 'gthread', '--threads', '8', 'wsgi:app'], True),
+    ('', ['--threads', '8', 'wsgi:app'], True),
+    ('-k gevent', ['wsgi:app'], True),
+    ('', ['-c', 'gunicorn.conf.py', 'wsgi:app'], None),
+])
+def test_gunicorn_worker_model_is_read_at_startup(monkeypatch, env_args, argv, expected):
+    monkeypatch.setenv('SERVER_SOFTWARE', 'gunicorn/21.2.0')
+    monkeypatch.setenv('GUNICORN_CMD_ARGS', env_args)
+    monkeypatch.setattr('sys.argv', ['gunicorn', *argv])
+    assert _serves_concurrently() is expected
+
+
+def test_other_servers_are_unknown_at_startup(monkeypatch):
+    monkeypatch.delenv('SERVER_SOFTWARE', raising=False)
+    assert _serves_concurrently() is None
+
+
+def test_revoked_viewer_is_cut_off_while_events_keep_arriving(app, monkeypatch):
+    monkeypatch.setattr(live_feed, 'heartbeat', 0.2)
+    monkeypatch.setattr(live_feed, '_ensure_thread', lambda: None)  # events are delivered by the test
+    company_id = 10 ** 6
+    allowed = [True]
+    received = []
+    with app.app_context():
+        stream = live_feed.stream(company_id, None, lambda: allowed[0], max_seconds=30)
+        assert next(stream).startswith('retry:')
+        subscriber = next(iter(live_feed._subscribers[company_id]))
+        started = time.monotonic()
+        for entry_id in range(1, 200):
+            if entry_id == 5:
+                allowed[0], revoked_at = False, time.monotonic()
+            live_feed._deliver(subscriber, {'id': entry_id, 'user': 'a@example.com', 'action': 'busy',
+                                            'ip_address': None, 'timestamp': datetime.utcnow().isoformat()})
+            chunk = next(stream)
+            while chunk.startswith(':'):
+                chunk = next(stream)
+            received.append(chunk)
+            if chunk.startswith('event: revoked'):
+                break
+            time.sleep(0.02)
+        stream.close()
+
+    assert received[-1].startswith('event: revoked')
+    assert time.monotonic() - revoked_at < 2 * live_feed.heartbeat
+    assert live_feed.subscriber_count == 0
+    assert time.monotonic() - started < 5
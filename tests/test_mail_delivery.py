@@ -0,0 +1,156 @@
+"""MailDeliveryQueue against a real SMTP server on localhost (plain SMTP, no STARTTLS/login)."""
+import queue
+import socketserver
+import threading
+import time
+
+import pytest
+from flask_mail import Message
+
+from vault.auth.utils import MailDeliveryQueue
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self._reply('220 localhost test SMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self._reply('250 localhost')
+            elif command.startswith('MAIL FROM'):
+                if server.fail_next:
+                    server.fail_next -= 1
+                    self._reply('451 Temporary failure, try again')
+                else:
+                    self._reply('250 OK')
+            elif command.startswith('DATA'):
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                body = []
+                while (data := self.rfile.readline()) not in (b'.\r\n', b''):
+                    body.append(data)
+                server.messages.append(b''.join(body))
+                self._reply('250 Queued')
+            elif command.startswith('QUIT'):
+                self._reply('221 Bye')
+                return
+            else:  # RCPT, NOOP, RSET
+                self._reply('250 OK')
+
+
+class _SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.connections = 0
+        self.fail_next = 0
+        self.messages = []
+
+
+@pytest.fixture
+def smtp_server():
+    server = _SMTPServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def mail(app, smtp_server, monkeypatch):
+    """A fresh delivery queue (own worker, connection and counters) pointed at smtp_server."""
+    monkeypatch.setitem(app.config, 'MAIL_SERVER', '127.0.0.1')
+    monkeypatch.setitem(app.config, 'MAIL_PORT', smtp_server.server_address[1])
+    monkeypatch.setitem(app.config, 'MAIL_USE_TLS', False)
+    monkeypatch.setitem(app.config, 'MAIL_USERNAME', None)
+    monkeypatch.setitem(app.config, 'MAIL_DELIVERY', 'queue')
+    monkeypatch.setitem(app.config, 'MAIL_MAX_RETRIES', 3)
+    monkeypatch.setitem(app.config, 'MAIL_RETRY_BACKOFF', 0.01)
+    mail_queue = MailDeliveryQueue()
+    mail_queue.init_app(app)
+    yield mail_queue
+    mail_queue.connection.close()
+
+
+def _message(n=0):
+    msg = Message(f'Login OTP {n}', sender='vault@localhost', recipients=['user@example.com'])
+    msg.body = f'OTP {n}'
+    return msg
+
+
+def test_queued_messages_share_one_connection(mail, smtp_server):
+    for n in range(3):
+        assert mail.deliver(_message(n)) is True
+    mail.join()
+
+    assert len(smtp_server.messages) == 3
+    assert smtp_server.connections == 1
+    assert mail.stats()['connects'] == 1
+    assert mail.stats()['sent'] == 3
+
+
+def test_worker_retries_temporary_failures(mail, smtp_server):
+    smtp_server.fail_next = 2
+    mail.deliver(_message())
+    mail.join()
+
+    assert len(smtp_server.messages) == 1
+    assert mail.retries == 2
+    assert mail.sent == 1 and mail.failed == 0
+    # A refusal leaves the connection usable: retried on it, not reconnected
+    assert smtp_server.connections == 1
+
+
+def test_worker_gives_up_after_max_retries(app, mail, smtp_server):
+    smtp_server.fail_next = app.config['MAIL_MAX_RETRIES'] + 1
+    mail.deliver(_message())
+    mail.join()
+
+    assert smtp_server.messages == []
+    assert mail.retries == app.config['MAIL_MAX_RETRIES']
+    assert mail.failed == 1
+
+
+def test_sync_mode_tries_once(app, mail, smtp_server, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_DELIVERY', 'sync')
+    # Long backoff: a retry on the request thread would show up in the elapsed time
+    monkeypatch.setitem(app.config, 'MAIL_RETRY_BACKOFF', 5.0)
+    smtp_server.fail_next = 1
+
+    started = time.monotonic()
+    assert mail.deliver(_message()) is False
+    assert time.monotonic() - started < 2.0
+    assert mail.retries == 0 and mail.failed == 1
+
+    assert mail.deliver(_message()) is True
+    assert len(smtp_server.messages) == 1
+    assert smtp_server.connections == 1
+
+
+def test_full_queue_sends_inline_once(app, mail, smtp_server, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_RETRY_BACKOFF', 5.0)
+    # A full queue and no worker draining it
+    mail._queue = queue.Queue(maxsize=1)
+    mail._queue.put_nowait(None)
+
+    assert mail.deliver(_message(1)) is True
+    assert mail.rejected == 1
+    assert len(smtp_server.messages) == 1
+
+    smtp_server.fail_next = 1
+    started = time.monotonic()
+    assert mail.deliver(_message(2)) is False
+    assert time.monotonic() - started < 2.0
+    assert mail.rejected == 2 and mail.retries == 0
+    assert len(smtp_server.messages) == 1
@@ -0,0 +1,114 @@
+"""@query_budget checks: each page stays within its budget, and its query count doesn't grow with the data.
+
+The app runs with QUERY_GUARD=raise (see conftest.py), so an N+1 loop also fails the request itself.
+"""
+import itertools
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from vault.extensions import db
+from vault.models import ActivityLog, Company, File, Role, User, memberships
+from vault.query_guard import count_queries
+
+SIZES = (2, 40)
+_tags = itertools.count()
+
+
+class Workspace:
+    """An owner with a company whose roster, files and log grow on demand."""
+
+    def __init__(self, app, keys, tag):
+        self.app, self.keys, self.tag = app, keys, tag
+        self.members = self.files = self.logs = 0
+        with app.app_context():
+            owner = self._user(f"owner-{tag}@example.com")
+            company = Company(name=f"Budget Co {tag}", password='company', owner_id=owner.id)
+            db.session.add(company)
+            db.session.flush()
+            admin = Role(name='Administrator', company_id=company.id, perm_admin=True, perm_view=True,
+                         perm_upload=True, perm_download=True, perm_logs=True, perm_manage_roles=True)
+            viewer = Role(name='Viewer', company_id=company.id, perm_view=True)
+            db.session.add_all([admin, viewer])
+            db.session.flush()
+            db.session.execute(memberships.insert().values(user_id=owner.id, company_id=company.id, role_id=admin.id))
+            db.session.commit()
+            self.owner_id, self.company_id, self.role_ids = owner.id, company.id, (admin.id, viewer.id)
+
+    def _user(self, email):
+        user = User(email=email, password=generate_password_hash('password', method='pbkdf2:sha256:1'),
+                    rsa_private_key=self.keys[0], rsa_public_key=self.keys[1])
+        db.session.add(user)
+        db.session.flush()
+        return user
+
+    def grow_to(self, n):
+        """n members (every other one without a role), n company files, n personal files, n log entries."""
+        now = datetime.utcnow()
+        with self.app.app_context():
+            for i in range(self.members, n):
+                member = self._user(f"member-{self.tag}-{i}@example.com")
+                db.session.execute(memberships.insert().values(
+                    user_id=member.id, company_id=self.company_id, role_id=self.role_ids[1] if i % 2 else None))
+            for i in range(self.files, n):
+                for company_id in (self.company_id, None):
+                    db.session.add(File(filename=f"doc-{i}.pdf", encrypted_name=os.urandom(16).hex(),
+                                        data=b'\0' * 32, size=16, encrypted_size=32, encrypted_aes_key=b'k',
+                                        iv=b'\0' * 16, user_id=self.owner_id, company_id=company_id))
+            for i in range(self.logs, n):
+                db.session.add(ActivityLog(company_id=self.company_id, user_email=f"owner-{self.tag}@example.com",
+                                           action=f"Downloaded file: doc-{i}.pdf", ip_address='127.0.0.1',
+                                           timestamp=now - timedelta(seconds=i)))
+            db.session.commit()
+        self.members = self.files = self.logs = n
+
+
+@pytest.fixture
+def workspace(app, user_keys):
+    return Workspace(app, user_keys, next(_tags))
+
+
+def _budget(app, endpoint):
+    return app.view_functions[endpoint]._query_budget
+
+
+@pytest.mark.parametrize('endpoint, path', [
+    ('main.dashboard', '/dashboard'),
+    ('companies.company_files', '/companies/{company_id}/files'),
+    ('companies.company_users', '/companies/{company_id}/users'),
+    ('companies.company_roles', '/companies/{company_id}/roles'),
+    ('companies.company_logs', '/companies/{company_id}/logs'),
+    ('companies.edit_user_role', '/companies/{company_id}/edit_user_role/{owner_id}'),
+    ('api.company_logs', '/api/v1/logs/{company_id}'),
+    ('api.get_company_stats', '/api/v1/stats/{company_id}'),
+])
+def test_view_query_count_is_bounded_and_constant(app, workspace, login, endpoint, path):
+    budget = _budget(app, endpoint)
+    client = login(workspace.owner_id)
+    url = path.format(company_id=workspace.company_id, owner_id=workspace.owner_id)
+
+    counts = []
+    for size in SIZES:
+        workspace.grow_to(size)
+        client.get(url)  # warm the permission and company list caches, as a second page view would be
+        with count_queries() as counter:
+            response = client.get(url)
+        assert response.status_code == 200, response.get_data(as_text=True)[:200]
+        assert counter.total <= budget, f"{endpoint}: {counter.total} queries with {size} rows (budget {budget})"
+        assert int(response.headers['X-Query-Count']) == counter.total
+        counts.append(counter.total)
+
+    assert counts[0] == counts[-1], f"{endpoint}: query count grows with the data: {dict(zip(SIZES, counts))}"
+
+
+def test_budget_violation_raises(app, workspace, login, monkeypatch):
+    from vault.query_guard import QueryBudgetExceeded
+
+    view = app.view_functions['companies.company_users']
+    monkeypatch.setattr(view, '_query_budget', 1)
+    # Let the guard's exception reach the test instead of becoming a 500
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', True)
+    with pytest.raises(QueryBudgetExceeded):
+        login(workspace.owner_id).get(f"/companies/{workspace.company_id}/users")
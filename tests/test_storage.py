@@ -0,0 +1,123 @@
+"""The filesystem blob backend and `flask vault move-blobs` between the two backends."""
+import os
+
+import pytest
+
+from vault.crypto_utils import encrypt_file_data
+from vault.extensions import db
+from vault.models import File, User
+from vault.storage import FilesystemBlobStore, get_blob_store, put_new_blob
+
+
+def _files_under(root):
+    return sorted(name for _, _, names in os.walk(root) for name in names)
+
+
+def test_filesystem_round_trip_and_ranges(tmp_path):
+    store = FilesystemBlobStore(str(tmp_path))
+    data = os.urandom(100000)
+    assert store.put('blob-a', (data[i:i + 7000] for i in range(0, len(data), 7000))) == len(data)
+
+    assert store.get('blob-a') == data and store.size('blob-a') == len(data)
+    assert _files_under(tmp_path) == ['blob-a']
+    assert b''.join(store.stream('blob-a', chunk_size=4096)) == data
+    for start, end in ((0, 1), (4095, 4097), (12345, 67890), (99990, None), (99990, 200000)):
+        assert b''.join(store.stream('blob-a', start, end, chunk_size=4096)) == data[start:end]
+    assert b''.join(store.stream('blob-a', len(data), None)) == b''
+
+    store.delete('blob-a')
+    assert store.get('blob-a') is None and store.size('blob-a') is None and _files_under(tmp_path) == []
+
+
+def test_failed_put_leaves_no_tmp_file_and_keeps_the_old_blob(tmp_path):
+    store = FilesystemBlobStore(str(tmp_path))
+    store.put('blob-b', [b'original'])
+
+    def broken():
+        yield b'partial'
+        raise IOError('client went away')
+
+    with pytest.raises(IOError):
+        store.put('blob-b', broken())
+    assert _files_under(tmp_path) == ['blob-b']
+    assert store.get('blob-b') == b'original'
+
+
+@pytest.fixture
+def owner_id(app, user_keys):
+    with app.app_context():
+        user = User(email=f"storage-{os.urandom(4).hex()}@example.com", password='x',
+                    rsa_private_key=user_keys[0], rsa_public_key=user_keys[1])
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def _store(app, owner_id, plain, user_keys):
+    with app.app_context():
+        data, encrypted_aes_key, iv = encrypt_file_data(plain, user_keys[1])
+        record = File(filename='moved.bin', encrypted_name=os.urandom(16).hex(),
+                      encrypted_aes_key=encrypted_aes_key, iv=iv, user_id=owner_id, size=len(plain))
+        put_new_blob(record, [data])
+        db.session.commit()
+        return record.id
+
+
+def _row(app, file_id):
+    with app.app_context():
+        record = File.query.get(file_id)
+        return record.storage, record.data, record.encrypted_name
+
+
+def test_filesystem_download_serves_ranges(app, user_keys, owner_id, login, monkeypatch):
+    monkeypatch.setitem(app.config, 'BLOB_STORAGE', 'filesystem')
+    plain = os.urandom(200000)
+    file_id = _store(app, owner_id, plain, user_keys)
+    assert _row(app, file_id)[0] == 'filesystem'
+
+    client = login(owner_id)
+    assert client.get(f'/download/{file_id}').get_data() == plain
+    response = client.get(f'/download/{file_id}', headers={'Range': 'bytes=70000-140000'})
+    assert response.status_code == 206 and response.get_data() == plain[70000:140001]
+
+
+def test_move_blobs_both_ways(app, user_keys, owner_id, login):
+    plain = os.urandom(5000)
+    file_id = _store(app, owner_id, plain, user_keys)
+    runner = app.test_cli_runner()
+    with app.app_context():
+        fs = get_blob_store('filesystem')
+
+    result = runner.invoke(args=['vault', 'move-blobs', '--to', 'filesystem'])
+    assert result.exit_code == 0, result.output
+    storage, data, name = _row(app, file_id)
+    assert storage == 'filesystem' and data is None and os.path.exists(fs.path_for(name))
+    assert login(owner_id).get(f'/download/{file_id}').get_data() == plain
+
+    result = runner.invoke(args=['vault', 'move-blobs', '--to', 'db'])
+    assert result.exit_code == 0, result.output
+    storage, data, name = _row(app, file_id)
+    assert storage == 'db' and data is not None and not os.path.exists(fs.path_for(name))
+    assert login(owner_id).get(f'/download/{file_id}').get_data() == plain
+
+
+def test_move_blobs_keeps_the_source_when_the_commit_fails(app, user_keys, owner_id, monkeypatch):
+    monkeypatch.setitem(app.config, 'BLOB_STORAGE', 'filesystem')
+    file_id = _store(app, owner_id, os.urandom(5000), user_keys)
+    monkeypatch.setitem(app.config, 'BLOB_STORAGE', 'db')
+    with app.app_context():
+        fs = get_blob_store('filesystem')
+    name = _row(app, file_id)[2]
+
+    def failing_commit():
+        raise RuntimeError('connection lost during commit')
+
+    monkeypatch.setattr(db.session, 'commit', failing_commit)
+    result = app.test_cli_runner().invoke(args=['vault', 'move-blobs', '--to', 'db'])
+    monkeypatch.undo()
+
+    assert isinstance(result.exception, RuntimeError)
+    assert _row(app, file_id)[0] == 'filesystem' and os.path.exists(fs.path_for(name))
+    # The next run finishes the move
+    assert app.test_cli_runner().invoke(args=['vault', 'move-blobs', '--to', 'db']).exit_code == 0
+    assert _row(app, file_id)[0] == 'db' and not os.path.exists(fs.path_for(name))
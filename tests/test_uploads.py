@@ -0,0 +1,92 @@
+"""Uploads: the single-file forms and /upload/batch (per-file results, all-or-nothing storage, file limit)."""
+import io
+
+import pytest
+
+from vault import company_stats
+from vault.crypto_utils import decrypt_file_data
+from vault.models import ActivityLog, File
+from vault.storage import DatabaseBlobStore
+
+
+def _files(*items):
+    return {'files': [(io.BytesIO(body), name) for name, body in items]}
+
+
+def _stored(app, **filters):
+    with app.app_context():
+        return sorted((f.filename, f.size) for f in File.query.filter_by(**filters))
+
+
+def test_batch_rejects_bad_files_and_stores_the_rest(app, make_company, login, user_keys):
+    owner_id, company_id = make_company()
+    response = login(owner_id).post(f'/companies/{company_id}/upload/batch', content_type='multipart/form-data',
+                                    data=_files(('a.pdf', b'a' * 10), ('run.exe', b'x'), ('', b''), ('b.txt', b'b' * 20)))
+    payload = response.get_json()
+    assert response.status_code == 200
+    assert (payload['uploaded'], payload['rejected'], payload['failed']) == (2, 2, 0)
+    assert [f['status'] for f in payload['files']] == ['uploaded', 'rejected', 'rejected', 'uploaded']
+    assert _stored(app, company_id=company_id) == [('a.pdf', 10), ('b.txt', 20)]
+
+    with app.app_context():
+        record = File.query.get(payload['files'][0]['id'])
+        plain = decrypt_file_data(record.data, record.encrypted_aes_key, record.iv, user_keys[0])
+        actions = [row.action for row in ActivityLog.query.filter_by(company_id=company_id)]
+    assert plain == b'a' * 10
+    assert actions == ['Uploaded files (2): a.pdf, b.txt']
+
+
+def test_batch_of_only_rejected_files_is_a_400(app, make_company, login):
+    owner_id, _ = make_company()
+    response = login(owner_id).post('/upload/batch', content_type='multipart/form-data',
+                                    data=_files(('run.exe', b'x'), ('script.sh', b'y')))
+    assert response.status_code == 400 and response.get_json()['rejected'] == 2
+    assert _stored(app, user_id=owner_id) == []
+
+
+def test_storage_failure_saves_nothing_from_the_batch(app, make_company, login, monkeypatch):
+    owner_id, company_id = make_company()
+    real_put = DatabaseBlobStore.put
+    calls = []
+
+    def put_failing_second(self, name, chunks):
+        calls.append(name)
+        if len(calls) == 2:
+            raise OSError('disk full')
+        return real_put(self, name, chunks)
+
+    monkeypatch.setattr(DatabaseBlobStore, 'put', put_failing_second)
+    response = login(owner_id).post(f'/companies/{company_id}/upload/batch', content_type='multipart/form-data',
+                                    data=_files(('a.pdf', b'a'), ('b.pdf', b'b'), ('c.pdf', b'c')))
+    payload = response.get_json()
+    assert response.status_code == 500 and payload['failed'] == 3 and payload['uploaded'] == 0
+    assert _stored(app, company_id=company_id) == []
+    with app.app_context():
+        assert ActivityLog.query.filter_by(company_id=company_id).count() == 0
+        _, _, counters = company_stats.read(company_id)
+    assert counters['file_count'] == 0
+
+
+@pytest.mark.parametrize('path', ['/upload/batch', '/companies/{company_id}/upload/batch'])
+def test_batch_file_limit(app, make_company, login, monkeypatch, path):
+    owner_id, company_id = make_company()
+    monkeypatch.setitem(app.config, 'UPLOAD_BATCH_MAX_FILES', 2)
+    response = login(owner_id).post(path.format(company_id=company_id), content_type='multipart/form-data',
+                                    data=_files(('a.pdf', b'a'), ('b.pdf', b'b'), ('c.pdf', b'c')))
+    assert response.status_code == 400 and 'At most 2 files' in response.get_json()['error']
+    assert _stored(app, user_id=owner_id) == []
+
+
+def test_batch_without_files_is_a_400(make_company, login):
+    owner_id, _ = make_company()
+    assert login(owner_id).post('/upload/batch', content_type='multipart/form-data', data={}).status_code == 400
+
+
+@pytest.mark.parametrize('path', ['/upload', '/companies/{company_id}/upload'])
+def test_single_upload_checks_the_shared_extension_list(app, make_company, login, path):
+    owner_id, company_id = make_company()
+    client = login(owner_id)
+    for name in ('notes.txt', 'virus.exe'):
+        client.post(path.format(company_id=company_id), content_type='multipart/form-data',
+                    data={'file': (io.BytesIO(b'hello'), name)})
+    assert _stored(app, user_id=owner_id) == [('notes.txt', 5)]
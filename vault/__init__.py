@@ -1,9 +1,16 @@
 import os
+import time
+_import_started = time.perf_counter()
+
+import click
 from flask import Flask
 # Added 'csrf' to the import list
-from .extensions import db, login_manager, main_bp, csrf, mail 
+from .extensions import db, login_manager, main_bp, csrf
+
+_import_seconds = time.perf_counter() - _import_started
 
 def create_app():
+    boot_started = time.perf_counter()
     app = Flask(__name__, instance_relative_config=True)
 
     # --- CLOUD DEPLOYMENT HARDWIRING ---
@@ -21,16 +28,45 @@ def create_app():
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../instance/vault.db'
     
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # Engine pool profile: 'serverless' (NullPool) on Vercel, 'server' (tuned QueuePool) elsewhere
+    from .pooling import configure_engine
+    configure_engine(app)
     # -----------------------------------
 
     db.init_app(app)
     login_manager.init_app(app)
     csrf.init_app(app)
-    mail.init_app(app)
-    
-    # Initialize Migrate
-    from .extensions import migrate
-    migrate.init_app(app, db)
+
+    # Flask-Migrate (Alembic + Mako) is registered on first use, except when the flask CLI is
+    # loading the app (a click context is active): init_app is what adds the `flask db` commands.
+    if click.get_current_context(silent=True) is not None:
+        from .schema import init_migrate
+        init_migrate(app)
+
+    # Pre-generated RSA keypairs for registration (see crypto_utils.KeyPairPool)
+    from .crypto_utils import key_pool
+    key_pool.init_app(app)
+
+    # Buffered activity logging (flushed in bulk, see activity_log.py)
+    from .activity_log import activity_log
+    activity_log.init_app(app)
+
+    # SSE activity feed: one shared poller per worker, woken by activity log flushes (see live_feed.py)
+    from .live_feed import live_feed
+    live_feed.init_app(app)
+
+    # Per-request Server-Timing header / [TIMING] log lines (REQUEST_TIMING, off by default)
+    from .instrumentation import request_timing
+    request_timing.init_app(app)
+
+    # Prometheus metrics, merged across workers through METRICS_DIR (see metrics.py)
+    from .metrics import metrics
+    metrics.init_app(app)
+
+    # Statement counting, N+1 detection and @query_budget checks (QUERY_GUARD, off by default)
+    from .query_guard import query_guard
+    query_guard.init_app(app)
 
     # --- EMAIL CONFIGURATION ---
     app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.googlemail.com')
@@ -38,10 +74,16 @@ def create_app():
     app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', 'true').lower() in ['true', 'on', '1']
     app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
     app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
+    app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', 'no-reply@localhost')
+
+    # Background OTP delivery over a pooled SMTP connection (see auth/utils.py)
+    from .auth.utils import mail_queue
+    mail_queue.init_app(app)
     # ---------------------------
     
     login_manager.login_view = 'auth.login'
     login_manager.login_message_category = 'info'
+    config_done = time.perf_counter()
 
     with app.app_context():
         # Register Blueprints
@@ -55,52 +97,8 @@ def create_app():
         app.register_blueprint(companies_bp)
         app.register_blueprint(api_bp)
 
-        # Build tables automatically (ONLY if they don't exist)
         from . import models
-        try:
-            db.create_all()
-        except Exception as e:
-            print(f"Table creation skipped or failed: {e}")
-
-    # --- AUTOMATIC SCHEMA MIGRATION (For Vercel/Production) ---
-    with app.app_context():
-        from sqlalchemy import text
-        try:
-            # Check/Add 'data' column to 'file' table
-            with db.engine.connect() as conn:
-                # 1. Update File table
-                try:
-                    conn.execute(text("ALTER TABLE file ADD COLUMN data BYTEA"))
-                    conn.commit()
-                    print("Added 'data' column to 'file' table.")
-                except Exception as e:
-                    # Column likely exists or table doesn't exist yet (handled by db.create_all)
-                    # For SQLite (local), syntax is different (ADD COLUMN data BLOB)
-                    # But assuming Vercel is Postgres. Handling SQLite fallback just in case.
-                    if "sqlite" in str(app.config['SQLALCHEMY_DATABASE_URI']):
-                         try:
-                             conn.execute(text("ALTER TABLE file ADD COLUMN data BLOB"))
-                             conn.commit()
-                         except:
-                             pass
-                    pass
-
-                # 2. Update Company table
-                try:
-                    conn.execute(text("ALTER TABLE company ADD COLUMN logo_data BYTEA"))
-                    conn.commit()
-                    print("Added 'logo_data' column to 'company' table.")
-                except Exception as e:
-                     if "sqlite" in str(app.config['SQLALCHEMY_DATABASE_URI']):
-                         try:
-                             conn.execute(text("ALTER TABLE company ADD COLUMN logo_data BLOB"))
-                             conn.commit()
-                         except:
-                             pass
-                     pass
-
-        except Exception as e:
-            print(f"Schema migration error (ignored if tables/columns exist): {e}")
+    blueprints_done = time.perf_counter()
 
     # --- FIX FOR READ-ONLY FILE SYSTEM ---
     # We now store files in DB, so UPLOAD_FOLDER is less critical but kept for temp ops if needed
@@ -111,5 +109,52 @@ def create_app():
         if not os.path.exists(app.config['UPLOAD_FOLDER']):
             os.makedirs(app.config['UPLOAD_FOLDER'])
 
+    # Multi-file uploads: encryption threads per request, files per request (see uploads.py)
+    app.config['UPLOAD_WORKERS'] = int(os.environ.get('UPLOAD_WORKERS', min(4, os.cpu_count() or 1)))
+    app.config['UPLOAD_BATCH_MAX_FILES'] = int(os.environ.get('UPLOAD_BATCH_MAX_FILES', 100))
+
+    # ZIP export (see export.py): decrypting threads per export, plaintext chunks buffered per file,
+    # a progress log entry every N files, and 'stored' (fastest) or 'deflated' entries
+    app.config['EXPORT_WORKERS'] = int(os.environ.get('EXPORT_WORKERS', min(4, os.cpu_count() or 1)))
+    app.config['EXPORT_QUEUE_CHUNKS'] = int(os.environ.get('EXPORT_QUEUE_CHUNKS', 4))
+    app.config['EXPORT_PROGRESS_EVERY'] = int(os.environ.get('EXPORT_PROGRESS_EVERY', 25))
+    app.config['EXPORT_ZIP_COMPRESSION'] = os.environ.get('EXPORT_ZIP_COMPRESSION', 'stored')
+
+    # --- BLOB STORAGE ---
+    # 'db' keeps ciphertext in File.data (works on Vercel); 'filesystem' shards it under BLOB_STORAGE_PATH
+    app.config['BLOB_STORAGE'] = os.environ.get('BLOB_STORAGE', 'db')
+    # 'db' writes the ciphertext this many bytes per statement (the most an upload buffers)
+    app.config['BLOB_DB_WRITE_SIZE'] = int(os.environ.get('BLOB_DB_WRITE_SIZE', 8 * 1024 * 1024))
+    app.config['BLOB_STORAGE_PATH'] = os.environ.get(
+        'BLOB_STORAGE_PATH', os.path.join(app.config['UPLOAD_FOLDER'], 'blobs')
+    )
+
+    # --- SCHEMA ---
+    # One query against alembic_version; migrations run from `flask vault migrate` (see schema.py).
+    # After the storage settings above: data migrations may need to find the blobs.
+    from .schema import ensure_schema
+    # Every gunicorn worker runs create_app(), so upgrading here would race; 'check' only reports
+    app.config['SCHEMA_ON_BOOT'] = os.environ.get('SCHEMA_ON_BOOT', 'check')
+    schema_status = ensure_schema(app)
+    db_done = time.perf_counter()
+
+    from .cli import vault_cli
+    app.cli.add_command(vault_cli)
+
+    # --- COLD START REPORT ---
+    finished = time.perf_counter()
+    app.extensions['boot_timings'] = {
+        'import_ms': _import_seconds * 1000,
+        'config_ms': (config_done - boot_started) * 1000,
+        'blueprints_ms': (blueprints_done - config_done) * 1000,
+        'db_ms': (db_done - blueprints_done) * 1000,
+        'total_ms': (_import_seconds + finished - boot_started) * 1000,
+        'schema': schema_status,
+    }
+    if os.environ.get('BOOT_TIMING', '1' if os.environ.get('VERCEL') else '0').lower() in ['true', 'on', '1']:
+        timings = app.extensions['boot_timings']
+        print("[BOOT] " + " ".join(f"{k[:-3]}={v:.1f}ms" for k, v in timings.items() if k.endswith('_ms'))
+              + f" schema={schema_status}")
+
 
     return app
\ No newline at end of file
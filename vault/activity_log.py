@@ -0,0 +1,214 @@
+"""Write-behind buffer for ActivityLog rows.
+
+log_activity() used to commit its own transaction on the request path. Records are now
+queued in memory and written with one bulk INSERT when any of these happens:
+  - the queue reaches ACTIVITY_LOG_FLUSH_SIZE records,
+  - the oldest record is ACTIVITY_LOG_FLUSH_INTERVAL seconds old (background thread, and
+    checked again at request teardown, which runs after the response has been sent),
+  - the worker shuts down.
+Readers (the log page, the logs API, the live feed) don't force a flush: with polling clients
+that would put the INSERT back on the request path. An entry is therefore visible at most
+ACTIVITY_LOG_FLUSH_INTERVAL seconds (plus the INSERT) after it was recorded.
+ACTIVITY_LOG_MODE=sync writes every record immediately (tests, debugging).
+"""
+import atexit
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from vault.company_stats import activity_added
+from vault.extensions import db
+from vault.live_feed import live_feed
+
+# ActivityLog.action is a String(100); Postgres rejects longer values (and with them the whole batch)
+MAX_ACTION_LENGTH = 100
+
+
+def truncate_action(action):
+    if len(action) > MAX_ACTION_LENGTH:
+        action = action[:MAX_ACTION_LENGTH - 1] + '…'
+    return action
+
+
+def _connection_lost(error):
+    # Worth retrying later; any other database error means the rows themselves were rejected
+    return error.connection_invalidated or isinstance(error, OperationalError)
+
+
+class ActivityLogBuffer:
+
+    def __init__(self, app=None):
+        self.app = None
+        self.mode = 'buffered'
+        self.flush_size = 50
+        self.flush_interval = 2.0
+        self.max_queue = 10000
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._local = threading.local()
+        self._oldest = None
+        self._thread = None
+        self._thread_pid = None
+        # Metrics
+        self.flushes = 0
+        self.flushed_records = 0
+        self.failed_flushes = 0
+        self.dropped_records = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.mode = app.config.setdefault('ACTIVITY_LOG_MODE', os.environ.get('ACTIVITY_LOG_MODE', 'buffered'))
+        self.flush_size = int(app.config.setdefault(
+            'ACTIVITY_LOG_FLUSH_SIZE', os.environ.get('ACTIVITY_LOG_FLUSH_SIZE', 50)))
+        # Serverless instances can be frozen between requests, so flush at every teardown there
+        default_interval = 0 if os.environ.get('VERCEL') else 2.0
+        self.flush_interval = float(app.config.setdefault(
+            'ACTIVITY_LOG_FLUSH_INTERVAL', os.environ.get('ACTIVITY_LOG_FLUSH_INTERVAL', default_interval)))
+        app.teardown_appcontext(self._on_teardown)
+        atexit.register(self.flush)
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def record(self, company_id, user_email, action, ip_address=None):
+        """Queue one ActivityLog row (written immediately in sync mode)."""
+        entry = {
+            'company_id': company_id,
+            'user_email': user_email,
+            'action': truncate_action(action),
+            'ip_address': ip_address,
+            'timestamp': datetime.utcnow(),
+        }
+        with self._lock:
+            self._queue.append(entry)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            while len(self._queue) > self.max_queue:
+                self._queue.popleft()
+                self.dropped_records += 1
+            depth = len(self._queue)
+        if self.mode == 'sync' or depth >= self.flush_size:
+            self.flush()
+        else:
+            self._ensure_thread()
+
+    def _due(self):
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.flush_interval
+
+    def _on_teardown(self, exc):
+        # flush() pushes its own app context; don't recurse from that context's teardown
+        if getattr(self._local, 'flushing', False):
+            return
+        if self._queue and self._due():
+            self.flush()
+
+    def flush(self):
+        """Write everything queued so far in one bulk INSERT. Safe to call from any thread."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._queue:
+                    return 0
+                batch = list(self._queue)
+                self._queue.clear()
+                self._oldest = None
+            started = time.perf_counter()
+            self._local.flushing = True
+            written = 0  # rows of batch already committed by the row-by-row fallback
+            try:
+                from vault.models import ActivityLog
+                with self.app.app_context():
+                    # Own connection + transaction: never touches the request's ORM session
+                    try:
+                        with db.engine.begin() as conn:
+                            conn.execute(ActivityLog.__table__.insert(), batch)
+                            activity_added(conn, batch)
+                    except DBAPIError as e:
+                        if _connection_lost(e):
+                            raise
+                        # e.g. the company was deleted meanwhile: keep the good rows, drop the rest
+                        for entry in batch:
+                            self._insert_one(ActivityLog.__table__, entry)
+                            written += 1
+            except Exception as e:
+                self.failed_flushes += 1
+                self.flushed_records += written
+                pending = batch[written:]
+                print(f"[ACTIVITY LOG] Flush of {len(pending)} record(s) failed, will retry: {e}")
+                with self._lock:
+                    self._queue.extendleft(reversed(pending))
+                    if self._oldest is None:
+                        self._oldest = time.monotonic()
+                if written:
+                    live_feed.notify()
+                return written
+            finally:
+                self._local.flushing = False
+            elapsed = time.perf_counter() - started
+            live_feed.notify()
+            self.flushes += 1
+            self.flushed_records += len(batch)
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+            return len(batch)
+
+    def _insert_one(self, table, entry):
+        """Insert one row in its own transaction; a row the database rejects is dropped."""
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.insert(), entry)
+                activity_added(conn, [entry])
+        except DBAPIError as e:
+            if _connection_lost(e):
+                raise
+            self.dropped_records += 1
+            print(f"[ACTIVITY LOG] Dropped record {entry['action']!r}: {e}")
+
+    def _ensure_thread(self):
+        # Started lazily and re-started after a fork (gunicorn --preload)
+        if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='activity-log-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            # Wake when the oldest record comes due, so none waits longer than flush_interval
+            oldest = self._oldest
+            timeout = self.flush_interval if oldest is None else oldest + self.flush_interval - time.monotonic()
+            self._wakeup.wait(max(timeout, 0.05))
+            self._wakeup.clear()
+            if self._queue and self._due():
+                self.flush()
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'queue_depth': self.depth,
+            'flushes': self.flushes,
+            'flushed_records': self.flushed_records,
+            'failed_flushes': self.failed_flushes,
+            'dropped_records': self.dropped_records,
+            'last_flush_seconds': self.last_flush_seconds,
+            'max_flush_seconds': self.max_flush_seconds,
+            'avg_flush_seconds': self.total_flush_seconds / self.flushes if self.flushes else 0.0,
+        }
+
+
+activity_log = ActivityLogBuffer()
@@ -1,23 +1,37 @@
-from flask import jsonify
+import hmac
+
+from flask import Response, abort, jsonify, request, stream_with_context
 from flask_login import login_required, current_user
 from vault.api import api_bp
-from vault.models import ActivityLog, File, Company
+from vault.models import ActivityLog, Company
+from vault.live_feed import live_feed
+from vault.metrics import metrics, CONTENT_TYPE
+from vault.query_guard import query_budget
+from vault import company_stats
+from vault.companies.services import has_permission, has_current_permission, query_activity_logs, parse_log_filters, LOG_PAGE_SIZE
 
 @api_bp.route('/stats/<int:company_id>')
 @login_required
+@query_budget(3)
 def get_company_stats(company_id):
     """Returns JSON stats for the company dashboard."""
-    company = Company.query.get_or_404(company_id)
-    if company.owner_id != current_user.id:
+    # Maintained counters (see vault/company_stats.py): one primary-key select, no COUNT(*).
+    # Activity still buffered in a worker shows up after its next flush (ACTIVITY_LOG_FLUSH_INTERVAL).
+    stats = company_stats.read(company_id)
+    if stats is None:
+        abort(404)
+    company_name, owner_id, counters = stats
+    if owner_id != current_user.id:
         return jsonify({"error": "Unauthorized"}), 403
     
-    file_count = File.query.filter_by(company_id=company_id).count()
-    log_count = ActivityLog.query.filter_by(company_id=company_id).count()
-    
+    last_activity = counters['last_activity_at']
     return jsonify({
-        "company_name": company.name,
-        "total_files": file_count,
-        "total_activities": log_count,
+        "company_name": company_name,
+        "total_files": counters['file_count'],
+        "total_activities": counters['activity_count'],
+        "plaintext_bytes": counters['plaintext_bytes'],
+        "ciphertext_bytes": counters['ciphertext_bytes'],
+        "last_activity": last_activity.isoformat() if last_activity else None,
         "encryption_standard": "AES-256 / RSA-2048"
     })
 
@@ -30,10 +44,26 @@ def health_check():
         "vault_io_standard": "verified"
     })
 
+@api_bp.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape target: totals from every worker process."""
+    # Never public: without a token configured there is nothing to check a scraper against
+    if not metrics.enabled or not metrics.token:
+        abort(404)
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not hmac.compare_digest(supplied.encode(), metrics.token.encode()):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer'})
+    return Response(metrics.render(), content_type=CONTENT_TYPE, headers={'Cache-Control': 'no-store'})
+
 @api_bp.route('/logs/recent/<int:company_id>')
 @login_required
+@query_budget(4)
 def recent_logs(company_id):
-    """Fetches the last 5 logs for real-time display."""
+    """Fetches the last 5 logs (for live updates, prefer the logs/<id>/stream SSE feed).
+
+    Entries still buffered in a worker show up after its next flush (ACTIVITY_LOG_FLUSH_INTERVAL).
+    """
     logs = ActivityLog.query.filter_by(company_id=company_id)\
         .order_by(ActivityLog.timestamp.desc())\
         .limit(5).all()
@@ -42,4 +72,54 @@ def recent_logs(company_id):
         "user": log.user_email,
         "action": log.action,
         "time": log.timestamp.strftime("%H:%M:%S")
-    } for log in logs])
\ No newline at end of file
+    } for log in logs])
+@api_bp.route('/logs/<int:company_id>/stream')
+@login_required
+@query_budget(4)
+def stream_logs(company_id):
+    """Server-Sent Events: entries after ?last_id= / Last-Event-ID, then new ones as they are written."""
+    Company.query.get_or_404(company_id)
+    if not has_permission(current_user, company_id, 'perm_logs'):
+        return jsonify({"error": "Unauthorized"}), 403
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id')
+    try:
+        last_id = int(last_id) if last_id not in (None, '') else None
+    except ValueError:
+        return jsonify({"error": "Invalid last_id"}), 400
+
+    user_id = current_user.id
+    still_allowed = lambda: has_current_permission(user_id, company_id, 'perm_logs')
+    max_seconds = live_feed.stream_seconds(request.environ)
+    body = stream_with_context(live_feed.stream(company_id, last_id, still_allowed, max_seconds))
+    response = Response(body, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx: pass events through as they are written
+    return response
+
+@api_bp.route('/logs/<int:company_id>')
+@login_required
+@query_budget(6)
+def company_logs(company_id):
+    """Keyset-paginated activity log: ?cursor=&limit=&user=&action=&from=&to="""
+    Company.query.get_or_404(company_id)
+    if not has_permission(current_user, company_id, 'perm_logs'):
+        return jsonify({"error": "Unauthorized"}), 403
+
+    cursor = request.args.get('cursor')
+    try:
+        filters = parse_log_filters(request.args)
+        limit = int(request.args.get('limit', LOG_PAGE_SIZE))
+        logs, next_cursor = query_activity_logs(company_id, cursor=cursor, limit=limit, **filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({
+        "logs": [{
+            "id": log.id,
+            "user": log.user_email,
+            "action": log.action,
+            "ip_address": log.ip_address,
+            "timestamp": log.timestamp.isoformat()
+        } for log in logs],
+        "next_cursor": next_cursor
+    })
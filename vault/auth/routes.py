@@ -120,8 +120,9 @@ def register():
                  flash('Email already exists.', 'danger')
                  return render_template('auth/login.html', form=RegistrationForm())
 
-            from vault.crypto_utils import generate_user_keys
-            priv_key, pub_key = generate_user_keys()
+            # Ready-made keypair from the background pool (generated inline if it is empty)
+            from vault.crypto_utils import key_pool
+            priv_key, pub_key = key_pool.take()
             
             hashed_password = generate_password_hash(password)
             new_user = User(
@@ -1,48 +1,221 @@
-from flask_mail import Message
-from vault import mail
 from flask import url_for, current_app
 
+import os
+import queue
 import smtplib
+import threading
+import time
 
-def send_email_sync(app, msg):
-    with app.app_context():
-        smtp_server = app.config.get('MAIL_SERVER')
-        smtp_port = app.config.get('MAIL_PORT')
-        smtp_user = app.config.get('MAIL_USERNAME')
-        smtp_password = app.config.get('MAIL_PASSWORD')
-        
+# Flask-Mail and the email.mime builders are imported on the first OTP, not at worker boot
+
+
+def _build_mime(msg):
+    """Construct email from Flask-Mail Message object"""
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
+    email_msg = MIMEMultipart()
+    email_msg['From'] = msg.sender
+    email_msg['To'] = ", ".join(msg.recipients)
+    email_msg['Subject'] = msg.subject
+    email_msg.attach(MIMEText(msg.body, 'plain'))
+    return email_msg
+
+
+class PooledSMTPConnection:
+    """One persistent SMTP connection reused across sends (STARTTLS + login happen once).
+
+    MAIL_USE_TLS=false and an unset MAIL_USERNAME skip STARTTLS and login, which is how
+    tests/test_mail_delivery.py talks to its local SMTP server (and how to try it by hand:
+    `python -m aiosmtpd -n -l localhost:1025` with MAIL_SERVER=localhost MAIL_PORT=1025).
+    """
+
+    def __init__(self):
+        self._smtp = None
+        self._lock = threading.Lock()
+        self.connects = 0
+
+    def _connect(self, config):
+        print(f"\n[DEBUG] Connecting to SMTP: {config.get('MAIL_SERVER')}:{config.get('MAIL_PORT')} as {config.get('MAIL_USERNAME')}...")
+        server = smtplib.SMTP(config.get('MAIL_SERVER'), config.get('MAIL_PORT'), timeout=config['MAIL_TIMEOUT'])
+        server.set_debuglevel(0) # Set to 1 for verbose output if needed
+        if config.get('MAIL_USE_TLS'):
+            server.starttls()
+        if config.get('MAIL_USERNAME'):
+            server.login(config.get('MAIL_USERNAME'), config.get('MAIL_PASSWORD'))
+        self.connects += 1
+        return server
+
+    def _alive(self):
         try:
-            print(f"\n[DEBUG] Connecting to SMTP: {smtp_server}:{smtp_port} as {smtp_user}...")
-            
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.set_debuglevel(0) # Set to 1 for verbose output if needed
-                server.starttls()
-                server.login(smtp_user, smtp_password)
-                
-                # Construct email from Flask-Mail Message object
-                from email.mime.text import MIMEText
-                from email.mime.multipart import MIMEMultipart
-                
-                email_msg = MIMEMultipart()
-                email_msg['From'] = msg.sender
-                email_msg['To'] = ", ".join(msg.recipients)
-                email_msg['Subject'] = msg.subject
-                email_msg.attach(MIMEText(msg.body, 'plain'))
-                
-                server.send_message(email_msg)
-                print("[DEBUG] Email sent successfully via smtplib!")
-
-        except (smtplib.SMTPException, ConnectionRefusedError, OSError) as e:
-            print(f"\n[EMAIL ERROR] Could not send email: {e}")
-            print(f"[TIP] Check your .env file. MAIL_USERNAME and MAIL_PASSWORD must be correct.")
-            print(f"[TIP] Ensure 'Less secure apps' or 'App Passwords' are enabled for Gmail.\n")
-        except Exception as e:
-             print(f"\n[EMAIL ERROR] Unexpected error sending email: {e}\n")
+            return self._smtp is not None and self._smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send(self, config, email_msg):
+        with self._lock:
+            if not self._alive():
+                self._close()
+                self._smtp = self._connect(config)
+            try:
+                self._smtp.send_message(email_msg)
+            except smtplib.SMTPResponseException:
+                # The server answered (e.g. 451): the connection is still good for the next attempt
+                raise
+            except (smtplib.SMTPServerDisconnected, OSError):
+                # Stale connection: the next attempt reconnects
+                self._close()
+                raise
+
+    def _close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class MailDeliveryQueue:
+    """Bounded queue drained by a background worker that sends over the pooled connection.
+
+    MAIL_DELIVERY=sync sends inside the request instead (the default on Vercel, where a
+    frozen instance would never run the worker). A full queue also falls back to sync.
+    Only the worker retries (MAIL_MAX_RETRIES, with backoff): a send on the request thread
+    makes one attempt, so an SMTP outage costs a login at most one MAIL_TIMEOUT.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.connection = PooledSMTPConnection()
+        self._queue = None
+        self._thread = None
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        # Metrics
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rejected = 0
+        self.total_send_seconds = 0.0
+        self.max_send_seconds = 0.0
+        self.total_delivery_seconds = 0.0
+        self.max_delivery_seconds = 0.0
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('MAIL_DELIVERY', os.environ.get('MAIL_DELIVERY', 'sync' if os.environ.get('VERCEL') else 'queue'))
+        app.config.setdefault('MAIL_QUEUE_SIZE', int(os.environ.get('MAIL_QUEUE_SIZE', 100)))
+        app.config.setdefault('MAIL_MAX_RETRIES', int(os.environ.get('MAIL_MAX_RETRIES', 3)))
+        app.config.setdefault('MAIL_RETRY_BACKOFF', float(os.environ.get('MAIL_RETRY_BACKOFF', 1.0)))
+        app.config.setdefault('MAIL_TIMEOUT', float(os.environ.get('MAIL_TIMEOUT', 10)))
+        app.config.setdefault('MAIL_IDLE_TIMEOUT', float(os.environ.get('MAIL_IDLE_TIMEOUT', 60)))
+        self._queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def deliver(self, msg):
+        """Send now (sync mode) or hand off to the worker; returns immediately in queue mode."""
+        email_msg = _build_mime(msg)
+        if self.app.config['MAIL_DELIVERY'] != 'queue':
+            return self._send(email_msg, time.monotonic(), attempts=1)
+        try:
+            self._queue.put_nowait((email_msg, time.monotonic()))
+        except queue.Full:
+            self.rejected += 1
+            print("[EMAIL] Delivery queue full, sending inline.")
+            return self._send(email_msg, time.monotonic(), attempts=1)
+        self._ensure_worker()
+        return True
+
+    def _send(self, email_msg, enqueued_at, attempts):
+        config = self.app.config
+        for attempt in range(attempts):
+            started = time.monotonic()
+            try:
+                self.connection.send(config, email_msg)
+            except (smtplib.SMTPException, ConnectionRefusedError, OSError) as e:
+                if attempt + 1 < attempts:
+                    self.retries += 1
+                    delay = config['MAIL_RETRY_BACKOFF'] * (2 ** attempt)
+                    print(f"[EMAIL ERROR] Send failed ({e}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                self.failed += 1
+                print(f"\n[EMAIL ERROR] Could not send email: {e}")
+                print(f"[TIP] Check your .env file. MAIL_USERNAME and MAIL_PASSWORD must be correct.")
+                print(f"[TIP] Ensure 'Less secure apps' or 'App Passwords' are enabled for Gmail.\n")
+                return False
+            finished = time.monotonic()
+            self.sent += 1
+            self.total_send_seconds += finished - started
+            self.max_send_seconds = max(self.max_send_seconds, finished - started)
+            self.total_delivery_seconds += finished - enqueued_at
+            self.max_delivery_seconds = max(self.max_delivery_seconds, finished - enqueued_at)
+            print("[DEBUG] Email sent successfully via smtplib!")
+            return True
+
+    def _ensure_worker(self):
+        # Started lazily and re-started after a fork (gunicorn --preload)
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='mail-delivery', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                email_msg, enqueued_at = self._queue.get(timeout=self.app.config['MAIL_IDLE_TIMEOUT'])
+            except queue.Empty:
+                # Don't hold an idle connection the server will drop anyway
+                self.connection.close()
+                continue
+            try:
+                self._send(email_msg, enqueued_at, attempts=self.app.config['MAIL_MAX_RETRIES'] + 1)
+            except Exception as e:
+                self.failed += 1
+                print(f"\n[EMAIL ERROR] Unexpected error sending email: {e}\n")
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Block until every queued message has been attempted (tests, shutdown)."""
+        if self._queue is not None:
+            self._queue.join()
+
+    def stats(self):
+        return {
+            'mode': self.app.config['MAIL_DELIVERY'] if self.app else None,
+            'queue_depth': self.depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'connects': self.connection.connects,
+            'avg_send_seconds': self.total_send_seconds / self.sent if self.sent else 0.0,
+            'max_send_seconds': self.max_send_seconds,
+            'avg_delivery_seconds': self.total_delivery_seconds / self.sent if self.sent else 0.0,
+            'max_delivery_seconds': self.max_delivery_seconds,
+        }
+
+
+mail_queue = MailDeliveryQueue()
+
 
 def send_otp_email(user):
+    from flask_mail import Message
+
     otp = user.otp_code
     msg = Message('Login OTP - Secure Startup Vault',
-                  sender=current_app.config['MAIL_USERNAME'],
+                  sender=current_app.config['MAIL_USERNAME'] or current_app.config['MAIL_DEFAULT_SENDER'],
                   recipients=[user.email])
     msg.body = f'''To log in to your Secure Startup Vault account, use the following One-Time Password (OTP):
 
@@ -51,8 +224,8 @@ def send_otp_email(user):
 This OTP is valid for 10 minutes.
 If you did not request this, please ignore this email.
 '''
-    # Send synchronously (blocking) to ensure delivery in serverless environments
+    # Queued for the background worker (or sent inline with MAIL_DELIVERY=sync, e.g. on Vercel)
     try:
-        send_email_sync(current_app._get_current_object(), msg)
+        mail_queue.deliver(msg)
     except Exception as e:
         print(f"FAILED to send OTP email: {e}")
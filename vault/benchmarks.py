@@ -0,0 +1,416 @@
+"""Offline benchmarks for the crypto and request hot paths.
+
+    python -m vault.benchmarks [--quick] [--only crypto.] [--save-baseline]
+    flask vault bench [same options]
+
+Everything runs in this process against a throwaway SQLite database and the Flask test
+client: no network, no DATABASE_URL, and outgoing mail is captured instead of sent.
+Each benchmark reports p50/p99 latency, throughput and the peak Python allocation of one
+extra traced iteration (tracemalloc is off while timing). Results are compared with
+benchmarks/baseline.json; a p50 or peak-memory increase beyond --tolerance is reported as
+a regression (exit status 1 with --fail-on-regression). Baselines are machine-specific:
+regenerate with --save-baseline on the machine that does the comparing.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BASELINE_PATH = os.path.join(PROJECT_ROOT, 'benchmarks', 'baseline.json')
+# What the suite's app is booted with (before vault is imported)
+BENCH_ENV = {
+    'SCHEMA_ON_BOOT': 'migrate',
+    'KEY_POOL_SIZE': '0',
+    'ACTIVITY_LOG_MODE': 'sync',
+    'MAIL_DELIVERY': 'sync',
+    'BOOT_TIMING': '0',
+    'DB_POOL_PROFILE': 'default',
+    'BLOB_STORAGE': 'db',
+    # Every page load also checks its @query_budget; an N+1 fails the run
+    'QUERY_GUARD': 'raise',
+    # The baseline includes the per-request recording cost
+    'METRICS': 'on',
+}
+PASSWORD = 'bench-password'
+KB = 1024
+MB = 1024 * KB
+# Changes smaller than these are noise, whatever the ratio
+TIME_NOISE_MS = 0.25
+MEMORY_NOISE_BYTES = 256 * KB
+
+_BENCHMARKS = []
+
+
+def benchmark(name, repeat, quick_repeat=None, size=None):
+    """Register fn(env) -> callable: the setup runs once, the returned callable is timed."""
+    def register(fn):
+        _BENCHMARKS.append({'name': name, 'setup': fn, 'repeat': repeat,
+                            'quick_repeat': quick_repeat or max(1, repeat // 5), 'size': size})
+        return fn
+    return register
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _measure(spec, env, quick):
+    run = spec['setup'](env)
+    run()  # warm-up: imports, key cache, SQLite page cache
+    samples = []
+    for _ in range(spec['quick_repeat'] if quick else spec['repeat']):
+        started = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    mean = sum(samples) / len(samples)
+    result = {
+        'runs': len(samples),
+        'p50_ms': _percentile(samples, 50) * 1000,
+        'p99_ms': _percentile(samples, 99) * 1000,
+        'ops_per_s': 1 / mean if mean else None,
+        'peak_kib': peak / KB,
+    }
+    if spec['size']:
+        result['mb_per_s'] = spec['size'] / MB / mean if mean else None
+    return result
+
+
+# --- Fixtures ---
+
+class BenchEnv:
+    """The app, a seeded database and a few handles the benchmarks share."""
+
+    def __init__(self, app, n_files, n_logs):
+        from werkzeug.security import generate_password_hash
+
+        from vault.activity_log import activity_log
+        from vault.auth.utils import mail_queue
+        from vault.crypto_utils import FileEncryptor, generate_user_keys, iter_chunks
+        from vault.extensions import db
+        from vault.models import ActivityLog, Company, File, Role, User, memberships
+        from vault.storage import put_new_blobs
+
+        self.app = app
+        self.n_files, self.n_logs = n_files, n_logs
+        self.sent_mail = []
+        # Offline: keep the OTP message instead of connecting to MAIL_SERVER
+        mail_queue.deliver = self.sent_mail.append
+
+        private_pem, public_pem = generate_user_keys()
+        self.private_pem, self.public_pem = private_pem, public_pem
+
+        def encrypted(data, name, user_id, company_id=None):
+            encryptor = FileEncryptor(public_pem, user_id=user_id)
+            chunks = [encryptor.update(chunk) for chunk in iter_chunks(data)] + [encryptor.finalize()]
+            return File(filename=name, encrypted_name=os.urandom(16).hex(), encrypted_aes_key=encryptor.encrypted_aes_key,
+                        iv=encryptor.iv, size=len(data), user_id=user_id, company_id=company_id), chunks
+
+        with app.app_context():
+            user = User(email='bench@example.com', password=generate_password_hash(PASSWORD),
+                        rsa_private_key=private_pem, rsa_public_key=public_pem)
+            db.session.add(user)
+            db.session.flush()
+            company = Company(name='Bench Co', password='bench', owner_id=user.id)
+            db.session.add(company)
+            db.session.flush()
+            role = Role(name='Admin', company_id=company.id, perm_admin=True, perm_view=True, perm_upload=True,
+                        perm_download=True, perm_logs=True, perm_modify=True)
+            db.session.add(role)
+            db.session.flush()
+            db.session.execute(memberships.insert().values(user_id=user.id, company_id=company.id, role_id=role.id))
+            # Company roster: n_files members, every other one without a role
+            db.session.bulk_insert_mappings(User, [
+                {'email': f"member-{i}@example.com", 'password': user.password,
+                 'rsa_private_key': private_pem, 'rsa_public_key': public_pem}
+                for i in range(n_files)
+            ])
+            member_ids = db.session.execute(
+                db.select(User.id).where(User.email.like('member-%')).order_by(User.id)).scalars().all()
+            db.session.execute(memberships.insert(), [
+                {'user_id': member_id, 'company_id': company.id, 'role_id': role.id if i % 2 else None}
+                for i, member_id in enumerate(member_ids)
+            ])
+
+            items = [encrypted(os.urandom(KB), f"doc-{i}.pdf", user.id) for i in range(n_files)]
+            items += [encrypted(os.urandom(KB), f"shared-{i}.pdf", user.id, company.id) for i in range(n_files)]
+            download = encrypted(os.urandom(MB), 'download.pdf', user.id)
+            put_new_blobs(items + [download])
+
+            started = time.time()
+            db.session.bulk_insert_mappings(ActivityLog, [
+                {'company_id': company.id, 'user_email': user.email, 'action': f"Downloaded file: doc-{i}.pdf",
+                 'ip_address': '127.0.0.1', 'timestamp': _utc(started - i)}
+                for i in range(n_logs)
+            ])
+            db.session.commit()
+            self.user_id, self.company_id, self.download_id = user.id, company.id, download[0].id
+        activity_log.flush()
+
+    def client(self):
+        """Test client already past login + OTP."""
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(self.user_id)
+            session['_fresh'] = True
+        return client
+
+
+def _utc(timestamp):
+    return datetime.utcfromtimestamp(timestamp)
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Swallow the app's debug prints while timing."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def _get(client, url, expect=200):
+    with _quiet():
+        response = client.get(url)
+        data = response.get_data()
+    if response.status_code != expect:
+        raise RuntimeError(f"GET {url} returned {response.status_code}, expected {expect}")
+    return data
+
+
+# --- Crypto ---
+
+@benchmark('crypto.generate_user_keys', repeat=30, quick_repeat=5)
+def bench_keygen(env):
+    from vault.crypto_utils import generate_user_keys
+    return generate_user_keys
+
+
+def _encrypt_bench(size):
+    def setup(env):
+        from vault.crypto_utils import encrypt_file_data
+        data = os.urandom(size)
+        # Parsed keys are cached by PEM digest, so this is a warm worker: RSA wrap + AES, no PEM parsing
+        return lambda: encrypt_file_data(data, env.public_pem)
+    return setup
+
+
+def _decrypt_bench(size):
+    def setup(env):
+        from vault.crypto_utils import decrypt_file_data, encrypt_file_data
+        encrypted_data, encrypted_aes_key, iv = encrypt_file_data(os.urandom(size), env.public_pem)
+        return lambda: decrypt_file_data(encrypted_data, encrypted_aes_key, iv, env.private_pem)
+    return setup
+
+
+for _label, _size, _repeat in (('1kb', KB, 300), ('64kb', 64 * KB, 200), ('1mb', MB, 60), ('16mb', 16 * MB, 8)):
+    benchmark(f"crypto.encrypt_file_data.{_label}", repeat=_repeat, size=_size)(_encrypt_bench(_size))
+    benchmark(f"crypto.decrypt_file_data.{_label}", repeat=_repeat, size=_size)(_decrypt_bench(_size))
+
+
+# --- Request flows ---
+
+@benchmark('flow.login_to_download.1mb', repeat=10, quick_repeat=3, size=MB)
+def bench_login_to_download(env):
+    from vault.extensions import db
+    from vault.models import User
+
+    def run():
+        client = env.app.test_client()
+        with _quiet():
+            response = client.post('/login', data={'email': 'bench@example.com', 'password': PASSWORD})
+            if response.status_code != 302:
+                raise RuntimeError(f"login returned {response.status_code}")
+            with env.app.app_context():
+                otp = db.session.get(User, env.user_id).otp_code
+            response = client.post('/verify-otp', data={'otp': otp})
+            if response.status_code != 302:
+                raise RuntimeError(f"verify-otp returned {response.status_code}")
+        _get(client, f"/download/{env.download_id}")
+    return run
+
+
+@benchmark('page.dashboard', repeat=30)
+def bench_dashboard(env):
+    client = env.client()
+    return lambda: _get(client, '/dashboard')
+
+
+@benchmark('page.company_files', repeat=30)
+def bench_company_files(env):
+    client = env.client()
+    return lambda: _get(client, f"/companies/{env.company_id}/files")
+
+
+@benchmark('page.company_users', repeat=30)
+def bench_company_users(env):
+    client = env.client()
+    return lambda: _get(client, f"/companies/{env.company_id}/users")
+
+
+@benchmark('page.company_logs.first', repeat=30)
+def bench_logs_first_page(env):
+    client = env.client()
+    return lambda: _get(client, f"/companies/{env.company_id}/logs")
+
+
+@benchmark('page.company_logs.deep', repeat=30)
+def bench_logs_deep_page(env):
+    from vault.companies.services import LOG_PAGE_SIZE, query_activity_logs
+
+    # Cursor for a page near the end of the log, as reached by clicking "Older" repeatedly
+    with env.app.app_context():
+        cursor = None
+        for _ in range(max(1, env.n_logs // LOG_PAGE_SIZE - 1)):
+            _, cursor = query_activity_logs(env.company_id, cursor=cursor)
+    client = env.client()
+    return lambda: _get(client, f"/companies/{env.company_id}/logs?cursor={cursor}")
+
+
+@benchmark('api.logs', repeat=30)
+def bench_api_logs(env):
+    client = env.client()
+    return lambda: _get(client, f"/api/v1/logs/{env.company_id}")
+
+
+# --- Runner ---
+
+def create_bench_app(workdir):
+    # Fixed, not defaults: a local .env must not change what the baseline measured
+    os.environ.update(BENCH_ENV)
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['BLOB_STORAGE_PATH'] = os.path.join(workdir, 'blobs')
+    # Keep the metrics snapshots away from a running server's directory
+    os.environ['METRICS_DIR'] = os.path.join(workdir, 'metrics')
+    from vault import create_app
+
+    with _quiet():
+        app = create_app()
+    # The test client posts forms without tokens
+    app.config['WTF_CSRF_ENABLED'] = False
+    # Let QueryBudgetExceeded reach the benchmark instead of becoming a 500
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    return app
+
+
+def run_benchmarks(only=None, quick=False, n_files=200, n_logs=10000, progress=print):
+    """{name: result} for every registered benchmark whose name starts with one of only."""
+    specs = [spec for spec in _BENCHMARKS if not only or any(spec['name'].startswith(prefix) for prefix in only)]
+    with tempfile.TemporaryDirectory(prefix='vault-bench-') as workdir:
+        app = create_bench_app(workdir)
+        env = BenchEnv(app, n_files, n_logs)
+        results = {}
+        for spec in specs:
+            progress(f"  {spec['name']} ...")
+            results[spec['name']] = _measure(spec, env, quick)
+        with app.app_context():
+            from vault.extensions import db
+            db.engine.dispose()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """[(name, metric, baseline value, current value, ratio)] for every regression."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        slower = result['p50_ms'] - before['p50_ms']
+        if slower > TIME_NOISE_MS and result['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+            regressions.append((name, 'p50_ms', before['p50_ms'], result['p50_ms'], result['p50_ms'] / before['p50_ms']))
+        grown = (result['peak_kib'] - before['peak_kib']) * KB
+        if grown > MEMORY_NOISE_BYTES and result['peak_kib'] > before['peak_kib'] * (1 + tolerance):
+            regressions.append((name, 'peak_kib', before['peak_kib'], result['peak_kib'],
+                                result['peak_kib'] / before['peak_kib'] if before['peak_kib'] else float('inf')))
+    return regressions
+
+
+def format_report(results, baseline):
+    lines = [f"{'benchmark':<34} {'p50 ms':>10} {'p99 ms':>10} {'ops/s':>10} {'MB/s':>9} {'peak KiB':>10} {'vs base':>8}"]
+    for name, r in results.items():
+        before = baseline.get(name)
+        delta = f"{(r['p50_ms'] / before['p50_ms'] - 1) * 100:+.0f}%" if before and before['p50_ms'] else 'new'
+        mb_per_s = f"{r['mb_per_s']:.1f}" if r.get('mb_per_s') else '-'
+        lines.append(f"{name:<34} {r['p50_ms']:>10.3f} {r['p99_ms']:>10.3f} {r['ops_per_s']:>10.1f} "
+                     f"{mb_per_s:>9} {r['peak_kib']:>10.1f} {delta:>8}")
+    return '\n'.join(lines)
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('results', {})
+
+
+def save_baseline(path, results, args):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    payload = {
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'processor': platform.processor() or platform.machine(), 'cpus': os.cpu_count()},
+        'settings': {'quick': args.quick, 'files': args.files, 'logs': args.logs},
+        'results': {name: {k: round(v, 4) if isinstance(v, float) else v for k, v in r.items()}
+                    for name, r in results.items()},
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m vault.benchmarks', description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true', help='Fewer iterations (a smoke run, not for baselines).')
+    parser.add_argument('--only', action='append', metavar='PREFIX', help='Run benchmarks whose name starts with PREFIX.')
+    parser.add_argument('--files', type=int, default=200, help='Rows per listing (personal files, company files, company members).')
+    parser.add_argument('--logs', type=int, default=10000, help='Activity log entries in the company.')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline JSON to compare against.')
+    parser.add_argument('--save-baseline', action='store_true', help='Write these results to --baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='Allowed slowdown / memory growth (0.3 = 30%%).')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 on any regression.')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results as JSON.')
+    args = parser.parse_args(argv)
+
+    print(f"Running benchmarks ({'quick' if args.quick else 'full'}, {args.files} files, {args.logs} log entries)")
+    results = run_benchmarks(args.only, args.quick, args.files, args.logs)
+    baseline = load_baseline(args.baseline)
+    print()
+    print(format_report(results, baseline))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        save_baseline(args.baseline, results, args)
+        print(f"\nBaseline written to {os.path.relpath(args.baseline)}")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if not baseline:
+        print(f"\nNo baseline at {os.path.relpath(args.baseline)}; run with --save-baseline to create one.")
+    elif regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+        for name, metric, before, after, ratio in regressions:
+            print(f"  {name}: {metric} {before:.3f} -> {after:.3f} ({ratio:.2f}x)")
+    else:
+        print(f"\nNo regressions beyond {args.tolerance:.0%} against the baseline.")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
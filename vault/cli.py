@@ -0,0 +1,339 @@
+"""`flask vault ...` maintenance commands."""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import click
+from flask.cli import AppGroup
+
+from vault.extensions import db
+
+vault_cli = AppGroup('vault', help='Secure Vault maintenance commands.')
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# What a worker runs at boot, with the DB check and key pool thread turned off
+BOOT_SNIPPET = 'from vault import create_app; create_app()'
+BOOT_ENV = {'SCHEMA_ON_BOOT': 'off', 'KEY_POOL_SIZE': '0', 'BOOT_TIMING': '0'}
+# Deferred to first use; importing any of these during boot is a regression
+DEFERRED_AT_BOOT = ('cryptography', 'flask_mail', 'flask_migrate', 'alembic', 'mako', 'email.mime')
+# Recorded by `flask vault import-time --save-baseline`; like the benchmark baselines, machine-specific
+IMPORT_TIME_BASELINE_PATH = os.path.join(PROJECT_ROOT, 'benchmarks', 'import_time.json')
+# Run-to-run spread of the median on one machine; smaller increases are never reported
+IMPORT_TIME_NOISE_MS = 20
+
+
+@vault_cli.command('migrate')
+@click.option('--check', is_flag=True, help='Only report the schema status (exit 1 if not current).')
+def migrate(check):
+    """Bring the database schema to the newest migration (run once per deploy)."""
+    from vault.schema import head_revision, schema_status, upgrade_schema
+
+    status, revision = schema_status()
+    click.echo(f"Database: {revision or 'no revision'} ({status}), migrations head: {head_revision()}")
+    if check:
+        if status != 'current':
+            raise click.ClickException('Schema is not current; run `flask vault migrate`.')
+        return
+    click.echo(upgrade_schema())
+
+
+@vault_cli.command('boot-report')
+def boot_report():
+    """Show how long this process spent importing, configuring and checking the DB at boot."""
+    from flask import current_app
+
+    timings = current_app.extensions.get('boot_timings', {})
+    for key, value in timings.items():
+        label = key[:-3] if key.endswith('_ms') else key
+        click.echo(f"  {label:<11} {value:>8.1f} ms" if key.endswith('_ms') else f"  {label:<11} {value:>8}")
+
+
+@vault_cli.command('move-blobs')
+@click.option('--to', 'target', type=click.Choice(['db', 'filesystem']), required=True,
+              help='Backend to move encrypted file contents into.')
+@click.option('--batch-size', default=50, show_default=True, help='Rows committed per batch.')
+def move_blobs(target, batch_size):
+    """Move existing encrypted blobs between storage backends."""
+    from vault.models import File
+    from vault.storage import move_blob
+
+    moved = 0
+    last_id = 0
+    while True:
+        # Keyset over ids; File.data is deferred so only the metadata columns are selected here
+        batch = File.query.filter(File.id > last_id)\
+            .filter(db.or_(File.storage != target, File.storage.is_(None)))\
+            .order_by(File.id).limit(batch_size).all()
+        if not batch:
+            break
+        pending_deletes = []
+        for file_record in batch:
+            last_id = file_record.id
+            try:
+                source = move_blob(file_record, target)
+            except FileNotFoundError:
+                click.echo(f"  skipped file {file_record.id}: blob missing from {file_record.storage}")
+                continue
+            if source is not None:
+                pending_deletes.append((source, file_record.encrypted_name))
+                moved += 1
+        db.session.commit()
+        # Only drop the old copies once the rows point at the new backend
+        for source, name in pending_deletes:
+            source.delete(name)
+        click.echo(f"  moved {moved} file(s) so far")
+
+    click.echo(f"Done: {moved} file(s) now stored in '{target}'.")
+
+
+@vault_cli.command('logo-variants')
+def logo_variants():
+    """Rebuild the pre-sized copies of every uploaded company logo (needs Pillow)."""
+    from vault.logos import logo_digest, set_logo
+    from vault.models import Company
+
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        raise click.ClickException('Pillow is not installed; logos are served at their original size.')
+
+    rebuilt = 0
+    for company in Company.query.filter(Company.logo.like('logos/%')).order_by(Company.id).all():
+        if logo_digest(company.logo) is None or not company.logo_data:
+            click.echo(f"  skipped company {company.id}: no content-addressed logo (run `flask vault migrate`)")
+            continue
+        set_logo(company, company.logo_data)
+        db.session.commit()
+        rebuilt += 1
+    click.echo(f"Done: rebuilt variants for {rebuilt} logo(s).")
+
+
+@vault_cli.command('reconcile-stats')
+@click.option('--company', 'company_id', type=int, help='Only this company (default: all).')
+@click.option('--dry-run', is_flag=True, help='Report drift without fixing it.')
+def reconcile_stats(company_id, dry_run):
+    """Recompute the per-company counters behind /api/v1/stats from the file and log tables."""
+    from vault.activity_log import activity_log
+    from vault.company_stats import reconcile
+
+    activity_log.flush()
+    drifted = reconcile(company_id)
+    for cid, old, new in drifted:
+        if old is None:
+            click.echo(f"  company {cid}: no counters row; created {new}")
+            continue
+        changes = ', '.join(f"{key} {old[key]} -> {new[key]}" for key in new if old[key] != new[key])
+        click.echo(f"  company {cid}: {changes}")
+    if dry_run:
+        db.session.rollback()
+        click.echo(f"Dry run: {len(drifted)} company(ies) drifted; nothing written.")
+        return
+    db.session.commit()
+    click.echo(f"Done: fixed {len(drifted)} company(ies).")
+
+
+@vault_cli.command('reset-metrics')
+def reset_metrics():
+    """Clear METRICS_DIR; run once before the workers start (e.g. gunicorn's on_starting hook)."""
+    from vault.metrics import metrics
+
+    if not metrics.enabled:
+        raise click.ClickException('Metrics are disabled (METRICS=off).')
+    removed = metrics.reset()
+    click.echo(f"Removed {removed} snapshot(s) from {metrics.directory}.")
+
+
+def _hot_queries():
+    """(label, statement) for the queries every page load depends on, with placeholder ids."""
+    from vault.companies.services import permissions_statement, user_companies_statement
+    from vault.models import ActivityLog, File, Role, User, memberships
+
+    return [
+        ('permission check', permissions_statement(1, 1)),
+        ('sidebar company list', user_companies_statement(1)),
+        ('company member list', db.select(User.id, User.email, Role.name).select_from(memberships)
+            .join(User, User.id == memberships.c.user_id).outerjoin(Role, Role.id == memberships.c.role_id)
+            .where(memberships.c.company_id == 1).order_by(User.email)),
+        ('company file list', db.select(File.id, File.filename, File.upload_date)
+            .where(File.company_id == 1).order_by(File.upload_date.desc())),
+        ('personal file list', db.select(File.id, File.filename)
+            .where(File.user_id == 1, File.company_id.is_(None))),
+        ('blob lookup', db.select(File.id).where(File.encrypted_name == 'x')),
+        ('activity log page', db.select(ActivityLog.id)
+            .where(ActivityLog.company_id == 1)
+            .order_by(ActivityLog.timestamp.desc(), ActivityLog.id.desc()).limit(50)),
+    ]
+
+
+def _full_scans(dialect, plan_lines):
+    """Tables read with a sequential scan according to an EXPLAIN plan."""
+    scans = []
+    for line in plan_lines:
+        if dialect == 'sqlite':
+            # "SCAN file" is a table scan; "SCAN t USING [COVERING] INDEX" and "SEARCH" are fine
+            words = line.split()
+            if len(words) >= 2 and words[0] == 'SCAN' and 'INDEX' not in words:
+                scans.append(words[1])
+        elif 'Seq Scan on ' in line:
+            scans.append(line.split('Seq Scan on ', 1)[1].split()[0])
+    # Scans of derived tables (UNION results, CTEs) are not index candidates
+    return [table for table in scans if table in db.metadata.tables]
+
+
+@vault_cli.command('explain')
+@click.option('--verbose', '-v', is_flag=True, help='Print the full plan of every query.')
+def explain(verbose):
+    """Check with EXPLAIN that the hot queries are served by indexes (exit 1 on a table scan)."""
+    dialect = db.engine.dialect.name
+    if dialect not in ('sqlite', 'postgresql'):
+        raise click.ClickException(f"EXPLAIN check not supported on {dialect}")
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+
+    failures = 0
+    with db.engine.begin() as conn:
+        if dialect == 'postgresql':
+            # Small tables make any plan cheap; this asks whether an index *can* serve each query
+            conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        for label, statement in _hot_queries():
+            sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+            rows = conn.exec_driver_sql(prefix + sql).all()
+            plan = [row[-1] for row in rows]
+            scans = _full_scans(dialect, plan)
+            status = 'FAIL' if scans else 'ok'
+            failures += bool(scans)
+            click.echo(f"[{status:>4}] {label}" + (f" (table scan on {', '.join(scans)})" if scans else ''))
+            if verbose or scans:
+                for line in plan:
+                    click.echo(f"         {line}")
+
+    if failures:
+        raise click.ClickException(f"{failures} query plan(s) fall back to a table scan; run `flask db upgrade`.")
+    click.echo('All hot queries use an index.')
+
+
+def parse_importtime(output):
+    """[(depth, self_us, cumulative_us, module)] from `python -X importtime` stderr."""
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, int(self_us), int(cumulative_us), name.strip()))
+    return entries
+
+
+def _importtime_run(code):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=PROJECT_ROOT, env=dict(os.environ, **BOOT_ENV),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=False
+    )
+    entries = parse_importtime(result.stderr)
+    if result.returncode != 0:
+        raise click.ClickException(f"Boot failed:\n{result.stderr[-2000:]}")
+    return entries
+
+
+def _machine():
+    import platform
+
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(), 'cpus': os.cpu_count()}
+
+
+def load_import_time_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_import_time_baseline(path, median, runs, entries):
+    payload = {
+        'machine': _machine(),
+        'median_ms': round(median, 1),
+        'runs': runs,
+        'imports': {name: round(cumulative / 1000, 1) for depth, _, cumulative, name in entries if depth == 0},
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+@vault_cli.command('import-time')
+@click.option('--baseline', 'baseline_path', default=IMPORT_TIME_BASELINE_PATH, show_default=True,
+              help='Recorded median to compare against.')
+@click.option('--save-baseline', is_flag=True, help='Record this median as the baseline (after an intended change).')
+@click.option('--tolerance', default=0.2, show_default=True, type=float, envvar='IMPORT_TIME_TOLERANCE',
+              help='Allowed growth over the baseline median (0.2 = 20%).')
+@click.option('--budget-ms', default=None, type=float, envvar='IMPORT_TIME_BUDGET_MS',
+              help='Also fail when the median exceeds this many ms (e.g. a cold-start limit in CI).')
+@click.option('--runs', default=5, show_default=True, help='Fresh interpreters to measure (median is reported).')
+@click.option('--top', default=10, show_default=True, help='Heaviest imports to list.')
+def import_time(baseline_path, save_baseline, tolerance, budget_ms, runs, top):
+    """Measure create_app() import time with `python -X importtime` and compare it with the baseline.
+
+    The check is relative: boot imports may grow by --tolerance (and IMPORT_TIME_NOISE_MS) over
+    the median recorded on this machine, since absolute times depend on the machine.
+    """
+    # Interpreter startup (site, encodings, ...) is the same for every app, so leave it out
+    startup = {name for depth, _, _, name in _importtime_run('pass') if depth == 0}
+
+    totals, samples, deferred = [], [], set()
+    for _ in range(runs):
+        entries = [e for e in _importtime_run(BOOT_SNIPPET) if not (e[0] == 0 and e[3] in startup)]
+        totals.append(sum(cumulative for depth, _, cumulative, _ in entries if depth == 0) / 1000)
+        samples.append(entries)
+        deferred.update(name for _, _, _, name in entries
+                        if any(name == m or name.startswith(m + '.') for m in DEFERRED_AT_BOOT))
+
+    median = statistics.median(totals)
+    entries = samples[totals.index(min(totals, key=lambda t: abs(t - median)))]
+    baseline = None if save_baseline else load_import_time_baseline(baseline_path)
+    limit = max(baseline['median_ms'] * (1 + tolerance), baseline['median_ms'] + IMPORT_TIME_NOISE_MS) if baseline else None
+    click.echo(f"Boot imports: median {median:.1f} ms, min {min(totals):.1f} ms, max {max(totals):.1f} ms "
+               f"over {runs} run(s)")
+    if baseline:
+        click.echo(f"Baseline: {baseline['median_ms']:.1f} ms ({median / baseline['median_ms'] - 1:+.0%}), "
+                   f"limit {limit:.1f} ms")
+        if baseline.get('machine') != _machine():
+            click.echo("Warning: the baseline was recorded on another machine or Python; "
+                       "re-record it here with --save-baseline.")
+    click.echo("Heaviest imports (cumulative, median run):")
+    for depth, _, cumulative, name in sorted((e for e in entries if e[0] <= 2), key=lambda e: -e[2])[:top]:
+        click.echo(f"  {cumulative / 1000:8.1f} ms  {'  ' * depth}{name}")
+
+    failures = []
+    if deferred:
+        failures.append(f"deferred modules imported at boot: {', '.join(sorted(deferred)[:10])}")
+    if limit and median > limit:
+        failures.append(f"median {median:.1f} ms is over the baseline's {baseline['median_ms']:.1f} ms "
+                        f"+ {tolerance:.0%} ({limit:.1f} ms)")
+    if budget_ms is not None and median > budget_ms:
+        failures.append(f"median {median:.1f} ms is over the {budget_ms:.0f} ms budget")
+    if failures:
+        raise click.ClickException('; '.join(failures))
+    if save_baseline:
+        save_import_time_baseline(baseline_path, median, runs, entries)
+        click.echo(f"Baseline written to {os.path.relpath(baseline_path)}")
+    elif baseline is None and budget_ms is None:
+        click.echo(f"No baseline at {os.path.relpath(baseline_path)}; run with --save-baseline to record one.")
+    else:
+        click.echo('Within budget.')
+
+
+@vault_cli.command('bench', context_settings={'ignore_unknown_options': True, 'help_option_names': []})
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+def bench(args):
+    """Run the offline benchmark suite (options: `flask vault bench --help`).
+
+    Runs in a fresh interpreter against a throwaway SQLite database, so it never touches
+    the configured DATABASE_URL.
+    """
+    env = {key: value for key, value in os.environ.items() if key != 'DATABASE_URL'}
+    result = subprocess.run([sys.executable, '-m', 'vault.benchmarks', *args], cwd=PROJECT_ROOT, env=env)
+    sys.exit(result.returncode)
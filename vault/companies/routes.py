@@ -1,28 +1,32 @@
-from flask import render_template, redirect, url_for, flash, current_app, send_file, request, send_from_directory
+from flask import render_template, redirect, url_for, flash, current_app, send_file, request, send_from_directory, jsonify, abort
 from flask_login import login_required, current_user
 from vault import db
-from vault.models import Company, Role, ActivityLog, File, User, memberships
+from vault.models import Company, CompanyStats, Role, ActivityLog, File, User, LogoVariant, memberships
 from vault.companies import companies_bp
 from vault.companies.forms import CompanyForm, RoleForm, AddUserForm
-from vault.main.forms import UploadFileForm
-from vault.crypto_utils import encrypt_file_data, decrypt_file_data
-from vault.companies.services import log_activity, has_permission
+from vault.main.forms import ALLOWED_EXTENSIONS, UploadFileForm
+from vault.crypto_utils import FileEncryptor
+from vault.companies.services import (log_activity, has_permission, invalidate_permissions, list_user_companies,
+                                     invalidate_user_companies, query_activity_logs, parse_log_filters, ACTION_TYPES)
+from vault.storage import put_new_blob, discard_blob
+from vault.uploads import store_uploads, upload_summary, upload_log_action
+from vault.activity_log import activity_log
+from vault.streaming import encrypted_file_response
+from vault.query_guard import query_budget
+from vault.export import export_zip_response
+from vault.logos import (LOGO_VARIANT_SIZES, DEFAULT_LOGO, logo_digest, logo_url, sniff_mimetype, set_logo,
+                         clear_logo)
 from werkzeug.utils import secure_filename
 from flask_wtf.csrf import generate_csrf
 from sqlalchemy import select, insert, update, delete
+from sqlalchemy.orm import Load
 import os
 import uuid
 import io
 
 def get_user_companies():
     """Helper function to get all companies the current user has access to"""
-    from sqlalchemy import select
-    owned_companies = Company.query.filter_by(owner_id=current_user.id).all()
-    member_companies_query = db.session.execute(
-        select(Company).join(memberships, Company.id == memberships.c.company_id).where(memberships.c.user_id == current_user.id)
-    ).all()
-    member_companies = [row[0] for row in member_companies_query]
-    return list(set(owned_companies + member_companies))
+    return list_user_companies(current_user.id)
 
 @companies_bp.route('/new', methods=['GET', 'POST'])
 @login_required
@@ -59,7 +63,10 @@ def create_company():
             perm_add_users=True
         )
         db.session.add(admin_role)
+        db.session.add(CompanyStats(company_id=new_company.id))
         db.session.commit()
+        invalidate_permissions(new_company.id)
+        invalidate_user_companies(current_user.id)
         
         flash(f'Company {new_company.name} created successfully!', 'success')
         return redirect(url_for('main.dashboard'))
@@ -98,14 +105,17 @@ def company_settings(company_id):
         company.password = form.password.data
         
         if form.logo.data:
-            logo_file = form.logo.data
-            raw_name = secure_filename(logo_file.filename)
-            logo_filename = f"{uuid.uuid4().hex}_{raw_name}"
-            # Store in DB
-            company.logo = os.path.join('logos', logo_filename) # Keep relative path for consistency if needed, or just filename
-            company.logo_data = logo_file.read() # Store binary
+            # Stored in the DB under a content-addressed name, with pre-sized variants
+            try:
+                set_logo(company, form.logo.data.read())
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e), "danger")
+                return redirect(url_for('companies.company_settings', company_id=company_id))
             
         db.session.commit()
+        # The name shows in every member's sidebar
+        invalidate_user_companies()
         from vault.companies.services import log_activity
         log_activity(company_id, current_user.email, "Updated company settings")
         flash("Company settings updated successfully!", "success")
@@ -128,16 +138,26 @@ def delete_company(company_id):
         flash("Incorrect password. Company deletion aborted.", "danger")
         return redirect(url_for('companies.company_settings', company_id=company_id))
 
+    # Write out buffered log entries before the company's logs are removed
+    activity_log.flush()
+    
     # Delete associated memberships first
     from sqlalchemy import delete
     db.session.execute(delete(memberships).where(memberships.c.company_id == company_id))
     
     # Delete associated files, roles, logs, etc.
+    blobs = File.query.with_entities(File.storage, File.encrypted_name).filter_by(company_id=company_id).all()
     File.query.filter_by(company_id=company_id).delete()
     Role.query.filter_by(company_id=company_id).delete()
     ActivityLog.query.filter_by(company_id=company_id).delete()
+    LogoVariant.query.filter_by(company_id=company_id).delete()
+    CompanyStats.query.filter_by(company_id=company_id).delete()
     db.session.delete(company)
     db.session.commit()
+    invalidate_permissions(company_id)
+    invalidate_user_companies()
+    for storage, encrypted_name in blobs:
+        discard_blob(storage, encrypted_name)
     flash("Company deleted successfully.", "success")
     return redirect(url_for('main.dashboard'))
 
@@ -165,10 +185,10 @@ def remove_logo(company_id):
         return redirect(url_for('companies.company_settings', company_id=company_id))
     
     if company.logo and company.logo != 'logo.svg':
-        # Just clear the DB fields
-        company.logo = 'logo.svg'
-        company.logo_data = None
+        clear_logo(company)
         db.session.commit()
+        # The sidebar shows company logos
+        invalidate_user_companies()
         log_activity(company_id, current_user.email, "Removed company logo")
         flash("Logo removed successfully.", "success")
     else:
@@ -178,21 +198,16 @@ def remove_logo(company_id):
 
 @companies_bp.route('/<int:company_id>/files')
 @login_required
+@query_budget(6)
 def company_files(company_id):
     company = Company.query.get_or_404(company_id)
     if not has_permission(current_user, company_id, 'perm_view'):
         flash("Access Denied", "danger")
         return redirect(url_for('main.dashboard'))
     
+    # File.data is deferred, so listing never pulls the encrypted blobs
     files = File.query.filter_by(company_id=company_id).all()
     
-    # Calculate file sizes
-    for file in files:
-        if file.data:
-            file.size = len(file.data)
-        else:
-            file.size = 0
-    
     form = UploadFileForm()  # ← Added missing form initialization
     can_manage_roles = has_permission(current_user, company_id, 'perm_manage_roles')
     can_view_logs = has_permission(current_user, company_id, 'perm_logs')
@@ -213,33 +228,24 @@ def upload_company_file(company_id):
         # Defensive: validate extension server-side
         _, ext = os.path.splitext(original_filename)
         ext = ext.lower().lstrip('.')
-        allowed = {'pdf', 'txt', 'docx', 'png', 'jpg', 'jpeg'}
-        if ext not in allowed:
+        if ext not in ALLOWED_EXTENSIONS:
             flash('File type not allowed. Allowed: PDF, TXT, DOCX, PNG, JPG', 'danger')
             return redirect(url_for('companies.company_files', company_id=company_id))
 
-        # Encrypt
-        file_content = file_storage.read()
-        encrypted_data, encrypted_aes_key, iv = encrypt_file_data(file_content, current_user.rsa_public_key)
-        
-        # Save to DB
-        unique_name = str(uuid.uuid4())
-        # file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_name)
-        
-        # with open(file_path, 'wb') as f:
-        #     f.write(encrypted_data)
+        # Encrypt straight from the upload stream
+        encryptor = FileEncryptor(current_user.rsa_public_key, user_id=current_user.id)
         
-        # DB
+        # Save metadata + encrypted blob (DB column or sharded disk, see vault/storage.py)
         new_file = File(
             filename=original_filename,
-            encrypted_name=unique_name,
-            data=encrypted_data, # Store file content
+            encrypted_name=str(uuid.uuid4()),
             user_id=current_user.id,
             company_id=company_id,
-            encrypted_aes_key=encrypted_aes_key,
-            iv=iv
+            encrypted_aes_key=encryptor.encrypted_aes_key,
+            iv=encryptor.iv
         )
-        db.session.add(new_file)
+        put_new_blob(new_file, encryptor.iter_encrypt(file_storage.stream))
+        new_file.size = encryptor.plaintext_size
         db.session.commit()
         
         log_activity(company_id, current_user.email, f"Uploaded file: {original_filename}")
@@ -250,6 +256,26 @@ def upload_company_file(company_id):
             flash(str(form.file.errors[0]), 'danger')
     return redirect(url_for('companies.company_files', company_id=company_id))
 
+@companies_bp.route('/<int:company_id>/upload/batch', methods=['POST'])
+@login_required
+def upload_company_files_batch(company_id):
+    """Encrypt several files into the company at once: one transaction, one activity log entry."""
+    Company.query.get_or_404(company_id)
+    if not has_permission(current_user, company_id, 'perm_upload'):
+        return jsonify({"error": "Access Denied"}), 403
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({"error": "No files uploaded."}), 400
+    if len(files) > current_app.config['UPLOAD_BATCH_MAX_FILES']:
+        return jsonify({"error": f"At most {current_app.config['UPLOAD_BATCH_MAX_FILES']} files per upload."}), 400
+
+    results, stored = store_uploads(files, current_user, company_id)
+    if stored:
+        db.session.commit()
+        log_activity(company_id, current_user.email, upload_log_action(stored))
+    payload, status = upload_summary(results)
+    return jsonify(payload), status
+
 @companies_bp.route('/<int:company_id>/download/<int:file_id>')
 @login_required
 def download_company_file(company_id, file_id):
@@ -264,35 +290,50 @@ def download_company_file(company_id, file_id):
             flash("File not found in this company.", "danger")
             return redirect(url_for('companies.company_files', company_id=company_id))
         
-        # Read encrypted data from DB
-        encrypted_data = file_record.data
-        if not encrypted_data:
-             flash("File content not found.", "danger")
-             return redirect(url_for('companies.company_files', company_id=company_id))
-        
-        # Decrypt
-        decrypted_data = decrypt_file_data(
-            encrypted_data, 
-            file_record.encrypted_aes_key, 
-            file_record.iv, 
-            current_user.rsa_private_key
-        )
-        
-        log_activity(company_id, current_user.email, f"Downloaded file: {file_record.filename}")
-        
-        # Create a BytesIO object fresh for this request
-        file_stream = io.BytesIO(decrypted_data)
-        
-        return send_file(
-            file_stream,
-            download_name=file_record.filename,
+        # Decrypt chunk by chunk straight from the storage backend (honours Range)
+        response = encrypted_file_response(
+            file_record,
+            current_user.rsa_private_key,
+            user_id=current_user.id,
             as_attachment=True,
             mimetype='application/octet-stream'
         )
+        
+        # Log once per download (a 304 still hands the user the file, from their cache), not for
+        # every follow-up Range request a viewer makes while seeking
+        if response.status_code in (200, 304) or response.headers.get('Content-Range', '').startswith('bytes 0-'):
+            log_activity(company_id, current_user.email, f"Downloaded file: {file_record.filename}")
+        return response
     except Exception as e:
         flash(f"Error downloading file: {str(e)}", "danger")
         return redirect(url_for('companies.company_files', company_id=company_id))
 
+@companies_bp.route('/<int:company_id>/export')
+@login_required
+def export_company_files(company_id):
+    """Stream a ZIP of the company's files: all of them, or the ones in ?ids=1&ids=2 (or ids=1,2)."""
+    company = Company.query.get_or_404(company_id)
+    if not has_permission(current_user, company_id, 'perm_download'):
+        flash("Access Denied", "danger")
+        return redirect(url_for('companies.company_files', company_id=company_id))
+
+    try:
+        ids = {int(part) for value in request.args.getlist('ids') for part in value.split(',') if part.strip()}
+    except ValueError:
+        flash("Invalid file selection.", "danger")
+        return redirect(url_for('companies.company_files', company_id=company_id))
+
+    query = File.query.filter_by(company_id=company_id)
+    if ids:
+        query = query.filter(File.id.in_(ids))
+    files = query.order_by(File.upload_date, File.id).all()
+    if not files:
+        flash("No files to export.", "warning")
+        return redirect(url_for('companies.company_files', company_id=company_id))
+
+    return export_zip_response(company, files, current_user.rsa_private_key, current_user.id,
+                               current_user.email, ip_address=request.remote_addr)
+
 @companies_bp.route('/<int:company_id>/delete/<int:file_id>', methods=['POST'])
 @login_required
 def delete_company_file(company_id, file_id):
@@ -308,12 +349,14 @@ def delete_company_file(company_id, file_id):
     
     db.session.delete(file_to_delete)
     db.session.commit()
+    discard_blob(file_to_delete.storage, file_to_delete.encrypted_name)
     log_activity(company_id, current_user.email, f"Deleted file: {file_to_delete.filename}")
     flash("File removed from company vault.", "success")
     return redirect(url_for('companies.company_files', company_id=company_id))
 
 @companies_bp.route('/<int:company_id>/roles', methods=['GET', 'POST'])
 @login_required
+@query_budget(6)
 def company_roles(company_id):
     company = Company.query.get_or_404(company_id)
     if not has_permission(current_user, company_id, 'perm_manage_roles'):
@@ -375,6 +418,7 @@ def edit_role_config(company_id, role_id):
         role.perm_manage_roles = form.perm_manage_roles.data
         role.perm_add_users = form.perm_add_users.data
         db.session.commit()
+        invalidate_permissions(company_id)
         flash("Role updated!", "success")
         return redirect(url_for('companies.company_roles', company_id=company_id))
     
@@ -423,39 +467,56 @@ def delete_role(company_id, role_id):
     role_name = role.name
     db.session.delete(role)
     db.session.commit()
+    invalidate_permissions(company_id)
     log_activity(company_id, current_user.email, f"Deleted role: {role_name}")
     flash("Role deleted successfully.", "success")
     return redirect(url_for('companies.company_roles', company_id=company_id))
 
 @companies_bp.route('/<int:company_id>/logs')
 @login_required
+@query_budget(6)
 def company_logs(company_id):
     company = Company.query.get_or_404(company_id)
     if not has_permission(current_user, company_id, 'perm_logs'):
         flash("You don't have permission to view activity logs.", "danger")
         return redirect(url_for('companies.company_files', company_id=company_id))
-    logs = ActivityLog.query.filter_by(company_id=company_id).order_by(ActivityLog.timestamp.desc()).all()
-    return render_template('companies/company_logs.html', company=company, logs=logs, companies=get_user_companies())
+    try:
+        filters = parse_log_filters(request.args)
+    except ValueError as e:
+        flash(str(e), "warning")
+        filters = parse_log_filters({})
+    cursor = request.args.get('cursor')
+    # Entries still buffered show up within ACTIVITY_LOG_FLUSH_INTERVAL, through the live feed
+    try:
+        logs, next_cursor = query_activity_logs(company_id, cursor=cursor, **filters)
+    except ValueError:
+        return redirect(url_for('companies.company_logs', company_id=company_id))
+    # Filter values echoed back into the form and the pagination links
+    filter_args = {k: v for k, v in request.args.items() if k in ('user', 'action', 'from', 'to') and v}
+    return render_template('companies/company_logs.html', company=company, logs=logs, companies=get_user_companies(),
+                           next_cursor=next_cursor, filter_args=filter_args, action_types=ACTION_TYPES,
+                           is_first_page=not cursor)
 
 @companies_bp.route('/<int:company_id>/users')
 @login_required
+@query_budget(6)
 def company_users(company_id):
     company = Company.query.get_or_404(company_id)
     if not has_permission(current_user, company_id, 'perm_view'):
         flash("Access Denied", "danger")
         return redirect(url_for('main.dashboard'))
     
-    # Fetch members
-    members = []
-    memberships_query = db.session.execute(select(memberships).where(memberships.c.company_id == company_id)).all()
-    for membership in memberships_query:
-        user = User.query.get(membership.user_id)
-        role = Role.query.get(membership.role_id) if membership.role_id else None
-        members.append({
-            'user': user,
-            'role': role,
-            'is_owner': user.id == company.owner_id
-        })
+    # Members with their roles in one joined select; only the columns the roster shows are loaded
+    rows = db.session.execute(
+        select(User, Role)
+        .select_from(memberships)
+        .join(User, User.id == memberships.c.user_id)
+        .outerjoin(Role, Role.id == memberships.c.role_id)
+        .where(memberships.c.company_id == company_id)
+        .options(Load(User).load_only(User.id, User.email), Load(Role).load_only(Role.id, Role.name))
+        .order_by(User.email)
+    ).all()
+    members = [{'user': user, 'role': role, 'is_owner': user.id == company.owner_id} for user, role in rows]
     
     can_remove_user = has_permission(current_user, company_id, 'perm_remove_user')
     can_add_users = has_permission(current_user, company_id, 'perm_add_users')
@@ -491,6 +552,8 @@ def add_company_user(company_id):
         from sqlalchemy import insert
         db.session.execute(insert(memberships).values(user_id=user.id, company_id=company_id, role_id=None))
         db.session.commit()
+        invalidate_permissions(company_id, user.id)
+        invalidate_user_companies(user.id)
         
         log_activity(company_id, current_user.email, f"Added user: {email}")
         flash("User added to company.", "success")
@@ -500,18 +563,24 @@ def add_company_user(company_id):
 
 @companies_bp.route('/<int:company_id>/edit_user_role/<int:user_id>', methods=['GET', 'POST'])
 @login_required
+@query_budget(6)
 def edit_user_role(company_id, user_id):
     company = Company.query.get_or_404(company_id)
     if not has_permission(current_user, company_id, 'perm_manage_roles'):
         flash("You don't have permission to manage roles.", "danger")
         return redirect(url_for('companies.company_users', company_id=company_id))
     
-    user = User.query.get_or_404(user_id)
-    
-    # Check if user is in company
-    from sqlalchemy import select
-    membership = db.session.execute(select(memberships).where(memberships.c.user_id == user_id, memberships.c.company_id == company_id)).first()
-    if not membership:
+    # The user and their membership (if any) in one query
+    from sqlalchemy import and_, select
+    row = db.session.execute(
+        select(User, memberships.c.company_id, memberships.c.role_id)
+        .outerjoin(memberships, and_(memberships.c.user_id == User.id, memberships.c.company_id == company_id))
+        .where(User.id == user_id)
+    ).first()
+    if row is None:
+        abort(404)
+    user, member_of, current_role_id = row
+    if member_of is None:
         flash("User not in company.", "danger")
         return redirect(url_for('companies.company_users', company_id=company_id))
     
@@ -528,14 +597,14 @@ def edit_user_role(company_id, user_id):
         from sqlalchemy import update
         db.session.execute(update(memberships).where(memberships.c.user_id == user_id, memberships.c.company_id == company_id).values(role_id=new_role_id))
         db.session.commit()
+        invalidate_permissions(company_id, user_id)
         
         log_activity(company_id, current_user.email, f"Changed role for user: {user.email}")
         flash("User role updated.", "success")
         return redirect(url_for('companies.company_users', company_id=company_id))
     
-    # Get current role
-    current_role_id = membership[2]  # role_id is the third column
-    current_role = Role.query.get(current_role_id) if current_role_id else None
+    # Current role, from the list the select is built from
+    current_role = next((role for role in roles if role.id == current_role_id), None)
     
     return render_template('companies/edit_user_role.html', company=company, user=user, roles=roles, current_role=current_role, csrf_token=generate_csrf(), companies=get_user_companies())
 
@@ -562,25 +631,64 @@ def remove_user(company_id, user_id):
     # Remove from memberships
     db.session.execute(memberships.delete().where(memberships.c.user_id == user_id, memberships.c.company_id == company_id))
     db.session.commit()
+    invalidate_permissions(company_id, user_id)
+    invalidate_user_companies(user_id)
     
     log_activity(company_id, current_user.email, f"Removed user: {user.email}")
     flash("User removed from company.", "success")
     return redirect(url_for('companies.company_users', company_id=company_id))
 
 
-@companies_bp.route('/logo/<path:filename>')
-def serve_logo(filename):
-    """Serve uploaded logo files from the database."""
-    # Try to find company with this logo
-    company = Company.query.filter(Company.logo.like(f"%{filename}%")).first()
-    
-    if company and company.logo_data:
-        return send_file(
-            io.BytesIO(company.logo_data),
-            mimetype='image/png', # Assuming PNG/JPG, browser handles it well usually
-            as_attachment=False,
-            download_name=filename
-        )
-            
-    # Fallback to static default
-    return redirect(url_for('static', filename='img/logo.svg'))
\ No newline at end of file
+# Sidebar and header <img> URLs
+companies_bp.add_app_template_global(logo_url)
+
+def _logo_response(data, mimetype, etag):
+    response = current_app.response_class(data, mimetype=mimetype or 'application/octet-stream')
+    response.set_etag(etag)
+    # The URL embeds the content digest, so it can be cached forever
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if mimetype == 'image/svg+xml':
+        # Uploaded SVGs are served from our origin: no scripts or external loads
+        response.headers['Content-Security-Policy'] = "default-src 'none'; style-src 'unsafe-inline'; sandbox"
+    return response
+
+def _send_logo(company_id, digest, size=None):
+    """Serve a logo by company id (primary key) and content digest.
+
+    The 304 check runs before any image bytes are loaded; only the digest-bearing
+    Company.logo column (and the variant's mimetype) are read for it.
+    """
+    logo = db.session.query(Company.logo).filter(Company.id == company_id).scalar()
+    current = logo_digest(logo)
+    if current is None:
+        return redirect(url_for('static', filename=f"img/{DEFAULT_LOGO}"))
+    if current != digest:
+        # Replaced since the page was rendered; not cached, unlike the digest URLs
+        response = redirect(url_for(request.endpoint, **dict(request.view_args, digest=current)))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    variant = LogoVariant.query.get((company_id, size)) if size is not None else None
+    etag = f"{digest}-{size}" if variant else digest
+    if etag in request.if_none_match:
+        response = _logo_response(None, variant.mimetype if variant else None, etag)
+        response.status_code = 304
+        return response
+
+    if variant:
+        return _logo_response(variant.data, variant.mimetype, etag)
+    data = db.session.query(Company.logo_data).filter(Company.id == company_id).scalar()
+    return _logo_response(data, sniff_mimetype(data or b''), etag)
+
+@companies_bp.route('/logo/<int:company_id>/<digest>')
+def serve_logo(company_id, digest):
+    """Original uploaded logo."""
+    return _send_logo(company_id, digest)
+
+@companies_bp.route('/logo/<int:company_id>/<digest>/<int:size>')
+def serve_logo_variant(company_id, digest, size):
+    """Logo sized for a size px box (the original when no smaller copy was built)."""
+    if size not in LOGO_VARIANT_SIZES:
+        abort(404)
+    return _send_logo(company_id, digest, size)
\ No newline at end of file
@@ -1,28 +1,182 @@
+import base64
+import binascii
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
 from vault.models import Role, ActivityLog, Company, memberships
 from vault import db
-from flask import request
+from vault.cache import TTLCache
+from vault.activity_log import activity_log
+from flask import request, g, has_app_context
+from sqlalchemy import select, and_, or_, union
+
+# Every boolean permission column on Role
+PERMISSIONS = (
+    'perm_admin', 'perm_view', 'perm_modify', 'perm_upload', 'perm_download',
+    'perm_logs', 'perm_remove_user', 'perm_manage_roles', 'perm_add_users',
+)
+
+# Optional cross-request cache of resolved permission matrices, keyed (user_id, company_id).
+# Off by default: invalidation only reaches the worker that made the change, so with several
+# gunicorn workers a revoked permission can survive for up to PERMISSION_CACHE_TTL seconds.
+permission_cache = TTLCache(
+    maxsize=int(os.environ.get('PERMISSION_CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('PERMISSION_CACHE_TTL', 0))
+)
+
+# Per-user sidebar company list. Per-worker like the permission cache, but only cosmetic if stale
+# (every company page still checks permissions), so it is on by default.
+company_list_cache = TTLCache(
+    maxsize=int(os.environ.get('COMPANY_LIST_CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('COMPANY_LIST_CACHE_TTL', 60))
+)
+
+# Plain rows rather than ORM objects, so cached entries never outlive their session
+CompanySummary = namedtuple('CompanySummary', ['id', 'name', 'logo', 'owner_id'])
 
 def log_activity(company_id, user_email, action):
-    new_log = ActivityLog(
-        company_id=company_id,
-        user_email=user_email,
-        action=action,
-        ip_address=request.remote_addr
-    )
-    db.session.add(new_log)
-    db.session.commit()
+    # Buffered and bulk-inserted off the request path, see vault/activity_log.py
+    activity_log.record(company_id, user_email, action, ip_address=request.remote_addr)
 
-def has_permission(user, company_id, permission_attr):
+def permissions_statement(user_id, company_id):
+    """Owner flag + role permissions for one user in one company, as a single joined select."""
+    role_columns = [getattr(Role, perm) for perm in PERMISSIONS]
+    return select(Company.owner_id, *role_columns)\
+        .select_from(Company)\
+        .outerjoin(memberships, and_(memberships.c.company_id == Company.id, memberships.c.user_id == user_id))\
+        .outerjoin(Role, Role.id == memberships.c.role_id)\
+        .where(Company.id == company_id)
+
+def _load_permissions(user_id, company_id):
+    row = db.session.execute(permissions_statement(user_id, company_id)).first()
+    if row is None:
+        return {perm: False for perm in PERMISSIONS}
     # Owners always have full permission
-    company = Company.query.get(company_id)
-    if company.owner_id == user.id:
-        return True
-    
-    # Check user's role in this company
-    from sqlalchemy import select
-    membership = db.session.execute(select(memberships).where(memberships.c.user_id == user.id, memberships.c.company_id == company_id)).first()
-    if membership and membership[2]:  # role_id is not None
-        role = Role.query.get(membership[2])
-        if role and getattr(role, permission_attr, False):
-            return True
-    return False
\ No newline at end of file
+    if row[0] == user_id:
+        return {perm: True for perm in PERMISSIONS}
+    return {perm: bool(value) for perm, value in zip(PERMISSIONS, row[1:])}
+
+def get_permissions(user, company_id):
+    """Permission matrix {perm_*: bool} for user in company, memoized on flask.g for the request."""
+    key = (user.id, int(company_id))
+    request_cache = g.setdefault('_permission_cache', {})
+    if key not in request_cache:
+        request_cache[key] = permission_cache.get_or_set(key, lambda: _load_permissions(*key))
+    return request_cache[key]
+
+def has_permission(user, company_id, permission_attr):
+    return get_permissions(user, company_id).get(permission_attr, False)
+
+def has_current_permission(user_id, company_id, permission_attr):
+    """has_permission() for long-lived responses (SSE): skips the per-request memo on flask.g, so a
+    revoked role is seen once permission_cache drops it (at once in this worker, within its TTL elsewhere)."""
+    key = (int(user_id), int(company_id))
+    return permission_cache.get_or_set(key, lambda: _load_permissions(*key)).get(permission_attr, False)
+
+def invalidate_permissions(company_id, user_id=None):
+    """Forget resolved permissions for a whole company, or for one member of it."""
+    def matches(key):
+        return key[1] == int(company_id) and (user_id is None or key[0] == int(user_id))
+    permission_cache.invalidate(matches)
+    if has_app_context() and '_permission_cache' in g:
+        for key in [k for k in g._permission_cache if matches(k)]:
+            del g._permission_cache[key]
+
+def user_companies_statement(user_id):
+    """Companies owned by or shared with user_id: a UNION of both id sets, without blob columns."""
+    accessible = union(
+        select(Company.id).where(Company.owner_id == user_id),
+        select(memberships.c.company_id).where(memberships.c.user_id == user_id)
+    )
+    return select(Company.id, Company.name, Company.logo, Company.owner_id)\
+        .where(Company.id.in_(select(accessible.subquery())))\
+        .order_by(Company.name, Company.id)
+
+def _load_user_companies(user_id):
+    rows = db.session.execute(user_companies_statement(user_id)).all()
+    return [CompanySummary(*row) for row in rows]
+
+def list_user_companies(user_id):
+    """Companies a user owns or belongs to: one UNION query (no blob columns), cached per user."""
+    return company_list_cache.get_or_set(int(user_id), lambda: _load_user_companies(user_id))
+
+def invalidate_user_companies(user_id=None):
+    """Forget one user's company list, or everyone's (renamed/deleted companies)."""
+    if user_id is None:
+        company_list_cache.invalidate(lambda key: True)
+    else:
+        company_list_cache.invalidate(lambda key: key == int(user_id))
+
+# Activity log viewer filters: action type -> prefix of ActivityLog.action written by log_activity()
+ACTION_TYPES = {
+    'upload': 'Uploaded file',
+    'download': 'Downloaded file',
+    'delete': 'Deleted file',
+    'settings': 'Updated company settings',
+    'logo': 'Removed company logo',
+    'add_user': 'Added user',
+    'change_role': 'Changed role for user',
+    'remove_user': 'Removed user',
+    'delete_role': 'Deleted role',
+}
+LOG_PAGE_SIZE = 50
+MAX_LOG_PAGE_SIZE = 200
+
+def encode_log_cursor(log):
+    """Opaque cursor for the page after log: its (timestamp, id) sort key."""
+    raw = f"{log.timestamp.isoformat()}|{log.id}"
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+def decode_log_cursor(cursor):
+    """(timestamp, id) from encode_log_cursor(); raises ValueError on anything malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        timestamp, log_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(log_id)
+    except (TypeError, UnicodeDecodeError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+def parse_log_filters(args):
+    """Validated filters from a query string (user, action, from, to as YYYY-MM-DD)."""
+    filters = {
+        'user_email': (args.get('user') or '').strip() or None,
+        'action_type': args.get('action') if args.get('action') in ACTION_TYPES else None,
+        'start': None,
+        'end': None,
+    }
+    for arg, key in (('from', 'start'), ('to', 'end')):
+        if args.get(arg):
+            try:
+                filters[key] = datetime.strptime(args[arg], '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f"Invalid date for '{arg}', expected YYYY-MM-DD")
+    return filters
+
+def query_activity_logs(company_id, cursor=None, limit=LOG_PAGE_SIZE,
+                        user_email=None, action_type=None, start=None, end=None):
+    """One page of a company's activity log, newest first, using keyset pagination.
+
+    Walks ix_activity_log_company_timestamp_id from the cursor instead of OFFSET, so every
+    page costs the same however deep it is. Returns (logs, next_cursor); next_cursor is None
+    on the last page. end is a date and inclusive.
+    """
+    limit = max(1, min(int(limit), MAX_LOG_PAGE_SIZE))
+    query = ActivityLog.query.filter(ActivityLog.company_id == company_id)
+    if user_email:
+        query = query.filter(ActivityLog.user_email == user_email)
+    if action_type:
+        query = query.filter(ActivityLog.action.startswith(ACTION_TYPES[action_type], autoescape=True))
+    if start:
+        query = query.filter(ActivityLog.timestamp >= start)
+    if end:
+        query = query.filter(ActivityLog.timestamp < end + timedelta(days=1))
+    if cursor:
+        timestamp, log_id = decode_log_cursor(cursor)
+        query = query.filter(or_(
+            ActivityLog.timestamp < timestamp,
+            and_(ActivityLog.timestamp == timestamp, ActivityLog.id < log_id)
+        ))
+    # One extra row tells us whether another page exists without a COUNT(*)
+    logs = query.order_by(ActivityLog.timestamp.desc(), ActivityLog.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_log_cursor(logs[limit - 1]) if len(logs) > limit else None
+    return logs[:limit], next_cursor
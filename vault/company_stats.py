@@ -0,0 +1,184 @@
+"""Per-company counters behind GET /api/v1/stats/<id>.
+
+CompanyStats holds file count, plaintext and ciphertext bytes, activity count and last activity
+time for each company. It is updated in the transaction that changes the underlying rows:
+  - File inserts, deletes and size changes, by a session after_flush hook (every upload and
+    delete path, on the request's transaction),
+  - activity_log flushes, on the flush's own connection, next to the bulk INSERT.
+Updates are relative (count = count + n), so concurrent workers never lose each other's changes.
+A missing row is rebuilt from the tables in the same transaction. `flask vault reconcile-stats`
+recomputes every row, after manual SQL or if the counters are ever suspected to have drifted.
+"""
+from sqlalchemy import case, event, func, or_, select
+from sqlalchemy.orm import Session, attributes
+
+from vault.extensions import db
+
+
+def _table():
+    from vault.models import CompanyStats
+    return CompanyStats.__table__
+
+
+def computed_values(conn, company_id):
+    """Counter values for company_id, computed from the file and activity_log tables."""
+    from vault.models import ActivityLog, File
+
+    files = conn.execute(
+        select(func.count(File.id), func.coalesce(func.sum(File.size), 0),
+               func.coalesce(func.sum(File.encrypted_size), 0))
+        .where(File.company_id == company_id)
+    ).one()
+    activity = conn.execute(
+        select(func.count(ActivityLog.id), func.max(ActivityLog.timestamp))
+        .where(ActivityLog.company_id == company_id)
+    ).one()
+    return {
+        'file_count': files[0],
+        'plaintext_bytes': files[1],
+        'ciphertext_bytes': files[2],
+        'activity_count': activity[0],
+        'last_activity_at': activity[1],
+    }
+
+
+def apply(conn, company_id, files=0, plaintext_bytes=0, ciphertext_bytes=0, activities=0, last_activity_at=None):
+    """Add deltas to company_id's counters inside conn's transaction.
+
+    Call after the file/log rows themselves have been written on the same transaction: if the
+    company has no counters row yet, one is computed from the tables (which then already
+    include this change) instead of applying the deltas.
+    """
+    table = _table()
+    values = {}
+    if files:
+        values['file_count'] = table.c.file_count + files
+    if plaintext_bytes:
+        values['plaintext_bytes'] = table.c.plaintext_bytes + plaintext_bytes
+    if ciphertext_bytes:
+        values['ciphertext_bytes'] = table.c.ciphertext_bytes + ciphertext_bytes
+    if activities:
+        values['activity_count'] = table.c.activity_count + activities
+    if last_activity_at is not None:
+        values['last_activity_at'] = case(
+            (or_(table.c.last_activity_at.is_(None), table.c.last_activity_at < last_activity_at), last_activity_at),
+            else_=table.c.last_activity_at,
+        )
+    if not values:
+        return
+    result = conn.execute(table.update().where(table.c.company_id == company_id).values(**values))
+    if result.rowcount == 0:
+        conn.execute(table.insert().values(company_id=company_id, **computed_values(conn, company_id)))
+
+
+_FILE_ATTRS = ('company_id', 'size', 'encrypted_size')
+
+
+def _file_values(file_record, before):
+    """(company_id, size, encrypted_size) before or after the pending flush."""
+    values = []
+    for attr in _FILE_ATTRS:
+        history = attributes.get_history(file_record, attr)
+        current = history.deleted if before else history.added
+        values.append(current[0] if current else (history.unchanged[0] if history.unchanged else None))
+    return values
+
+
+def _after_flush(session, flush_context):
+    """Turn the File rows this flush inserted, deleted or resized into counter deltas.
+
+    Runs on the session's connection, so the deltas commit or roll back with the rows. Covers
+    every path that goes through the ORM (uploads set File.size after the first flush, which
+    shows up here as a change); bulk query deletes don't, see delete_company.
+    """
+    from vault.models import File
+
+    deltas = {}
+
+    def add(values, sign):
+        company_id, size, encrypted_size = values
+        if company_id is None:
+            return  # personal vault files
+        entry = deltas.setdefault(company_id, [0, 0, 0])
+        entry[0] += sign
+        entry[1] += sign * (size or 0)
+        entry[2] += sign * (encrypted_size or 0)
+
+    for obj in session.new:
+        if isinstance(obj, File):
+            add(_file_values(obj, before=False), 1)
+    for obj in session.deleted:
+        if isinstance(obj, File):
+            add(_file_values(obj, before=True), -1)
+    for obj in session.dirty:
+        if isinstance(obj, File) and any(attributes.get_history(obj, attr).has_changes() for attr in _FILE_ATTRS):
+            add(_file_values(obj, before=True), -1)
+            add(_file_values(obj, before=False), 1)
+
+    if not deltas:
+        return
+    conn = session.connection()
+    for company_id, (count, plain, cipher) in deltas.items():
+        apply(conn, company_id, files=count, plaintext_bytes=plain, ciphertext_bytes=cipher)
+
+
+event.listen(Session, 'after_flush', _after_flush)
+
+
+def activity_added(conn, entries):
+    """Count activity log rows just inserted on conn (a flush batch)."""
+    totals = {}
+    for entry in entries:
+        count, latest = totals.get(entry['company_id'], (0, None))
+        totals[entry['company_id']] = (count + 1, max(latest, entry['timestamp']) if latest else entry['timestamp'])
+    for company_id, (count, latest) in totals.items():
+        if company_id is not None:
+            apply(conn, company_id, activities=count, last_activity_at=latest)
+
+
+def read(company_id):
+    """(company name, owner id, counters dict) with one primary-key select, or None."""
+    from vault.models import Company, CompanyStats
+
+    row = db.session.execute(
+        select(Company.name, Company.owner_id, CompanyStats.file_count, CompanyStats.plaintext_bytes,
+               CompanyStats.ciphertext_bytes, CompanyStats.activity_count, CompanyStats.last_activity_at)
+        .outerjoin(CompanyStats, CompanyStats.company_id == Company.id)
+        .where(Company.id == company_id)
+    ).one_or_none()
+    if row is None:
+        return None
+    name, owner_id, *counters = row
+    if counters[0] is None:
+        # No counters row (a company inserted outside the app); computed, and fixed by reconcile-stats
+        values = computed_values(db.session.connection(), company_id)
+    else:
+        values = dict(zip(('file_count', 'plaintext_bytes', 'ciphertext_bytes', 'activity_count',
+                           'last_activity_at'), counters))
+    return name, owner_id, values
+
+
+def reconcile(company_id=None):
+    """Recompute counters from the tables; returns [(company_id, old values, new values)] that differed."""
+    from vault.models import Company
+
+    table = _table()
+    conn = db.session.connection()
+    ids = [company_id] if company_id is not None else \
+        conn.execute(select(Company.id).order_by(Company.id)).scalars().all()
+    drifted = []
+    for cid in ids:
+        new = computed_values(conn, cid)
+        current = conn.execute(select(table).where(table.c.company_id == cid)).mappings().one_or_none()
+        old = None if current is None else {key: current[key] for key in new}
+        if old == new:
+            continue
+        if current is None:
+            conn.execute(table.insert().values(company_id=cid, **new))
+        else:
+            conn.execute(table.update().where(table.c.company_id == cid).values(**new))
+        drifted.append((cid, old, new))
+    if company_id is None:
+        # Rows left behind by companies deleted outside the app
+        conn.execute(table.delete().where(table.c.company_id.not_in(select(Company.id))))
+    return drifted
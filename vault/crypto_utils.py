@@ -1,17 +1,78 @@
 import os
-from cryptography.hazmat.primitives import hashes, padding
-from cryptography.hazmat.primitives.asymmetric import rsa, padding as asym_padding
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import serialization
+import hashlib
+import struct
+import threading
+import time
+from collections import deque
+
+from vault.cache import TTLCache
+
+# cryptography's hazmat modules are imported where they are first used, so a worker that
+# only serves health checks or static pages never loads them at boot.
+
+# --- SEGMENTED CONTAINER FORMAT (v2) ---
+# Header: MAGIC | version (1 byte) | segment size (4 bytes, big-endian) | nonce prefix (7 bytes)
+# Body:   one AES-256-GCM segment per SEGMENT_SIZE bytes of plaintext, each followed by its 16 byte tag.
+# Segment nonce = nonce prefix | segment index (4 bytes) | last-segment flag (1 byte), so segments
+# cannot be reordered, dropped or truncated without the tag check failing. The header is the AAD.
+MAGIC = b'SVLT'
+FORMAT_VERSION = 2
+SEGMENT_SIZE = 64 * 1024
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+HEADER_SIZE = len(MAGIC) + 1 + 4 + NONCE_PREFIX_SIZE
+READ_CHUNK_SIZE = 64 * 1024
+
+_HEADER_STRUCT = struct.Struct('>4sBI7s')
+_OAEP = None
+
+
+class CryptoCounters:
+    """Process-wide totals of crypto work (exported by vault/metrics.py)."""
+
+    FIELDS = ('bytes_encrypted', 'bytes_decrypted', 'rsa_keygen', 'rsa_wrap', 'rsa_unwrap')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, field, amount=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def stats(self):
+        with self._lock:
+            return {field: getattr(self, field) for field in self.FIELDS}
+
+
+crypto_counters = CryptoCounters()
+
+
+def _oaep():
+    global _OAEP
+    if _OAEP is None:
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+        _OAEP = asym_padding.OAEP(
+            mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+    return _OAEP
+
 
 def generate_user_keys():
     """Generates RSA pair for a new user."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
     private_key = rsa.generate_private_key(
         public_exponent=65537,
         key_size=2048
     )
     public_key = private_key.public_key()
-    
+
     # Serialize to PEM format for storage
     private_pem = private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
@@ -22,53 +83,407 @@ def generate_user_keys():
         encoding=serialization.Encoding.PEM,
         format=serialization.PublicFormat.SubjectPublicKeyInfo
     )
+    crypto_counters.add('rsa_keygen')
     return private_pem, public_pem
 
-def encrypt_file_data(file_binary, public_key_pem):
-    """AES-256 File Encryption + RSA Key Wrap."""
-    # 1. Setup AES
-    aes_key = os.urandom(32)
-    iv = os.urandom(16)
-    
-    # 2. Pad and Encrypt Data
-    padder = padding.PKCS7(128).padder()
-    padded_data = padder.update(file_binary) + padder.finalize()
-    
-    cipher = Cipher(algorithms.AES(aes_key), modes.CBC(iv))
-    encryptor = cipher.encryptor()
-    encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
-    
-    # 3. Encrypt AES Key with User's RSA Public Key
-    public_key = serialization.load_pem_public_key(public_key_pem)
-    encrypted_aes_key = public_key.encrypt(
-        aes_key,
-        asym_padding.OAEP(
-            mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
-    return encrypted_data, encrypted_aes_key, iv
-
-def decrypt_file_data(encrypted_data, encrypted_aes_key, iv, private_key_pem):
-    """RSA Key Unwrap + AES-256 Decryption."""
-    # 1. Decrypt the AES key using RSA Private Key
-    private_key = serialization.load_pem_private_key(private_key_pem, password=None)
-    aes_key = private_key.decrypt(
-        encrypted_aes_key,
-        asym_padding.OAEP(
-            mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
+
+class KeyPairPool:
+    """Keeps KEY_POOL_SIZE ready RSA keypairs so registration doesn't generate one inline.
+
+    A background thread refills the pool after every take(); when the pool is empty (or
+    disabled with size 0) take() falls back to generate_user_keys() on the caller's thread.
+    """
+
+    def __init__(self, size=0):
+        self.size = size
+        self._keys = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._thread_pid = None
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.total_generate_seconds = 0.0
+        self._recent = deque(maxlen=32)  # completion times of recent refills
+
+    def init_app(self, app):
+        default_size = 0 if os.environ.get('VERCEL') else 4
+        self.size = int(app.config.setdefault('KEY_POOL_SIZE', os.environ.get('KEY_POOL_SIZE', default_size)))
+        if self.size > 0:
+            self._ensure_thread()
+
+    def take(self):
+        """Return (private_pem, public_pem), from the pool when one is ready."""
+        with self._cond:
+            keypair = self._keys.popleft() if self._keys else None
+            if keypair is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._cond.notify()
+        if self.size > 0:
+            self._ensure_thread()
+        return keypair if keypair is not None else generate_user_keys()
+
+    def _ensure_thread(self):
+        # Started lazily and re-started after a fork (gunicorn --preload)
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            if self._thread_pid != os.getpid():
+                # Keys generated in the parent would be shared by every forked worker
+                self._keys.clear()
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='rsa-key-pool', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._keys) >= self.size:
+                    self._cond.wait()
+            started = time.perf_counter()
+            keypair = generate_user_keys()
+            with self._cond:
+                self.generated += 1
+                self.total_generate_seconds += time.perf_counter() - started
+                self._recent.append(time.monotonic())
+                self._keys.append(keypair)
+
+    def stats(self):
+        with self._cond:
+            recent = list(self._recent)
+            available = len(self._keys)
+        window = recent[-1] - recent[0] if len(recent) > 1 else 0.0
+        return {
+            'target_size': self.size,
+            'available': available,
+            'hits': self.hits,
+            'misses': self.misses,
+            'generated': self.generated,
+            'avg_generate_seconds': self.total_generate_seconds / self.generated if self.generated else 0.0,
+            'refill_rate_per_second': (len(recent) - 1) / window if window else 0.0,
+        }
+
+
+key_pool = KeyPairPool()
+
+
+def is_segmented(iv):
+    """Segmented (v2) blobs store the 7 byte nonce prefix in File.iv; legacy CBC blobs a 16 byte IV."""
+    return iv is not None and len(iv) == NONCE_PREFIX_SIZE
+
+
+def encrypted_size(plaintext_size, segment_size=SEGMENT_SIZE):
+    """Size of the v2 container for a plaintext of the given length."""
+    segments = max(1, -(-plaintext_size // segment_size))
+    return HEADER_SIZE + plaintext_size + segments * TAG_SIZE
+
+
+def _segment_nonce(prefix, index, last):
+    return prefix + struct.pack('>IB', index, 1 if last else 0)
+
+
+class KeyCache(TTLCache):
+    """Bounded LRU + TTL cache of parsed RSA key objects.
+
+    Entries are keyed by (kind, user id, SHA-256 of the PEM bytes), so a rotated key
+    can never be served from a stale entry even before invalidate_user() runs.
+    """
+
+    def load(self, kind, user_id, pem, loader):
+        key = (kind, user_id, hashlib.sha256(bytes(pem)).digest())
+        # A concurrent miss for the same key just parses twice
+        return self.get_or_set(key, lambda: loader(pem))
+
+    def invalidate_user(self, user_id):
+        self.invalidate(lambda key: key[1] == user_id)
+
+
+key_cache = KeyCache(
+    maxsize=int(os.environ.get('KEY_CACHE_SIZE', 256)),
+    ttl=int(os.environ.get('KEY_CACHE_TTL', 3600))
+)
+
+
+def load_public_key(public_key_pem, user_id=None):
+    from cryptography.hazmat.primitives import serialization
+    return key_cache.load('public', user_id, public_key_pem, serialization.load_pem_public_key)
+
+
+def load_private_key(private_key_pem, user_id=None):
+    from cryptography.hazmat.primitives import serialization
+    return key_cache.load(
+        'private', user_id, private_key_pem,
+        lambda pem: serialization.load_pem_private_key(pem, password=None)
     )
-    
-    # 2. Decrypt the File
-    cipher = Cipher(algorithms.AES(aes_key), modes.CBC(iv))
-    decryptor = cipher.decryptor()
-    padded_data = decryptor.update(encrypted_data) + decryptor.finalize()
-    
-    # 3. Unpad
-    unpadder = padding.PKCS7(128).unpadder()
-    data = unpadder.update(padded_data) + unpadder.finalize()
-    return data
\ No newline at end of file
+
+
+def wrap_aes_key(aes_key, public_key_pem, user_id=None):
+    """Encrypt an AES key with the user's RSA public key."""
+    crypto_counters.add('rsa_wrap')
+    return load_public_key(public_key_pem, user_id).encrypt(aes_key, _oaep())
+
+
+def unwrap_aes_key(encrypted_aes_key, private_key_pem, user_id=None):
+    """Decrypt an AES key with the user's RSA private key."""
+    crypto_counters.add('rsa_unwrap')
+    return load_private_key(private_key_pem, user_id).decrypt(encrypted_aes_key, _oaep())
+
+
+class FileEncryptor:
+    """Incremental AES-256-GCM encryptor producing the segmented v2 container.
+
+    Feed plaintext with update() and collect the returned ciphertext, then call finalize().
+    At most one segment of plaintext is buffered, whatever the file size.
+    """
+
+    def __init__(self, public_key_pem, segment_size=SEGMENT_SIZE, user_id=None):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        self.segment_size = segment_size
+        self._aes_key = os.urandom(32)
+        self._aead = AESGCM(self._aes_key)
+        self.iv = os.urandom(NONCE_PREFIX_SIZE)
+        self.encrypted_aes_key = wrap_aes_key(self._aes_key, public_key_pem, user_id)
+        self.header = _HEADER_STRUCT.pack(MAGIC, FORMAT_VERSION, segment_size, self.iv)
+        self.plaintext_size = 0
+        self.ciphertext_size = 0
+        self._buffer = bytearray()
+        self._index = 0
+        self._header_sent = False
+        self._finalized = False
+
+    def _seal(self, data, last):
+        nonce = _segment_nonce(self.iv, self._index, last)
+        self._index += 1
+        crypto_counters.add('bytes_encrypted', len(data))
+        return self._aead.encrypt(nonce, bytes(data), self.header)
+
+    def _emit(self, parts):
+        out = b''.join(parts)
+        self.ciphertext_size += len(out)
+        return out
+
+    def update(self, data):
+        if self._finalized:
+            raise ValueError('Encryptor already finalized.')
+        parts = []
+        if not self._header_sent:
+            parts.append(self.header)
+            self._header_sent = True
+        self.plaintext_size += len(data)
+        self._buffer += data
+        # Keep the tail buffered: the last segment must be sealed with the "last" flag.
+        while len(self._buffer) > self.segment_size:
+            parts.append(self._seal(self._buffer[:self.segment_size], last=False))
+            del self._buffer[:self.segment_size]
+        return self._emit(parts)
+
+    def finalize(self):
+        if self._finalized:
+            raise ValueError('Encryptor already finalized.')
+        parts = []
+        if not self._header_sent:
+            parts.append(self.header)
+            self._header_sent = True
+        parts.append(self._seal(self._buffer, last=True))
+        self._buffer = bytearray()
+        self._finalized = True
+        return self._emit(parts)
+
+    def iter_encrypt(self, fileobj, chunk_size=READ_CHUNK_SIZE):
+        """Yield the container for a readable binary file object chunk by chunk."""
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            out = self.update(chunk)
+            if out:
+                yield out
+        yield self.finalize()
+
+
+class FileDecryptor:
+    """Incremental decryptor for the segmented v2 container.
+
+    update() accepts ciphertext in arbitrary chunks and returns the plaintext of every
+    complete segment; finalize() authenticates and returns the last segment.
+    """
+
+    def __init__(self, aes_key, iv):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        self._aead = AESGCM(aes_key)
+        self.iv = iv
+        self.header = None
+        self.segment_size = None
+        self._buffer = bytearray()
+        self._index = 0
+        self._finalized = False
+
+    def load_header(self, header):
+        magic, version, segment_size, prefix = _HEADER_STRUCT.unpack(bytes(header[:HEADER_SIZE]))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('Unsupported encrypted file format.')
+        if prefix != self.iv:
+            raise ValueError('Encrypted file header does not match its metadata.')
+        self.header = bytes(header[:HEADER_SIZE])
+        self.segment_size = segment_size
+
+    def _read_header(self):
+        self.load_header(self._buffer)
+        del self._buffer[:HEADER_SIZE]
+
+    def decrypt_segment(self, index, sealed, last):
+        """Authenticate and decrypt a single segment (random access; load_header() first)."""
+        nonce = _segment_nonce(self.iv, index, last)
+        plain = self._aead.decrypt(nonce, bytes(sealed), self.header)
+        crypto_counters.add('bytes_decrypted', len(plain))
+        return plain
+
+    def _open(self, data, last):
+        self._index += 1
+        return self.decrypt_segment(self._index - 1, data, last)
+
+    def update(self, data):
+        if self._finalized:
+            raise ValueError('Decryptor already finalized.')
+        self._buffer += data
+        if self.header is None:
+            if len(self._buffer) < HEADER_SIZE:
+                return b''
+            self._read_header()
+        sealed = self.segment_size + TAG_SIZE
+        parts = []
+        while len(self._buffer) > sealed:
+            parts.append(self._open(self._buffer[:sealed], last=False))
+            del self._buffer[:sealed]
+        return b''.join(parts)
+
+    def finalize(self):
+        if self._finalized:
+            raise ValueError('Decryptor already finalized.')
+        if self.header is None:
+            raise ValueError('Encrypted file is truncated.')
+        self._finalized = True
+        out = self._open(self._buffer, last=True)
+        self._buffer = bytearray()
+        return out
+
+
+class LegacyCBCDecryptor:
+    """Incremental decryptor for blobs written before the segmented format (AES-256-CBC + PKCS7)."""
+
+    def __init__(self, aes_key, iv):
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        self._decryptor = Cipher(algorithms.AES(aes_key), modes.CBC(iv)).decryptor()
+        self._unpadder = padding.PKCS7(128).unpadder()
+
+    def update(self, data):
+        plain = self._unpadder.update(self._decryptor.update(data))
+        crypto_counters.add('bytes_decrypted', len(plain))
+        return plain
+
+    def finalize(self):
+        plain = self._unpadder.update(self._decryptor.finalize()) + self._unpadder.finalize()
+        crypto_counters.add('bytes_decrypted', len(plain))
+        return plain
+
+
+def new_decryptor(encrypted_aes_key, iv, private_key_pem, user_id=None):
+    """RSA key unwrap, then the incremental decryptor matching the blob's format."""
+    aes_key = unwrap_aes_key(encrypted_aes_key, private_key_pem, user_id)
+    if is_segmented(iv):
+        return FileDecryptor(aes_key, iv)
+    return LegacyCBCDecryptor(aes_key, iv)
+
+
+def iter_decrypt(decryptor, chunks):
+    """Yield plaintext for an iterable of ciphertext chunks."""
+    for chunk in chunks:
+        out = decryptor.update(chunk)
+        if out:
+            yield out
+    out = decryptor.finalize()
+    if out:
+        yield out
+
+
+def plaintext_size(ciphertext_size, segment_size=SEGMENT_SIZE):
+    """Inverse of encrypted_size() for a v2 container."""
+    sealed = segment_size + TAG_SIZE
+    segments = max(1, -(-(ciphertext_size - HEADER_SIZE) // sealed))
+    return ciphertext_size - HEADER_SIZE - segments * TAG_SIZE
+
+
+def iter_decrypt_range(decryptor, read_range, ciphertext_size, start, end):
+    """Yield plaintext bytes [start, end) of a v2 container, decrypting only the covering segments.
+
+    read_range(offset, stop) must return an iterable of ciphertext chunks for that byte range.
+    """
+    if decryptor.header is None:
+        decryptor.load_header(b''.join(read_range(0, HEADER_SIZE)))
+    segment_size = decryptor.segment_size
+    sealed_size = segment_size + TAG_SIZE
+    total_segments = max(1, -(-(ciphertext_size - HEADER_SIZE) // sealed_size))
+    if end <= start:
+        return
+    first, last = start // segment_size, (end - 1) // segment_size
+    offset = HEADER_SIZE + first * sealed_size
+    stop = min(HEADER_SIZE + (last + 1) * sealed_size, ciphertext_size)
+    buffer = bytearray()
+    index = first
+    for chunk in read_range(offset, stop):
+        buffer += chunk
+        # The final segment is shorter than the others, so size each one from the remaining bytes
+        need = min(sealed_size, ciphertext_size - offset)
+        while len(buffer) >= need:
+            plain = decryptor.decrypt_segment(index, buffer[:need], last=index == total_segments - 1)
+            del buffer[:need]
+            offset += need
+            seg_start = index * segment_size
+            lo, hi = max(start - seg_start, 0), min(end - seg_start, len(plain))
+            if lo < hi:
+                yield plain[lo:hi]
+            index += 1
+            if index > last:
+                return
+            need = min(sealed_size, ciphertext_size - offset)
+    raise ValueError('Encrypted file is truncated.')
+
+
+def iter_chunks(data, chunk_size=READ_CHUNK_SIZE):
+    """Slice a bytes-like object into memoryview chunks without copying it."""
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def encrypt_file_data(file_binary, public_key_pem, user_id=None):
+    """AES-256-GCM segmented file encryption + RSA key wrap, for data already in memory.
+
+    The container is written into one preallocated bytearray (returned as is), so peak memory
+    is the input plus its ciphertext. Uploads stream through FileEncryptor.iter_encrypt instead.
+    """
+    encryptor = FileEncryptor(public_key_pem, user_id=user_id)
+    encrypted_data = bytearray(encrypted_size(len(file_binary)))
+    offset = 0
+    for chunk in iter_chunks(file_binary):
+        out = encryptor.update(chunk)
+        encrypted_data[offset:offset + len(out)] = out
+        offset += len(out)
+    out = encryptor.finalize()
+    encrypted_data[offset:offset + len(out)] = out
+    if offset + len(out) != len(encrypted_data):
+        raise ValueError('Encrypted size mismatch.')
+    return encrypted_data, encryptor.encrypted_aes_key, encryptor.iv
+
+
+def decrypt_file_data(encrypted_data, encrypted_aes_key, iv, private_key_pem, user_id=None):
+    """RSA key unwrap + AES-256 decryption (segmented GCM or legacy CBC)."""
+    decryptor = new_decryptor(encrypted_aes_key, iv, private_key_pem, user_id)
+    return b''.join(iter_decrypt(decryptor, iter_chunks(encrypted_data)))
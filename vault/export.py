@@ -0,0 +1,178 @@
+"""Streamed ZIP export of a company's files.
+
+The archive is written to the response as it is built: zipfile writes into a sink that the
+response generator drains after every chunk, so nothing is buffered beyond the current chunk.
+A bounded pool decrypts up to EXPORT_WORKERS files ahead of the writer, each into a queue of
+at most EXPORT_QUEUE_CHUNKS plaintext chunks, so memory stays at a few chunks per worker
+whatever the archive size. Files are written in order; one that cannot be decrypted is
+skipped and listed in an _export_errors.txt entry at the end of the archive.
+"""
+import os
+import posixpath
+import queue
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response, current_app, stream_with_context
+
+from vault.activity_log import activity_log
+from vault.crypto_utils import iter_decrypt, new_decryptor
+from vault.storage import store_for
+from vault.streaming import content_disposition
+
+_DONE = object()
+# Entries whose size is unknown or close to 4 GiB need zip64 headers up front
+_ZIP64_THRESHOLD = int(zipfile.ZIP64_LIMIT * 0.9)
+# Put timeout, so a worker notices a cancelled export instead of blocking on a full queue
+_PUT_POLL_SECONDS = 0.5
+
+
+class _ZipSink:
+    """Write-only file object for zipfile; the response generator drains it."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        if data:
+            self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return b''.join(chunks)
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _archive_names(files):
+    """Unique, flat entry names (client-supplied filenames can contain paths or repeat)."""
+    seen = set()
+    names = []
+    for file_record in files:
+        base = posixpath.basename(file_record.filename.replace('\\', '/')) or f"file-{file_record.id}"
+        stem, ext = os.path.splitext(base)
+        name, n = base, 1
+        while name.lower() in seen:
+            n += 1
+            name = f"{stem} ({n}){ext}"
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+
+def _decrypt_into(app, file_id, private_key_pem, user_id, out, cancelled):
+    """Pool job: decrypt one file into out, then _DONE (or the exception that stopped it)."""
+    from vault.models import File
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                out.put(item, timeout=_PUT_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+        raise _Cancelled()
+
+    try:
+        # Own app context: DB-backed blobs are read through this thread's session
+        with app.app_context():
+            file_record = File.query.get(file_id)
+            if file_record is None:
+                raise FileNotFoundError('File was deleted during the export.')
+            decryptor = new_decryptor(file_record.encrypted_aes_key, file_record.iv, private_key_pem, user_id)
+            for chunk in iter_decrypt(decryptor, store_for(file_record).stream(file_record.encrypted_name)):
+                if chunk:
+                    put(chunk)
+        put(_DONE)
+    except _Cancelled:
+        pass
+    except Exception as e:
+        try:
+            put(e)
+        except _Cancelled:
+            pass
+
+
+def export_zip_response(company, files, private_key_pem, user_id, user_email, ip_address=None):
+    """Streaming application/zip response with the decrypted contents of files (in order)."""
+    app = current_app._get_current_object()
+    workers = max(1, min(app.config['EXPORT_WORKERS'], len(files) or 1))
+    queue_chunks = app.config['EXPORT_QUEUE_CHUNKS']
+    progress_every = app.config['EXPORT_PROGRESS_EVERY']
+    compression = zipfile.ZIP_DEFLATED if app.config['EXPORT_ZIP_COMPRESSION'] == 'deflated' else zipfile.ZIP_STORED
+    entries = list(zip(files, _archive_names(files)))
+
+    def log(action):
+        activity_log.record(company.id, user_email, action, ip_address=ip_address)
+
+    def generate():
+        sink = _ZipSink()
+        cancelled = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zip-export')
+        pending = {}  # index -> queue, for at most `workers` files ahead of the writer
+        written, errors, total_bytes = 0, [], 0
+        finished = False
+
+        def submit(index):
+            if index < len(entries) and index not in pending:
+                out = queue.Queue(maxsize=queue_chunks)
+                pending[index] = out
+                pool.submit(_decrypt_into, app, entries[index][0].id, private_key_pem, user_id, out, cancelled)
+
+        log(f"Started ZIP export of {len(entries)} file(s)")
+        try:
+            for index in range(min(workers, len(entries))):
+                submit(index)
+            with zipfile.ZipFile(sink, 'w', compression=compression, allowZip64=True) as archive:
+                for index, (file_record, name) in enumerate(entries):
+                    out = pending.pop(index)
+                    submit(index + workers)
+                    item = out.get()
+                    if isinstance(item, Exception):
+                        errors.append(f"{name}: {item}")
+                        continue
+                    info = zipfile.ZipInfo(name, date_time=file_record.upload_date.timetuple()[:6])
+                    info.compress_type = compression
+                    force_zip64 = file_record.size is None or file_record.size > _ZIP64_THRESHOLD
+                    with archive.open(info, 'w', force_zip64=force_zip64) as entry:
+                        while item is not _DONE:
+                            if isinstance(item, Exception):
+                                # Authenticated up to here; note the truncation and move on
+                                errors.append(f"{name}: incomplete ({item})")
+                                break
+                            entry.write(item)
+                            total_bytes += len(item)
+                            data = sink.drain()
+                            if data:
+                                yield data
+                            item = out.get()
+                    written += 1
+                    data = sink.drain()
+                    if data:
+                        yield data
+                    if progress_every and written % progress_every == 0 and written < len(entries):
+                        log(f"ZIP export progress: {written}/{len(entries)} file(s)")
+                if errors:
+                    archive.writestr('_export_errors.txt', '\n'.join(errors) + '\n')
+            yield sink.drain()
+            finished = True
+            log(f"Exported {written}/{len(entries)} file(s) as ZIP ({total_bytes} bytes)"
+                + (f", {len(errors)} error(s)" if errors else ''))
+        finally:
+            cancelled.set()
+            pool.shutdown(wait=False)
+            if not finished:
+                # Client went away (or the writer failed) mid-archive
+                log(f"ZIP export interrupted after {written}/{len(entries)} file(s)")
+
+    response = Response(stream_with_context(generate()), mimetype='application/zip', direct_passthrough=True)
+    disposition, names = content_disposition('attachment', f"{company.name}-files.zip")
+    response.headers.set('Content-Disposition', disposition, **names)
+    return response
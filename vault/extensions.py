@@ -1,13 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from flask_migrate import Migrate
 from flask import Blueprint
 from flask_wtf.csrf import CSRFProtect
-from flask_mail import Mail
 
+# Flask-Migrate is registered on first use (vault.schema.init_migrate). Flask-Mail is only used
+# for its Message container (vault.auth.utils), and mail goes out over our own SMTP connection.
 db = SQLAlchemy()
 login_manager = LoginManager()
-migrate = Migrate()
 main_bp = Blueprint("main", __name__)
 csrf = CSRFProtect()
-mail = Mail()
\ No newline at end of file
@@ -0,0 +1,198 @@
+"""Per-request timing by category: DB queries, RSA and AES work, SMTP, template rendering.
+
+REQUEST_TIMING selects the output:
+  - 'off':    nothing is hooked (the default), so there is no per-call cost at all,
+  - 'header': a Server-Timing response header, shown in the browser's network panel,
+  - 'log':    one "[TIMING] {json}" line per request, written at teardown so streamed
+              downloads include the time spent sending the body,
+  - 'on':     both.
+REQUEST_TIMING_LOG_MS only logs requests that took at least that long.
+
+Only work done on the request's own thread is counted: the key pool, mail queue and
+activity log threads run outside any request.
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+from flask import request
+
+MODES = ('off', 'header', 'log', 'on')
+# Server-Timing metric name -> what its count means
+CATEGORIES = {
+    'db': 'queries',
+    'rsa': 'ops',
+    'aes': 'segments',
+    'smtp': 'messages',
+    'render': 'templates',
+}
+
+_local = threading.local()
+
+
+def record(category, seconds):
+    """Add one timed operation to the current request (ignored outside one)."""
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return
+    entry = timings.get(category)
+    if entry is None:
+        timings[category] = [seconds, 1]
+    else:
+        entry[0] += seconds
+        entry[1] += 1
+
+
+def timed(category, fn):
+    """fn, timed into category while a request is being measured."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'timings', None) is None:
+            return fn(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record(category, time.perf_counter() - started)
+    wrapper._timed = True
+    return wrapper
+
+
+def _wrap(owner, name, category):
+    fn = getattr(owner, name)
+    if not getattr(fn, '_timed', False):
+        setattr(owner, name, timed(category, fn))
+
+
+# --- Hooks (installed once per process, only when enabled) ---
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'timings', None) is not None:
+        conn.info.setdefault('_timing_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('_timing_started')
+    if started:
+        record('db', time.perf_counter() - started.pop())
+
+
+def _on_db_error(context):
+    # A failed statement never reaches after_cursor_execute
+    started = context.connection.info.get('_timing_started') if context.connection is not None else None
+    if started:
+        record('db', time.perf_counter() - started.pop())
+
+
+def _before_render(sender, template, context, **extra):
+    stack = getattr(_local, 'renders', None)
+    if stack is not None:
+        stack.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    stack = getattr(_local, 'renders', None)
+    if stack:
+        record('render', time.perf_counter() - stack.pop())
+
+
+def _install_hooks():
+    from flask import before_render_template, template_rendered
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    from vault import crypto_utils
+    from vault.auth.utils import PooledSMTPConnection
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _on_db_error)
+    before_render_template.connect(_before_render)
+    template_rendered.connect(_rendered)
+
+    # Module-level functions are looked up at call time inside crypto_utils (the key pool,
+    # FileEncryptor and new_decryptor all go through them), so patching the module is enough
+    for name in ('generate_user_keys', 'wrap_aes_key', 'unwrap_aes_key'):
+        _wrap(crypto_utils, name, 'rsa')
+    # One call per sealed/opened segment, whichever API (streaming, range, whole file) is used
+    _wrap(crypto_utils.FileEncryptor, '_seal', 'aes')
+    _wrap(crypto_utils.FileDecryptor, 'decrypt_segment', 'aes')
+    _wrap(crypto_utils.LegacyCBCDecryptor, 'update', 'aes')
+    _wrap(crypto_utils.LegacyCBCDecryptor, 'finalize', 'aes')
+    _wrap(PooledSMTPConnection, 'send', 'smtp')
+
+
+class RequestTiming:
+
+    def __init__(self):
+        self.mode = 'off'
+        self.log_threshold_ms = 0.0
+        self._installed = False
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('REQUEST_TIMING', os.environ.get('REQUEST_TIMING', 'off').lower())
+        app.config.setdefault('REQUEST_TIMING_LOG_MS', float(os.environ.get('REQUEST_TIMING_LOG_MS', 0)))
+        self.mode = app.config['REQUEST_TIMING']
+        if self.mode not in MODES:
+            raise ValueError(f"Unknown REQUEST_TIMING {self.mode!r}; expected one of {', '.join(MODES)}")
+        self.log_threshold_ms = app.config['REQUEST_TIMING_LOG_MS']
+        if self.mode == 'off':
+            return
+        with self._lock:
+            if not self._installed:
+                _install_hooks()
+                self._installed = True
+        app.before_request(self._start)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown)
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def _start(self):
+        _local.timings = {}
+        _local.renders = []
+        _local.started = time.perf_counter()
+        _local.status = None
+
+    def _after_request(self, response):
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            return response
+        _local.status = response.status_code
+        if self.mode in ('header', 'on'):
+            metrics = [
+                f'{name};dur={seconds * 1000:.2f};desc="{count} {CATEGORIES[name]}"'
+                for name, (seconds, count) in timings.items()
+            ]
+            # Up to here: a streamed body is still to come
+            metrics.append(f'app;dur={(time.perf_counter() - _local.started) * 1000:.2f}')
+            response.headers.add('Server-Timing', ', '.join(metrics))
+        return response
+
+    def _teardown(self, exc):
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            return
+        total_ms = (time.perf_counter() - _local.started) * 1000
+        _local.timings = _local.renders = None
+        if self.mode not in ('log', 'on') or total_ms < self.log_threshold_ms:
+            return
+        line = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': _local.status if exc is None else 500,
+            'total_ms': round(total_ms, 2),
+        }
+        for name, (seconds, count) in timings.items():
+            line[f'{name}_ms'] = round(seconds * 1000, 2)
+            line[f'{name}_count'] = count
+        print(f"[TIMING] {json.dumps(line, separators=(',', ':'))}")
+
+
+request_timing = RequestTiming()
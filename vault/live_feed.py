@@ -0,0 +1,348 @@
+"""Server-Sent Events feed of new ActivityLog entries (GET /api/v1/logs/<id>/stream).
+
+A client resumes from the last id it has seen: ?last_id= on the first request, then the
+Last-Event-ID header that EventSource sends on every reconnect. Delivery, per worker process:
+  - one shared poller thread (started with the first subscriber) runs ONE query per
+    LIVE_FEED_POLL_INTERVAL for rows with id > its cursor, whatever the company, and fans them
+    out to the in-process subscribers of each company: N viewers cost one query, not N,
+  - a flush of this worker's own activity log buffer wakes the poller at once, so entries
+    written by the same worker are pushed without waiting for the interval.
+Ids from concurrent transactions can become visible out of order, so ids the cursor skipped
+are re-checked for GAP_SECONDS before they are given up on.
+
+A stream ends after LIVE_FEED_MAX_SECONDS and the browser reconnects with its last id. Each
+open stream holds a worker thread, so streams only stay open on servers that handle requests
+concurrently (threaded or async: the request's wsgi.multithread). Anywhere else (gunicorn sync
+workers, and Vercel, where the default is 0) a request sends what is new since the client's id
+and closes, and the client reconnects after LIVE_FEED_POLL_INTERVAL (the SSE retry field), i.e.
+plain polling. init_app reports a gunicorn sync worker setup at startup.
+"""
+import json
+import os
+import queue
+import shlex
+import sys
+import threading
+import time
+from collections import deque
+
+from vault.extensions import db
+
+# Re-check ids skipped by the cursor for this long (uncommitted when the poll ran)
+GAP_SECONDS = 10.0
+# Skipped ranges wider than this are deletions, not in-flight transactions
+MAX_GAP_IDS = 100
+POLL_BATCH = 500
+# Events buffered per subscriber; a stream that falls further behind is closed and resumes by id
+SUBSCRIBER_QUEUE = 500
+# Sent ids remembered per stream, to drop events delivered by both the backlog and the poller
+SENT_MEMORY = 1000
+
+_OVERFLOW = object()
+
+
+class _Subscriber:
+
+    def __init__(self, company_id):
+        self.company_id = company_id
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE)
+
+
+def _entry(row):
+    return {
+        'id': row.id,
+        'user': row.user_email,
+        'action': row.action,
+        'ip_address': row.ip_address,
+        'timestamp': row.timestamp.isoformat(),
+    }
+
+
+def _serves_concurrently():
+    """Whether this process's server handles requests concurrently, as far as can be told at startup.
+
+    True for gevent/eventlet (threading is monkey-patched) and for gunicorn started with a threaded
+    or async worker class, False for gunicorn sync workers, None when unknown (another server, or a
+    gunicorn config file, which isn't read here). Requests are checked again in stream_seconds().
+    """
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    if gevent_monkey is not None and gevent_monkey.is_module_patched('threading'):
+        return True
+    eventlet_patcher = sys.modules.get('eventlet.patcher')
+    if eventlet_patcher is not None and eventlet_patcher.is_monkey_patched('thread'):
+        return True
+    if not os.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn/'):
+        return None
+    try:
+        from gunicorn.config import Config, get_default_config_file
+
+        parser = Config().parser()
+        env_args, _ = parser.parse_known_args(shlex.split(os.environ.get('GUNICORN_CMD_ARGS', '')))
+        args, _ = parser.parse_known_args(sys.argv[1:])
+    except (Exception, SystemExit):
+        return None
+    if args.config or env_args.config or get_default_config_file():
+        return None
+    worker_class = args.worker_class or env_args.worker_class or 'sync'
+    threads = args.threads or env_args.threads or 1
+    # gunicorn itself switches sync workers with --threads > 1 to gthread
+    return worker_class != 'sync' or threads > 1
+
+
+def format_event(entry):
+    return f"id: {entry['id']}\nevent: activity\ndata: {json.dumps(entry, separators=(',', ':'))}\n\n"
+
+
+class LiveFeed:
+
+    def __init__(self):
+        self.app = None
+        self.poll_interval = 2.0
+        self.heartbeat = 15.0
+        self.max_seconds = 300.0
+        self.backlog = 200
+        self._lock = threading.Lock()
+        self._subscribers = {}  # company_id -> set of _Subscriber
+        self._wakeup = threading.Event()
+        self._cursor = None
+        self._gaps = {}  # skipped id -> monotonic time first skipped
+        self._thread = None
+        self._thread_pid = None
+        # Metrics
+        self.polls = 0
+        self.delivered = 0
+        self.overflows = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.poll_interval = float(app.config.setdefault(
+            'LIVE_FEED_POLL_INTERVAL', os.environ.get('LIVE_FEED_POLL_INTERVAL', 2.0)))
+        self.heartbeat = float(app.config.setdefault(
+            'LIVE_FEED_HEARTBEAT', os.environ.get('LIVE_FEED_HEARTBEAT', 15.0)))
+        # Serverless functions can't hold a response open, so each request just catches up
+        default_max = 0 if os.environ.get('VERCEL') else 300
+        self.max_seconds = float(app.config.setdefault(
+            'LIVE_FEED_MAX_SECONDS', os.environ.get('LIVE_FEED_MAX_SECONDS', default_max)))
+        self.backlog = int(app.config.setdefault('LIVE_FEED_BACKLOG', os.environ.get('LIVE_FEED_BACKLOG', 200)))
+        if self.max_seconds and _serves_concurrently() is False:
+            print(f"[LIVE FEED] gunicorn sync workers serve one request at a time: the activity feed polls every "
+                  f"{self.poll_interval:g}s instead of streaming. Run gunicorn with --worker-class gthread --threads N "
+                  f"(or gevent) for live streams.")
+
+    @property
+    def subscriber_count(self):
+        return sum(len(subs) for subs in self._subscribers.values())
+
+    def notify(self):
+        """New rows were just committed by this process (activity log flush): poll now."""
+        if self._subscribers:
+            self._wakeup.set()
+
+    # --- Subscriptions ---
+
+    def subscribe(self, company_id):
+        subscriber = _Subscriber(company_id)
+        with self._lock:
+            if self._cursor is None:
+                # Start at the current tail; anything older comes from the stream's own backlog query
+                self._cursor = self._max_id()
+                self._gaps.clear()
+            self._subscribers.setdefault(company_id, set()).add(subscriber)
+        self._ensure_thread()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subs = self._subscribers.get(subscriber.company_id)
+            if subs is not None:
+                subs.discard(subscriber)
+                if not subs:
+                    del self._subscribers[subscriber.company_id]
+            if not self._subscribers:
+                # Nobody listening: the next subscriber starts again from the tail
+                self._cursor = None
+
+    def _max_id(self):
+        from sqlalchemy import func, select
+
+        from vault.models import ActivityLog
+
+        with self.app.app_context():
+            with db.engine.connect() as conn:
+                return conn.execute(select(func.max(ActivityLog.id))).scalar() or 0
+
+    # --- Shared poller ---
+
+    def _ensure_thread(self):
+        # Started lazily and re-started after a fork (gunicorn --preload)
+        if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='live-feed-poller', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if not self._subscribers:
+                continue
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"[LIVE FEED] Poll failed, will retry: {e}")
+
+    def poll(self):
+        """One query for every company: new rows past the cursor, plus ids skipped earlier."""
+        from sqlalchemy import or_, select
+
+        from vault.models import ActivityLog
+
+        with self._lock:
+            cursor = self._cursor
+            now = time.monotonic()
+            self._gaps = {i: t for i, t in self._gaps.items() if now - t < GAP_SECONDS}
+            gaps = list(self._gaps)
+        if cursor is None:
+            return
+        condition = ActivityLog.id > cursor
+        if gaps:
+            condition = or_(condition, ActivityLog.id.in_(gaps))
+        with self.app.app_context():
+            with db.engine.connect() as conn:
+                rows = conn.execute(
+                    select(ActivityLog.id, ActivityLog.company_id, ActivityLog.user_email, ActivityLog.action,
+                           ActivityLog.ip_address, ActivityLog.timestamp)
+                    .where(condition).order_by(ActivityLog.id).limit(POLL_BATCH)
+                ).all()
+        self.polls += 1
+        if not rows:
+            return
+
+        with self._lock:
+            if self._cursor is None:
+                return  # everyone unsubscribed meanwhile
+            previous = self._cursor
+            for row in rows:
+                self._gaps.pop(row.id, None)
+                if row.id > previous:
+                    if 1 < row.id - previous <= MAX_GAP_IDS:
+                        for missing in range(previous + 1, row.id):
+                            self._gaps.setdefault(missing, now)
+                    previous = row.id
+            self._cursor = previous
+            targets = {company_id: list(subs) for company_id, subs in self._subscribers.items()}
+
+        for row in rows:
+            for subscriber in targets.get(row.company_id, ()):
+                self._deliver(subscriber, _entry(row))
+        if len(rows) == POLL_BATCH:
+            self._wakeup.set()  # more waiting; don't sleep a full interval
+
+    def _deliver(self, subscriber, entry):
+        try:
+            subscriber.queue.put_nowait(entry)
+            self.delivered += 1
+        except queue.Full:
+            # A stalled client: end its stream, it resumes from its last id
+            self.overflows += 1
+            with subscriber.queue.mutex:
+                subscriber.queue.queue.clear()
+            subscriber.queue.put_nowait(_OVERFLOW)
+
+    # --- Streams ---
+
+    def stream_seconds(self, environ):
+        """How long a stream served from this WSGI environ stays open (0: catch up and close).
+
+        A server that doesn't run requests concurrently (wsgi.multithread false) would give the
+        whole worker to one viewer, so it always gets plain polling.
+        """
+        return self.max_seconds if environ.get('wsgi.multithread') else 0
+
+
+    def backlog_entries(self, company_id, last_id):
+        """Entries of company_id after last_id (oldest first), or None if more than LIVE_FEED_BACKLOG."""
+        from vault.models import ActivityLog
+
+        rows = ActivityLog.query.filter(ActivityLog.company_id == company_id, ActivityLog.id > last_id)\
+            .order_by(ActivityLog.id).limit(self.backlog + 1).all()
+        if len(rows) > self.backlog:
+            return None
+        return [_entry(row) for row in rows]
+
+    def stream(self, company_id, last_id, still_allowed, max_seconds=None):
+        """SSE body generator: backlog after last_id, then live entries, heartbeats and a deadline.
+
+        still_allowed() is re-checked every LIVE_FEED_HEARTBEAT seconds, busy or idle, so a revoked
+        viewer is cut off within one heartbeat.
+        max_seconds defaults to LIVE_FEED_MAX_SECONDS (see stream_seconds()).
+        """
+        if max_seconds is None:
+            max_seconds = self.max_seconds
+        # Catch-up-only requests (polling) don't need the shared poller
+        subscriber = self.subscribe(company_id) if max_seconds > 0 else None
+        try:
+            yield f"retry: {int(self.poll_interval * 1000)}\n\n"
+            sent = deque(maxlen=SENT_MEMORY)
+            floor = last_id or 0
+            if last_id is not None:
+                entries = self.backlog_entries(company_id, last_id)
+                if entries is None:
+                    # Too far behind to replay; the page reloads the log instead
+                    yield "event: reset\ndata: {}\n\n"
+                    return
+                for entry in entries:
+                    sent.append(entry['id'])
+                    yield format_event(entry)
+            # Don't hold a pooled connection while idle
+            db.session.remove()
+            if subscriber is None:
+                return
+
+            now = time.monotonic()
+            deadline = now + max_seconds
+            # Access is re-checked on this schedule whether or not events are flowing
+            next_check = now + self.heartbeat
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    return
+                if now >= next_check:
+                    allowed = still_allowed()
+                    db.session.remove()
+                    if not allowed:
+                        yield "event: revoked\ndata: {}\n\n"
+                        return
+                    next_check = now + self.heartbeat
+                    yield ": keep-alive\n\n"
+                try:
+                    entry = subscriber.queue.get(timeout=min(next_check, deadline) - now)
+                except queue.Empty:
+                    continue
+                if entry is _OVERFLOW:
+                    return
+                if entry['id'] <= floor or entry['id'] in sent:
+                    continue
+                sent.append(entry['id'])
+                yield format_event(entry)
+        finally:
+            if subscriber is not None:
+                self.unsubscribe(subscriber)
+
+    def stats(self):
+        return {
+            'subscribers': self.subscriber_count,
+            'companies': len(self._subscribers),
+            'polls': self.polls,
+            'delivered': self.delivered,
+            'overflows': self.overflows,
+            'cursor': self._cursor,
+            'pending_gaps': len(self._gaps),
+        }
+
+
+live_feed = LiveFeed()
@@ -0,0 +1,136 @@
+"""Company logos: content-addressed names, MIME sniffing and pre-sized variants.
+
+An uploaded logo is stored as Company.logo = "logos/<digest>.<ext>", where digest is a
+SHA-256 prefix of the image bytes. URLs carry the company id and that digest, so the
+server finds the row by primary key and a URL never changes meaning: responses are sent
+with a strong ETag and "Cache-Control: immutable", and a new upload simply gets new URLs.
+
+Smaller copies for the sidebar and page header (LOGO_VARIANT_SIZES, bounding box in px)
+are built at upload time when Pillow is installed; without it, or for SVGs, the original
+is served at every size.
+"""
+import hashlib
+import io
+import re
+
+from flask import url_for
+
+# Sidebar (24 px) and header (50 px) logos, at 2x for high-DPI screens
+LOGO_VARIANT_SIZES = (48, 100)
+DEFAULT_LOGO = 'logo.svg'
+
+_DIGEST_LENGTH = 32
+_LOGO_NAME = re.compile(r'^logos/([0-9a-f]{%d})\.[a-z]+$' % _DIGEST_LENGTH)
+_EXTENSIONS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+    'image/webp': 'webp',
+    'image/svg+xml': 'svg',
+    'image/x-icon': 'ico',
+}
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'\x00\x00\x01\x00', 'image/x-icon'),
+)
+
+
+def sniff_mimetype(data):
+    """Image type from the leading bytes (never from the client's filename), or None."""
+    for signature, mimetype in _SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    head = data[:1024].lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if head.startswith(b'<') and b'<svg' in head:
+        return 'image/svg+xml'
+    return None
+
+
+def logo_name(data, mimetype):
+    """Content-addressed Company.logo value for these bytes."""
+    digest = hashlib.sha256(data).hexdigest()[:_DIGEST_LENGTH]
+    return f"logos/{digest}.{_EXTENSIONS[mimetype]}"
+
+
+def logo_digest(logo):
+    """Digest part of a content-addressed Company.logo value (None for the default logo)."""
+    match = _LOGO_NAME.match(logo or '')
+    return match.group(1) if match else None
+
+
+def logo_url(company, size=None):
+    """URL of company's logo (a Company or CompanySummary), sized for a size px box if given."""
+    digest = logo_digest(company.logo)
+    if digest is None:
+        return url_for('static', filename=f"img/{DEFAULT_LOGO}")
+    if size is None:
+        return url_for('companies.serve_logo', company_id=company.id, digest=digest)
+    return url_for('companies.serve_logo_variant', company_id=company.id, digest=digest, size=size)
+
+
+def build_variants(data, mimetype):
+    """[(size, mimetype, bytes)] for each LOGO_VARIANT_SIZES box smaller than the image.
+
+    Returns [] when Pillow isn't installed or the image can't be resized (SVG, corrupt data).
+    """
+    if mimetype == 'image/svg+xml':
+        return []
+    try:
+        from PIL import Image
+    except ImportError:
+        return []
+
+    variants = []
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+            for size in LOGO_VARIANT_SIZES:
+                if max(image.size) <= size:
+                    continue  # already small enough; the original is served
+                resized = image.copy()
+                resized.thumbnail((size, size), Image.LANCZOS)
+                out = io.BytesIO()
+                if mimetype == 'image/jpeg':
+                    resized.convert('RGB').save(out, 'JPEG', quality=85, optimize=True)
+                    variants.append((size, 'image/jpeg', out.getvalue()))
+                else:
+                    if resized.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                        resized = resized.convert('RGBA')
+                    resized.save(out, 'PNG', optimize=True)
+                    variants.append((size, 'image/png', out.getvalue()))
+    except Exception as e:
+        print(f"[LOGO WARNING] Could not build logo variants: {e}")
+        return []
+    return variants
+
+
+def set_logo(company, data):
+    """Store data as company's logo and rebuild its variants (in the current session).
+
+    Raises ValueError if data isn't a supported image.
+    """
+    from vault.extensions import db
+    from vault.models import LogoVariant
+
+    mimetype = sniff_mimetype(data)
+    if mimetype is None:
+        raise ValueError('Logo must be a PNG, JPEG, GIF, WebP, SVG or ICO image.')
+    company.logo = logo_name(data, mimetype)
+    company.logo_data = data
+    LogoVariant.query.filter_by(company_id=company.id).delete()
+    for size, variant_mimetype, variant_data in build_variants(data, mimetype):
+        db.session.add(LogoVariant(company_id=company.id, size=size, mimetype=variant_mimetype, data=variant_data))
+
+
+def clear_logo(company):
+    """Back to the default logo (in the current session)."""
+    from vault.models import LogoVariant
+
+    company.logo = DEFAULT_LOGO
+    company.logo_data = None
+    LogoVariant.query.filter_by(company_id=company.id).delete()
@@ -1,34 +1,28 @@
 import os
 import uuid
 import io
-from flask import render_template, url_for, flash, redirect, request, current_app, send_file, make_response
+from flask import render_template, url_for, flash, redirect, request, current_app, send_file, make_response, jsonify
 from flask_login import current_user, login_required
 from flask_wtf.csrf import generate_csrf
 from vault import db
 # CHANGE: Import the blueprint from the local __init__.py file
 from vault.extensions import main_bp 
-from vault.main.forms import UploadFileForm
+from vault.main.forms import ALLOWED_EXTENSIONS, UploadFileForm
 from vault.models import File, Company, memberships
-from sqlalchemy import select
+from vault.companies.services import list_user_companies
+from vault.crypto_utils import FileEncryptor
+from vault.storage import put_new_blob, discard_blob
+from vault.uploads import store_uploads, upload_summary
+from vault.streaming import encrypted_file_response
+from vault.query_guard import query_budget
+
+# REMOVE the line: main_bp = Blueprint("main", __name__) 
+# (It is now created in __init__.py)
 
 def _get_user_companies():
     if not current_user.is_authenticated:
         return []
-    owned_companies = Company.query.filter_by(owner_id=current_user.id).all()
-    member_companies_query = db.session.execute(
-        select(Company).join(memberships, Company.id == memberships.c.company_id).where(memberships.c.user_id == current_user.id)
-    ).all()
-    member_companies = [row[0] for row in member_companies_query]
-    # dedupe by id
-    companies_map = {c.id: c for c in owned_companies}
-    for c in member_companies:
-        companies_map[c.id] = c
-    return list(companies_map.values())
-from vault.crypto_utils import decrypt_file_data
-from vault.crypto_utils import encrypt_file_data, decrypt_file_data
-
-# REMOVE the line: main_bp = Blueprint("main", __name__) 
-# (It is now created in __init__.py)
+    return list_user_companies(current_user.id)
 
 @main_bp.route("/")
 def index():
@@ -36,26 +30,15 @@ def index():
 
 @main_bp.route("/dashboard")
 @login_required
+@query_budget(5)
 def dashboard():
     # ... rest of your code remains the same ...
     # Fetch user's personal files (where company_id is NULL)
+    # File.data is deferred, so listing never pulls the encrypted blobs
     user_files = File.query.filter_by(user_id=current_user.id, company_id=None).all()
     
-    # Calculate file sizes (based on DB data length)
-    for file in user_files:
-        if file.data:
-            file.size = len(file.data)
-        else:
-            file.size = 0
-    
     # Fetch companies for the sidebar list (owned or member)
-    from sqlalchemy import select
-    owned_companies = Company.query.filter_by(owner_id=current_user.id).all()
-    member_companies_query = db.session.execute(
-        select(Company).join(memberships, Company.id == memberships.c.company_id).where(memberships.c.user_id == current_user.id)
-    ).all()
-    member_companies = [row[0] for row in member_companies_query]
-    user_companies = list(set(owned_companies + member_companies))
+    user_companies = _get_user_companies()
     form = UploadFileForm()
     return render_template('main/dashboard.html', 
                            files=user_files, 
@@ -74,37 +57,44 @@ def upload_file():
         # Validate extension (defensive)
         _, ext = os.path.splitext(original_filename)
         ext = ext.lower().lstrip('.')
-        allowed = {'pdf', 'txt', 'docx', 'png', 'jpg', 'jpeg'}
-        if ext not in allowed:
+        if ext not in ALLOWED_EXTENSIONS:
             flash('File type not allowed. Allowed: PDF, TXT, DOCX, PNG, JPG', 'danger')
             return redirect(url_for('main.dashboard'))
 
-        # 1. Read file and Encrypt
-        file_content = file_storage.read()
-        encrypted_data, aes_key, iv = encrypt_file_data(file_content, current_user.rsa_public_key)
-        
-        # 2. Save encrypted blob to DB (instead of disk)
-        unique_name = str(uuid.uuid4())
-        # file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_name)
-        
-        # with open(file_path, 'wb') as f:
-        #     f.write(encrypted_data)
+        # 1. Encrypt straight from the upload stream (no full plaintext copy in memory)
+        encryptor = FileEncryptor(current_user.rsa_public_key, user_id=current_user.id)
         
-        # 3. Save metadata to DB
+        # 2. Save metadata + encrypted blob (DB column or sharded disk, see vault/storage.py)
         new_file = File(
             filename=original_filename,
-            encrypted_name=unique_name,
-            data=encrypted_data, # Store file content in DB
-            encrypted_aes_key=aes_key,
-            iv=iv,
+            encrypted_name=str(uuid.uuid4()),
+            encrypted_aes_key=encryptor.encrypted_aes_key,
+            iv=encryptor.iv,
             user_id=current_user.id
         )
-        db.session.add(new_file)
+        put_new_blob(new_file, encryptor.iter_encrypt(file_storage.stream))
+        new_file.size = encryptor.plaintext_size
         db.session.commit()
         
         flash(f'File "{original_filename}" has been encrypted and secured!', 'success')
     return redirect(url_for('main.dashboard'))
 
+@main_bp.route("/upload/batch", methods=['POST'])
+@login_required
+def upload_files_batch():
+    """Encrypt several files into the personal vault at once; per-file results as JSON."""
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({"error": "No files uploaded."}), 400
+    if len(files) > current_app.config['UPLOAD_BATCH_MAX_FILES']:
+        return jsonify({"error": f"At most {current_app.config['UPLOAD_BATCH_MAX_FILES']} files per upload."}), 400
+
+    results, stored = store_uploads(files, current_user)
+    if stored:
+        db.session.commit()
+    payload, status = upload_summary(results)
+    return jsonify(payload), status
+
 @main_bp.route("/download/<int:file_id>")
 @login_required
 def download_file(file_id):
@@ -116,27 +106,11 @@ def download_file(file_id):
             flash("Unauthorized access!", "danger")
             return redirect(url_for('main.dashboard'))
         
-        # Read encrypted data from DB
-        encrypted_data = file_record.data
-        
-        if not encrypted_data:
-            flash("File not found in database (Legacy file or error).", "danger")
-            return redirect(url_for('main.dashboard'))
-        
-        # Decrypt using User's Private Key
-        decrypted_data = decrypt_file_data(
-            encrypted_data, 
-            file_record.encrypted_aes_key, 
-            file_record.iv, 
-            current_user.rsa_private_key
-        )
-        
-        # Send back to user with fresh BytesIO object
-        file_stream = io.BytesIO(decrypted_data)
-        
-        return send_file(
-            file_stream,
-            download_name=file_record.filename,
+        # Decrypt chunk by chunk straight from the storage backend (honours Range)
+        return encrypted_file_response(
+            file_record,
+            current_user.rsa_private_key,
+            user_id=current_user.id,
             as_attachment=True,
             mimetype='application/octet-stream'
         )
@@ -154,6 +128,7 @@ def delete_file(file_id):
     
     db.session.delete(file_to_delete)
     db.session.commit()
+    discard_blob(file_to_delete.storage, file_to_delete.encrypted_name)
     flash("File removed from vault.", "success")
     return redirect(url_for('main.dashboard'))
 
@@ -167,27 +142,17 @@ def view_file(file_id):
         flash("Unauthorized access!", "danger")
         return redirect(url_for('main.dashboard'))
     
-    # 1. Read encrypted data from DB
-    encrypted_data = file_record.data
-    
-    if not encrypted_data:
-         flash("File content not found.", "danger")
-         return redirect(url_for('main.dashboard'))
-    
-    # 2. Decrypt using User's Private Key
-    decrypted_data = decrypt_file_data(
-        encrypted_data, 
-        file_record.encrypted_aes_key, 
-        file_record.iv, 
-        current_user.rsa_private_key
-    )
-    
-    # 3. Send back to user for viewing
-    return send_file(
-        io.BytesIO(decrypted_data),
-        mimetype='application/pdf',  # Or detect type based on extension
-        as_attachment=False
-    )
+    # Decrypt chunk by chunk for inline viewing; Range lets the browser's PDF viewer seek
+    try:
+        return encrypted_file_response(
+            file_record,
+            current_user.rsa_private_key,
+            user_id=current_user.id,
+            as_attachment=False
+        )
+    except FileNotFoundError:
+        flash("File content not found.", "danger")
+        return redirect(url_for('main.dashboard'))
 
 
 @main_bp.route('/about')
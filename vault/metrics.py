@@ -0,0 +1,347 @@
+"""Prometheus metrics (text format 0.0.4), aggregated across worker processes.
+
+Each process keeps its totals in memory and writes a snapshot to METRICS_DIR/<pid>-<start>.json
+every METRICS_FLUSH_INTERVAL seconds (background thread) and at exit. The start time is part of
+the name so a new worker that reuses a dead worker's pid doesn't overwrite its totals.
+GET /api/v1/metrics merges every snapshot in the directory:
+  - counters and histograms are summed over all processes, including ones that have exited,
+    so totals don't go backwards when gunicorn recycles a worker,
+  - gauges (queue depths, pool usage) only over processes that are still running (for a
+    reused pid, the newest snapshot).
+Stale snapshots from an earlier server run would be added in too, so clear the directory
+when the server starts: `flask vault reset-metrics` (e.g. from gunicorn's on_starting hook).
+
+Off by default (METRICS=on to enable). The endpoint exposes per-route traffic and pool
+internals, so it is only served when METRICS_TOKEN is set, sent as "Authorization: Bearer <token>".
+"""
+import atexit
+import bisect
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import g, request
+
+# Request latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name -> (type, help)
+FAMILIES = {
+    'vault_http_requests_total': ('counter', 'HTTP requests by route, method and status.'),
+    'vault_http_request_duration_seconds': ('histogram', 'Request latency by route and method, including streamed bodies.'),
+    'vault_crypto_bytes_total': ('counter', 'Plaintext bytes encrypted or decrypted with AES.'),
+    'vault_rsa_operations_total': ('counter', 'RSA key generations and AES key wraps/unwraps.'),
+    'vault_cache_hits_total': ('counter', 'In-process cache hits.'),
+    'vault_cache_misses_total': ('counter', 'In-process cache misses.'),
+    'vault_cache_hit_ratio': ('gauge', 'Hits / lookups per cache, over all processes since they started.'),
+    'vault_cache_entries': ('gauge', 'Entries currently held per cache.'),
+    'vault_db_pool_checkouts_total': ('counter', 'Connections checked out of the engine pool.'),
+    'vault_db_pool_overflow_checkouts_total': ('counter', 'Checkouts that found every pooled connection in use.'),
+    'vault_db_pool_timeouts_total': ('counter', 'Checkouts that timed out waiting for a connection.'),
+    'vault_db_pool_checkout_seconds_total': ('counter', 'Time spent waiting for pool checkouts.'),
+    'vault_db_pool_checked_out': ('gauge', 'Connections currently checked out.'),
+    'vault_db_pool_capacity': ('gauge', 'pool_size + max_overflow (QueuePool profiles only).'),
+    'vault_activity_log_queue_depth': ('gauge', 'Activity log records waiting for the next bulk INSERT.'),
+    'vault_activity_log_flushed_records_total': ('counter', 'Activity log records written.'),
+    'vault_activity_log_dropped_records_total': ('counter', 'Activity log records dropped (queue overflow or bad rows).'),
+    'vault_mail_queue_depth': ('gauge', 'Emails waiting for the delivery worker.'),
+    'vault_mail_sent_total': ('counter', 'Emails sent.'),
+    'vault_mail_failed_total': ('counter', 'Emails that failed after every retry.'),
+    'vault_key_pool_available': ('gauge', 'Pre-generated RSA keypairs ready for registration.'),
+    'vault_key_pool_hits_total': ('counter', 'Registrations served from the keypair pool.'),
+    'vault_key_pool_misses_total': ('counter', 'Registrations that generated a keypair inline.'),
+    'vault_live_feed_subscribers': ('gauge', 'Open activity feed (SSE) streams.'),
+    'vault_live_feed_polls_total': ('counter', 'Shared activity feed poll queries (one per interval per process, not per viewer).'),
+    'vault_metrics_processes': ('gauge', 'Worker processes whose gauges are included.'),
+}
+
+
+def _series(name, **labels):
+    """Prometheus series key, e.g. vault_cache_hits_total{cache="key"}."""
+    if not labels:
+        return name
+    rendered = ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return f'{name}{{{rendered}}}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _family(series):
+    return series.split('{', 1)[0]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _component_metrics():
+    """(counters, gauges) read from the stats() of the app's other components."""
+    from vault.activity_log import activity_log
+    from vault.auth.utils import mail_queue
+    from vault.companies.services import company_list_cache, permission_cache
+    from vault.crypto_utils import crypto_counters, key_cache, key_pool
+    from vault.live_feed import live_feed
+    from vault.pooling import pool_metrics
+
+    counters, gauges = {}, {}
+    crypto = crypto_counters.stats()
+    counters[_series('vault_crypto_bytes_total', op='encrypt')] = crypto['bytes_encrypted']
+    counters[_series('vault_crypto_bytes_total', op='decrypt')] = crypto['bytes_decrypted']
+    for op in ('keygen', 'wrap', 'unwrap'):
+        counters[_series('vault_rsa_operations_total', op=op)] = crypto[f'rsa_{op}']
+
+    for name, cache in (('key', key_cache), ('permission', permission_cache), ('company_list', company_list_cache)):
+        stats = cache.stats()
+        counters[_series('vault_cache_hits_total', cache=name)] = stats['hits']
+        counters[_series('vault_cache_misses_total', cache=name)] = stats['misses']
+        gauges[_series('vault_cache_entries', cache=name)] = stats['size']
+
+    pool = pool_metrics.stats()
+    counters['vault_db_pool_checkouts_total'] = pool['checkouts']
+    counters['vault_db_pool_overflow_checkouts_total'] = pool['overflow_checkouts']
+    counters['vault_db_pool_timeouts_total'] = pool['timeouts']
+    counters['vault_db_pool_checkout_seconds_total'] = pool['avg_checkout_seconds'] * pool['checkouts']
+    if pool['checked_out'] is not None:
+        gauges['vault_db_pool_checked_out'] = pool['checked_out']
+    if pool['capacity'] is not None:
+        gauges['vault_db_pool_capacity'] = pool['capacity']
+
+    log = activity_log.stats()
+    gauges['vault_activity_log_queue_depth'] = log['queue_depth']
+    counters['vault_activity_log_flushed_records_total'] = log['flushed_records']
+    counters['vault_activity_log_dropped_records_total'] = log['dropped_records']
+
+    if mail_queue.app is not None:
+        mail = mail_queue.stats()
+        gauges['vault_mail_queue_depth'] = mail['queue_depth']
+        counters['vault_mail_sent_total'] = mail['sent']
+        counters['vault_mail_failed_total'] = mail['failed']
+
+    feed = live_feed.stats()
+    gauges['vault_live_feed_subscribers'] = feed['subscribers']
+    counters['vault_live_feed_polls_total'] = feed['polls']
+
+    keys = key_pool.stats()
+    gauges['vault_key_pool_available'] = keys['available']
+    counters['vault_key_pool_hits_total'] = keys['hits']
+    counters['vault_key_pool_misses_total'] = keys['misses']
+    return counters, gauges
+
+
+class Metrics:
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.flush_interval = 5.0
+        self.token = None
+        self._lock = threading.Lock()
+        self._requests = {}    # series -> count
+        self._histograms = {}  # series (no le label) -> [per-bucket counts..., +Inf count]
+        self._sums = {}        # series -> total seconds
+        self._thread = None
+        self._thread_pid = None
+        self._started = None
+        self._started_pid = None
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS', os.environ.get('METRICS', 'off').lower())
+        app.config.setdefault('METRICS_DIR', os.environ.get(
+            'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'vault-metrics')))
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', float(os.environ.get('METRICS_FLUSH_INTERVAL', 5)))
+        app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+        self.enabled = app.config['METRICS'] in ('on', 'true', '1')
+        if not self.enabled:
+            return
+        self.directory = app.config['METRICS_DIR']
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        self.token = app.config['METRICS_TOKEN']
+        if not self.token:
+            print("[METRICS] METRICS=on but METRICS_TOKEN is not set: /api/v1/metrics will not be served")
+        os.makedirs(self.directory, exist_ok=True)
+        app.before_request(self._start)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown)
+        atexit.register(self._flush_at_exit)
+
+    # --- Recording ---
+
+    def _start(self):
+        g._metrics_started = time.perf_counter()
+        self._ensure_thread()
+
+    def _after_request(self, response):
+        g._metrics_status = response.status_code
+        return response
+
+    def _teardown(self, exc):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return
+        # Teardown runs after a streamed body has been sent, so downloads count in full
+        seconds = time.perf_counter() - started
+        status = g.pop('_metrics_status', None) if exc is None else 500
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        self.observe_request(route, request.method, status or 500, seconds)
+
+    def observe_request(self, route, method, status, seconds):
+        series = _series('vault_http_request_duration_seconds', route=route, method=method)
+        counter = _series('vault_http_requests_total', route=route, method=method, status=status)
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self._requests[counter] = self._requests.get(counter, 0) + 1
+            buckets = self._histograms.get(series)
+            if buckets is None:
+                buckets = self._histograms[series] = [0] * (len(LATENCY_BUCKETS) + 1)
+            buckets[index] += 1
+            self._sums[series] = self._sums.get(series, 0.0) + seconds
+
+    # --- Per-process snapshots ---
+
+    def snapshot(self):
+        counters, gauges = _component_metrics()
+        with self._lock:
+            counters.update(self._requests)
+            histograms = {series: {'buckets': list(buckets), 'sum': self._sums[series]}
+                          for series, buckets in self._histograms.items()}
+        return {'pid': os.getpid(), 'started': self._process_started(), 'time': time.time(), 'counters': counters, 'gauges': gauges,
+                'histograms': histograms}
+
+    def flush(self):
+        """Write this process's snapshot (atomically: readers never see a partial file)."""
+        if not self.enabled:
+            return
+        try:
+            path = os.path.join(self.directory, self._snapshot_file())
+            tmp = f"{path}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"[METRICS ERROR] Could not write snapshot: {e}")
+
+    def _process_started(self):
+        if self._started_pid != os.getpid():
+            # First snapshot of this process (or of a forked child): new file name
+            self._started_pid = os.getpid()
+            self._started = int(time.time() * 1000)
+        return self._started
+
+    def _snapshot_file(self):
+        return f"{os.getpid()}-{self._process_started()}.json"
+
+    def _flush_at_exit(self):
+        # Only processes that served requests (not `flask` CLI commands) leave a snapshot
+        if self._thread_pid == os.getpid() and os.path.isdir(self.directory):
+            self.flush()
+
+    def _ensure_thread(self):
+        # Started lazily and re-started after a fork (gunicorn --preload)
+        if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='metrics-snapshot', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def reset(self):
+        """Delete every snapshot in the directory (call before workers start)."""
+        removed = 0
+        for path in glob.glob(os.path.join(self.directory, '*.json*')):
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    # --- Aggregation ---
+
+    def collect(self):
+        """Merged snapshot of every process, this one freshly written."""
+        self.flush()
+        counters, gauges, histograms, processes = {}, {}, {}, 0
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # removed or being replaced right now
+        # A reused pid: only its newest snapshot can belong to the running process
+        newest = {}
+        for snap in snapshots:
+            newest[snap['pid']] = max(newest.get(snap['pid'], 0), snap.get('started', 0))
+        for snap in snapshots:
+            for series, value in snap['counters'].items():
+                counters[series] = counters.get(series, 0) + value
+            for series, hist in snap['histograms'].items():
+                merged = histograms.setdefault(series, {'buckets': [0] * len(hist['buckets']), 'sum': 0.0})
+                merged['buckets'] = [a + b for a, b in zip(merged['buckets'], hist['buckets'])]
+                merged['sum'] += hist['sum']
+            if snap.get('started', 0) != newest[snap['pid']]:
+                continue
+            if snap['pid'] == os.getpid() or _pid_alive(snap['pid']):
+                processes += 1
+                for series, value in snap['gauges'].items():
+                    gauges[series] = gauges.get(series, 0) + value
+        gauges['vault_metrics_processes'] = processes
+
+        for series, hits in list(counters.items()):
+            if _family(series) == 'vault_cache_hits_total':
+                labels = series[len('vault_cache_hits_total'):]
+                lookups = hits + counters.get(f'vault_cache_misses_total{labels}', 0)
+                gauges[f'vault_cache_hit_ratio{labels}'] = hits / lookups if lookups else 0.0
+        return counters, gauges, histograms
+
+    def render(self):
+        """Prometheus text exposition of collect()."""
+        counters, gauges, histograms = self.collect()
+        by_family = {}
+        for series, value in list(counters.items()) + list(gauges.items()):
+            by_family.setdefault(_family(series), []).append(f'{series} {_number(value)}')
+        for series, hist in histograms.items():
+            name = _family(series)
+            labels = series[len(name) + 1:-1] if '{' in series else ''
+            sep = ',' if labels else ''
+            lines = by_family.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], hist['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {_number(hist["sum"])}' if labels else f'{name}_sum {_number(hist["sum"])}')
+            lines.append(f'{name}_count{{{labels}}} {cumulative}' if labels else f'{name}_count {cumulative}')
+
+        out = []
+        for name in sorted(by_family):
+            kind, help_text = FAMILIES.get(name, ('untyped', ''))
+            out.append(f'# HELP {name} {help_text}')
+            out.append(f'# TYPE {name} {kind}')
+            out.extend(sorted(by_family[name]) if kind != 'histogram' else by_family[name])
+        return '\n'.join(out) + '\n'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
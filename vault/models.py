@@ -11,10 +11,13 @@ def load_user(user_id):
         return None
 
 # Junction table for User-Company Membership
+# (user_id, company_id) is the key: one membership per user per company, and the index
+# behind every permission check. company_id alone serves the member list.
 memberships = db.Table('memberships',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('company_id', db.Integer, db.ForeignKey('company.id')),
-    db.Column('role_id', db.Integer, db.ForeignKey('role.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('company_id', db.Integer, db.ForeignKey('company.id'), primary_key=True),
+    db.Column('role_id', db.Integer, db.ForeignKey('role.id')),
+    db.Index('ix_memberships_company_id', 'company_id')
 )
 
 class User(UserMixin, db.Model):
@@ -35,14 +38,30 @@ class Company(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     password = db.Column(db.String(100)) # Company entry password
-    logo = db.Column(db.String(100), default='logo.svg')
-    logo_data = db.Column(db.LargeBinary) # Store logo image data in DB
+    logo = db.Column(db.String(100), default='logo.svg') # 'logos/<content digest>.<ext>' once uploaded, see vault/logos.py
+    logo_data = db.deferred(db.Column(db.LargeBinary)) # Store logo image data in DB (only loaded on access)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True) # Owned half of the sidebar company list
     
     roles = db.relationship('Role', backref='company_ref', lazy=True)
     logs = db.relationship('ActivityLog', backref='company_ref', lazy=True)
 
+class CompanyStats(db.Model):
+    """Counters behind the dashboard stats API, kept in step with File / ActivityLog (see vault/company_stats.py)."""
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), primary_key=True)
+    file_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    plaintext_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    ciphertext_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    activity_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_activity_at = db.Column(db.DateTime)
+
+class LogoVariant(db.Model):
+    """Resized copy of a company logo, built when the logo is uploaded (see vault/logos.py)."""
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), primary_key=True)
+    size = db.Column(db.Integer, primary_key=True) # Bounding box edge in px
+    mimetype = db.Column(db.String(50), nullable=False)
+    data = db.deferred(db.Column(db.LargeBinary, nullable=False)) # Only loaded when the image is actually sent
+
 class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
@@ -63,17 +82,40 @@ class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     encrypted_name = db.Column(db.String(255), nullable=False) # Disk name
-    data = db.Column(db.LargeBinary) # Encrypted file content stored in DB
+    data = db.deferred(db.Column(db.LargeBinary)) # Encrypted file content stored in DB (only loaded on access)
+    size = db.Column(db.BigInteger) # Plaintext size in bytes
+    encrypted_size = db.Column(db.BigInteger) # Stored ciphertext size in bytes
+    content_digest = db.Column(db.String(64)) # SHA-256 of the ciphertext, set at upload (the ETag)
+    storage = db.Column(db.String(20), default='db', server_default='db') # Blob backend, see vault/storage.py
     encrypted_aes_key = db.Column(db.LargeBinary) # AES key encrypted with RSA
     iv = db.Column(db.LargeBinary) # AES Initialization Vector
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     company_id = db.Column(db.Integer, db.ForeignKey('company.id'), nullable=True)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_file_company_upload_date', 'company_id', 'upload_date'), # Company file listings
+        db.Index('ix_file_user_company', 'user_id', 'company_id'), # Personal vault (company_id IS NULL)
+        db.Index('ix_file_encrypted_name', 'encrypted_name'), # Blob lookups, see vault/storage.py
+    )
+
 class ActivityLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     company_id = db.Column(db.Integer, db.ForeignKey('company.id'))
     user_email = db.Column(db.String(150))
     action = db.Column(db.String(100)) # e.g., "Downloaded File: Q4_Report.pdf"
     ip_address = db.Column(db.String(50))
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Serves the log viewer's keyset pagination: WHERE company_id = ? ORDER BY timestamp DESC, id DESC
+    __table_args__ = (
+        db.Index('ix_activity_log_company_timestamp_id', 'company_id', timestamp.desc(), id.desc()),
+    )
+
+@db.event.listens_for(User.rsa_private_key, 'set')
+@db.event.listens_for(User.rsa_public_key, 'set')
+def _invalidate_cached_keys(target, value, oldvalue, initiator):
+    """Drop parsed key objects as soon as a user's key material is replaced."""
+    if target.id is not None and value != oldvalue:
+        from vault.crypto_utils import key_cache
+        key_cache.invalidate_user(target.id)
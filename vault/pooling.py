@@ -0,0 +1,174 @@
+"""Named SQLAlchemy engine/pool profiles and pool checkout metrics.
+
+DB_POOL_PROFILE picks one of:
+  - 'serverless': NullPool, one connection per checkout and none kept between invocations, so
+                  many short-lived Vercel instances don't pin Neon connections. Point DATABASE_URL
+                  at the pooled (pgbouncer, "-pooler") endpoint. DB_POOL_SIZE > 0 keeps a tiny
+                  pre-pinged pool per instance instead, for hosts that do reuse instances.
+  - 'server':     QueuePool sized for long-lived gunicorn workers, with pre_ping and recycle so
+                  connections dropped by the server or a proxy are replaced transparently.
+  - 'default':    SQLAlchemy / Flask-SQLAlchemy defaults (the behaviour before profiles).
+The default is 'serverless' on Vercel and 'server' elsewhere. SQLite ignores the sizing
+options: file databases always get a NullPool and in-memory ones Flask-SQLAlchemy's StaticPool.
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+PROFILES = ('serverless', 'server', 'default')
+
+
+class PoolMetrics:
+    """Checkout latency and saturation for the app's engine pool (one per process)."""
+
+    def __init__(self):
+        self.profile = None
+        self.pool = None
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.overflow_checkouts = 0  # checkouts that found every pooled connection in use
+        self.total_checkout_seconds = 0.0
+        self.max_checkout_seconds = 0.0
+        self.peak_checked_out = 0
+
+    def record_checkout(self, pool, seconds, timed_out=False):
+        with self._lock:
+            self.pool = pool
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.total_checkout_seconds += seconds
+            self.max_checkout_seconds = max(self.max_checkout_seconds, seconds)
+            if isinstance(pool, QueuePool):
+                checked_out = pool.checkedout()
+                self.peak_checked_out = max(self.peak_checked_out, checked_out)
+                if checked_out > pool.size():
+                    self.overflow_checkouts += 1
+
+    def stats(self):
+        pool = self.pool
+        capacity = checked_out = None
+        if isinstance(pool, QueuePool):
+            # pool._max_overflow is -1 for "unbounded"
+            capacity = pool.size() + pool._max_overflow if pool._max_overflow >= 0 else None
+            checked_out = pool.checkedout()
+        return {
+            'profile': self.profile,
+            'pool_class': type(pool).__name__ if pool is not None else None,
+            'checked_out': checked_out,
+            'capacity': capacity,
+            'saturation': checked_out / capacity if capacity else None,
+            'peak_checked_out': self.peak_checked_out,
+            'checkouts': self.checkouts,
+            'overflow_checkouts': self.overflow_checkouts,
+            'timeouts': self.timeouts,
+            'connects': self.connects,
+            'invalidations': self.invalidations,
+            'avg_checkout_seconds': self.total_checkout_seconds / self.checkouts if self.checkouts else 0.0,
+            'max_checkout_seconds': self.max_checkout_seconds,
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+class _TimedPoolMixin:
+    """Times _do_get(): waiting for a free connection plus opening a new one if needed."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record_checkout(self, time.perf_counter() - started, timed_out=True)
+            raise
+        pool_metrics.record_checkout(self, time.perf_counter() - started)
+        return connection
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedNullPool(_TimedPoolMixin, NullPool):
+    pass
+
+
+@event.listens_for(TimedQueuePool, 'connect')
+@event.listens_for(TimedNullPool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    pool_metrics.connects += 1
+
+
+@event.listens_for(TimedQueuePool, 'invalidate')
+@event.listens_for(TimedNullPool, 'invalidate')
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    # Includes connections found dead by pool_pre_ping
+    pool_metrics.invalidations += 1
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def engine_options(profile, database_uri):
+    """SQLALCHEMY_ENGINE_OPTIONS for a profile."""
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown DB_POOL_PROFILE {profile!r}; expected one of {', '.join(PROFILES)}")
+    if profile == 'default':
+        return {}
+
+    url = make_url(database_uri)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return {}
+        return {'poolclass': TimedNullPool}
+
+    if profile == 'serverless':
+        pool_size = _env_int('DB_POOL_SIZE', 0)
+        options = {'connect_args': {'connect_timeout': _env_int('DB_CONNECT_TIMEOUT', 5)}}
+        if pool_size <= 0:
+            # pgbouncer does the pooling; nothing is held open while the instance is frozen
+            options['poolclass'] = TimedNullPool
+            return options
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': pool_size,
+            'max_overflow': _env_int('DB_MAX_OVERFLOW', 0),
+            'pool_timeout': _env_int('DB_POOL_TIMEOUT', 5),
+            # Shorter than typical proxy idle timeouts, so a thawed instance rarely finds a dead socket
+            'pool_recycle': _env_int('DB_POOL_RECYCLE', 300),
+            'pool_pre_ping': True,
+        })
+        return options
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': _env_int('DB_POOL_SIZE', 5),
+        'max_overflow': _env_int('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': _env_int('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': True,
+        # Reuse the most recent connection so idle extras age out via pool_recycle
+        'pool_use_lifo': True,
+        'connect_args': {'connect_timeout': _env_int('DB_CONNECT_TIMEOUT', 10)},
+    }
+
+
+def configure_engine(app):
+    """Pick the pool profile and set SQLALCHEMY_ENGINE_OPTIONS (before the engine is created)."""
+    default_profile = 'serverless' if os.environ.get('VERCEL') else 'server'
+    profile = app.config.setdefault('DB_POOL_PROFILE', os.environ.get('DB_POOL_PROFILE', default_profile))
+    options = engine_options(profile, app.config['SQLALCHEMY_DATABASE_URI'])
+    # Explicit SQLALCHEMY_ENGINE_OPTIONS entries still win over the profile
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    pool_metrics.profile = profile
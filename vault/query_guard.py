@@ -0,0 +1,168 @@
+"""Per-request SQL statement counting, N+1 detection and query budgets (development / CI).
+
+QUERY_GUARD selects what happens when a request misbehaves:
+  - 'off':   nothing is hooked (the default),
+  - 'warn':  a "[QUERY GUARD] ..." line, plus an X-Query-Count header on every response,
+  - 'raise': QueryBudgetExceeded, so the test client (TESTING=True) or `flask vault bench`
+             fails on the offending request (tests/test_query_budgets.py runs every budgeted
+             page this way, at two data sizes).
+A request misbehaves when it runs the same statement, differing only in its parameters,
+QUERY_GUARD_REPEATS times or more (a lookup inside a loop), or when it runs more statements
+than its view's @query_budget. Budgets are meant to be constants: a listing whose query count
+grows with the number of rows can't meet one.
+
+count_queries() gives the same numbers for any block of code, e.g. a test that calls
+several views or a service function directly.
+"""
+import os
+import re
+import threading
+from collections import Counter
+
+from flask import current_app, request
+
+MODES = ('off', 'warn', 'raise')
+
+_local = threading.local()
+_WHITESPACE = re.compile(r'\s+')
+# "IN (?, ?, ?)" / "IN (%(p_1)s, ...)" with a varying number of parameters is still one statement
+_IN_LIST = re.compile(r'\(\s*(?:\?|%\([^)]*\)s|:\w+)(?:\s*,\s*(?:\?|%\([^)]*\)s|:\w+))*\s*\)')
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """A request ran more statements than its budget, or repeated one like an N+1 loop."""
+
+
+def query_budget(max_queries):
+    """Declare that a view runs at most max_queries SQL statements per request.
+
+    Enforced when QUERY_GUARD is on; the decorator itself costs nothing per call.
+    """
+    def decorator(view):
+        view._query_budget = max_queries
+        return view
+    return decorator
+
+
+def normalize(statement):
+    """Statement text with parameters already out of it, whitespace and IN lists collapsed."""
+    return _IN_LIST.sub('(?)', _WHITESPACE.sub(' ', statement).strip())
+
+
+class QueryCounter:
+    """Statements seen while active (one per execute/executemany call)."""
+
+    def __init__(self):
+        self.statements = Counter()
+
+    @property
+    def total(self):
+        return sum(self.statements.values())
+
+    def repeated(self, threshold):
+        """[(count, statement)] run at least threshold times, most repeated first."""
+        return sorted(((n, s) for s, n in self.statements.items() if n >= threshold), reverse=True)
+
+
+class count_queries:
+    """Context manager counting this thread's statements: `with count_queries() as counter:`.
+
+    Installs the engine hook on first use, whatever QUERY_GUARD says.
+    """
+
+    def __enter__(self):
+        _install_hook()
+        self.counter = QueryCounter()
+        self._outer = getattr(_local, 'counters', None) or []
+        _local.counters = self._outer + [self.counter]
+        return self.counter
+
+    def __exit__(self, *exc):
+        _local.counters = self._outer
+        return False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    counters = getattr(_local, 'counters', None)
+    if counters:
+        key = normalize(statement)
+        for counter in counters:
+            counter.statements[key] += 1
+
+
+_hook_lock = threading.Lock()
+_hook_installed = False
+
+
+def _install_hook():
+    global _hook_installed
+    if _hook_installed:
+        return
+    with _hook_lock:
+        if not _hook_installed:
+            from sqlalchemy import event
+            from sqlalchemy.engine import Engine
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            _hook_installed = True
+
+
+def _shorten(statement, limit=160):
+    return statement if len(statement) <= limit else statement[:limit - 3] + '...'
+
+
+class QueryGuard:
+
+    def __init__(self):
+        self.mode = 'off'
+        self.repeats = 5
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_GUARD', os.environ.get('QUERY_GUARD', 'off').lower())
+        app.config.setdefault('QUERY_GUARD_REPEATS', int(os.environ.get('QUERY_GUARD_REPEATS', 5)))
+        self.mode = app.config['QUERY_GUARD']
+        if self.mode not in MODES:
+            raise ValueError(f"Unknown QUERY_GUARD {self.mode!r}; expected one of {', '.join(MODES)}")
+        self.repeats = app.config['QUERY_GUARD_REPEATS']
+        if self.mode == 'off':
+            return
+        _install_hook()
+        app.before_request(self._start)
+        app.after_request(self._check)
+        app.teardown_request(self._teardown)
+
+    def _start(self):
+        _local.request_counter = count_queries()
+        _local.request_counter.__enter__()
+
+    def _check(self, response):
+        scope = getattr(_local, 'request_counter', None)
+        if scope is None:
+            return response
+        counter = scope.counter
+        # Streamed bodies (downloads, exports) read blobs after this point; those aren't counted
+        response.headers['X-Query-Count'] = str(counter.total)
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, '_query_budget', None)
+
+        problems = []
+        if budget is not None and counter.total > budget:
+            problems.append(f"{counter.total} queries (budget {budget})")
+        for count, statement in counter.repeated(self.repeats):
+            problems.append(f"same statement {count}x, likely N+1: {_shorten(statement)}")
+        if not problems:
+            return response
+
+        message = f"{request.method} {request.path} ({request.endpoint}): " + '; '.join(problems)
+        if self.mode == 'raise':
+            raise QueryBudgetExceeded(message)
+        print(f"[QUERY GUARD] {message}")
+        return response
+
+    def _teardown(self, exc):
+        scope = getattr(_local, 'request_counter', None)
+        if scope is not None:
+            scope.__exit__(None, None, None)
+            _local.request_counter = None
+
+
+query_guard = QueryGuard()
@@ -0,0 +1,152 @@
+"""Schema management, kept off the serverless boot path.
+
+create_app() used to run db.create_all() plus a list of ALTER TABLE statements that were
+expected to fail, each a round-trip to the database on every cold start. Now boot only
+compares alembic_version with the newest migration script (one query), and SCHEMA_ON_BOOT
+decides what happens on a mismatch:
+  - 'check':   log a warning and serve anyway (the default: run `flask vault migrate` once, from
+               the deploy step or before the server starts its workers),
+  - 'migrate': bring the schema up to date. Only for a single process (the dev server, tests):
+               several workers booting at once would each run the same migrations,
+  - 'off':     skip the check entirely (zero queries).
+"""
+import ast
+import os
+import re
+
+import sqlalchemy as sa
+
+from vault.extensions import db
+
+MIGRATIONS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'migrations'))
+# First revision: what a pre-Alembic database becomes once its missing columns are added
+BASE_REVISION = '1ae2431b529a'
+
+_REVISION_LINE = re.compile(r"^(revision|down_revision)\s*=\s*(.+?)\s*$", re.MULTILINE)
+
+_head_revision = None
+
+
+def init_migrate(app):
+    """Register Flask-Migrate, which imports Alembic and Mako, only when something needs it."""
+    if 'migrate' not in app.extensions:
+        from flask_migrate import Migrate
+        # Absolute path: serverless runtimes don't start in the project root
+        Migrate(app, db, directory=MIGRATIONS_DIR)
+
+
+def head_revision():
+    """Newest revision in migrations/versions, read from disk once per process.
+
+    The revision identifiers are read straight from the scripts so the boot-time check
+    doesn't import Alembic; anything unusual (several heads) defers to Alembic itself.
+    """
+    global _head_revision
+    if _head_revision is None:
+        revisions, parents = set(), set()
+        versions_dir = os.path.join(MIGRATIONS_DIR, 'versions')
+        for name in os.listdir(versions_dir):
+            if not name.endswith('.py'):
+                continue
+            with open(os.path.join(versions_dir, name), encoding='utf-8') as f:
+                fields = dict(_REVISION_LINE.findall(f.read()))
+            revisions.add(ast.literal_eval(fields['revision']))
+            down = ast.literal_eval(fields.get('down_revision', 'None'))
+            parents.update(down if isinstance(down, tuple) else [down])
+        heads = revisions - parents
+        if len(heads) == 1:
+            _head_revision = heads.pop()
+        else:
+            from alembic.script import ScriptDirectory
+            _head_revision = ScriptDirectory(MIGRATIONS_DIR).get_current_head()
+    return _head_revision
+
+
+def current_revision():
+    """Revision recorded in the database, or None if it has never been stamped."""
+    # Connection errors propagate; only the query itself may fail
+    with db.engine.connect() as conn:
+        try:
+            return conn.execute(sa.text('SELECT version_num FROM alembic_version')).scalar()
+        except sa.exc.DBAPIError as e:
+            if e.connection_invalidated:
+                raise
+            # No alembic_version table: a fresh database or one built by the old create_all() boot path
+            return None
+
+
+def schema_status():
+    """('current' | 'behind' | 'unversioned', revision in the database)."""
+    revision = current_revision()
+    if revision is None:
+        return 'unversioned', None
+    return ('current' if revision == head_revision() else 'behind'), revision
+
+
+def _add_missing_columns():
+    """ADD COLUMN for every model column a pre-Alembic database lacks (the old boot-time ALTERs)."""
+    inspector = sa.inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = {col['name'] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            definition = sa.schema.CreateColumn(column).compile(dialect=db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.execute(sa.text(f'ALTER TABLE "{table.name}" ADD COLUMN {definition}'))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def upgrade_schema():
+    """Bring any database (empty, pre-Alembic, or behind) to the head revision.
+
+    Returns a short description of what was done. Needs an app context.
+    """
+    from flask import current_app
+    from flask_migrate import stamp, upgrade
+    from vault import models  # noqa: F401  (registers every table on db.metadata)
+
+    init_migrate(current_app)
+
+    status, revision = schema_status()
+    if status == 'current':
+        return f"already at {revision}"
+
+    if status == 'unversioned':
+        tables = set(sa.inspect(db.engine).get_table_names()) - {'alembic_version'}
+        if not tables:
+            # The migration chain starts from the original tables, so build them from the models
+            db.create_all()
+            stamp(directory=MIGRATIONS_DIR, revision='head')
+            return f"created tables at {head_revision()}"
+        db.create_all()  # tables introduced since that deploy
+        added = _add_missing_columns()
+        if added:
+            print(f"[SCHEMA] Added column(s): {', '.join(added)}")
+        stamp(directory=MIGRATIONS_DIR, revision=BASE_REVISION)
+
+    upgrade(directory=MIGRATIONS_DIR)
+    return f"upgraded {revision or 'unversioned database'} -> {head_revision()}"
+
+
+def ensure_schema(app):
+    """Boot-time check configured by SCHEMA_ON_BOOT; returns the schema status it found."""
+    mode = app.config['SCHEMA_ON_BOOT']
+    if mode == 'off':
+        return 'unchecked'
+    with app.app_context():
+        try:
+            status, revision = schema_status()
+            if status == 'current':
+                return status
+            if mode == 'migrate':
+                print(f"[SCHEMA] {upgrade_schema()}")
+                return 'migrated'
+            print(f"[SCHEMA WARNING] Database is {status} ({revision or 'no revision'}, "
+                  f"expected {head_revision()}). Run `flask vault migrate`.")
+            return status
+        except Exception as e:
+            print(f"[SCHEMA ERROR] Schema check failed: {e}")
+            return 'error'
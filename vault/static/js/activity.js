@@ -13,4 +13,37 @@ document.addEventListener('DOMContentLoaded', () => {
             });
         });
     }
+
+    // Live feed: new entries arrive over Server-Sent Events and are added to the top.
+    // EventSource reconnects by itself, resuming after the last id it received.
+    const liveTable = document.querySelector('table[data-stream-url]');
+    if (liveTable && window.EventSource) {
+        const body = liveTable.querySelector('tbody');
+        const url = `${liveTable.dataset.streamUrl}?last_id=${encodeURIComponent(liveTable.dataset.lastId)}`;
+        const source = new EventSource(url);
+
+        source.addEventListener('activity', (event) => {
+            const entry = JSON.parse(event.data);
+            const empty = body.querySelector('.empty-row');
+            if (empty) empty.parentElement.remove();
+
+            const row = document.createElement('tr');
+            const action = document.createElement('span');
+            action.className = 'action-tag';
+            action.textContent = entry.action;
+            const button = document.createElement('button');
+            button.className = 'btn-sm';
+            button.textContent = 'View';
+            [entry.timestamp.slice(0, 16).replace('T', ' '), entry.user, action, entry.ip_address || '', button]
+                .forEach(content => {
+                    const cell = document.createElement('td');
+                    cell.append(content);
+                    row.append(cell);
+                });
+            body.prepend(row);
+        });
+        // Too far behind to replay: reload the newest page instead
+        source.addEventListener('reset', () => { source.close(); window.location.reload(); });
+        source.addEventListener('revoked', () => source.close());
+    }
 });
\ No newline at end of file
@@ -22,9 +22,42 @@ const fileInput = document.getElementById('file-upload');
 
 if(fileInput) {
     fileInput.onchange = () => {
-        const fileName = fileInput.files[0].name;
+        const files = fileInput.files;
+        if(files.length > 1 && fileInput.dataset.batchUrl) {
+            if(confirm(`Do you want to encrypt and secure ${files.length} files?`)) {
+                uploadBatch(fileInput, files);
+            }
+            return;
+        }
+        const fileName = files[0].name;
         if(confirm(`Do you want to encrypt and secure "${fileName}"?`)) {
             fileInput.form.submit();
         }
     };
+}
+
+// Several files: one request to the batch endpoint, then show per-file results
+function uploadBatch(input, files) {
+    const data = new FormData();
+    const csrf = input.form.querySelector('input[name="csrf_token"]');
+    if(csrf) {
+        data.append('csrf_token', csrf.value);
+    }
+    for(const file of files) {
+        data.append('files', file);
+    }
+    fetch(input.dataset.batchUrl, { method: 'POST', body: data })
+        .then(response => response.json())
+        .then(result => {
+            const problems = (result.files || [])
+                .filter(f => f.status !== 'uploaded')
+                .map(f => `${f.filename}: ${f.error}`);
+            let message = result.error || `${result.uploaded} file(s) encrypted and secured.`;
+            if(problems.length) {
+                message += `\n\nNot uploaded:\n${problems.join('\n')}`;
+            }
+            alert(message);
+            window.location.reload();
+        })
+        .catch(() => alert('Upload failed. Please try again.'));
 }
\ No newline at end of file
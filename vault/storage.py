@@ -0,0 +1,251 @@
+"""Blob storage for encrypted file contents.
+
+Every File row names the backend holding its ciphertext in File.storage:
+  - 'db':         the File.data column (the original layout, needed on read-only hosts like Vercel).
+                  Written BLOB_DB_WRITE_SIZE bytes at a time (first an UPDATE, then appends), so an
+                  upload holds at most that much ciphertext in memory. Each append makes the database
+                  rewrite the stored value, so files much larger than BLOB_DB_WRITE_SIZE belong on
+                  the filesystem backend.
+  - 'filesystem': one file per blob under BLOB_STORAGE_PATH, sharded by a hash of encrypted_name
+                  and read back through mmap so downloads never go through a DB row fetch.
+"""
+import hashlib
+import mmap
+import os
+import uuid
+
+from flask import current_app
+from sqlalchemy import LargeBinary, cast, func, update
+
+from vault.extensions import db
+from vault.models import File
+
+DEFAULT_BACKEND = 'db'
+STREAM_CHUNK_SIZE = 256 * 1024
+DB_WRITE_SIZE = 8 * 1024 * 1024
+
+
+class BlobStore:
+    """Interface: put/get/stream/delete blobs by File.encrypted_name."""
+    name = None
+
+    def put(self, name, chunks):
+        """Store an iterable of byte chunks; returns the number of bytes written."""
+        raise NotImplementedError
+
+    def get(self, name):
+        """Return the whole blob as bytes, or None if it does not exist."""
+        raise NotImplementedError
+
+    def stream(self, name, start=0, end=None, chunk_size=STREAM_CHUNK_SIZE):
+        """Yield bytes [start, end) of the blob in chunks."""
+        raise NotImplementedError
+
+    def size(self, name):
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+
+class DatabaseBlobStore(BlobStore):
+    """Ciphertext lives in File.data. The File row must already be flushed before put()."""
+    name = 'db'
+
+    def __init__(self, write_size=DB_WRITE_SIZE):
+        self.write_size = write_size
+
+    def put(self, name, chunks):
+        # A bytea parameter has to be sent in one piece, so buffer up to write_size per statement
+        buffer = bytearray()
+        written = 0
+        for chunk in chunks:
+            buffer += chunk
+            if len(buffer) >= self.write_size:
+                self._write(name, buffer, append=written > 0)
+                written += len(buffer)
+                buffer = bytearray()
+        if buffer or not written:
+            self._write(name, buffer, append=written > 0)
+            written += len(buffer)
+        return written
+
+    def _write(self, name, data, append):
+        value = bytes(data)
+        if append:
+            # CAST: SQLite's || returns TEXT even for two blobs
+            value = cast(File.data.op('||')(value), LargeBinary)
+        db.session.execute(
+            update(File).where(File.encrypted_name == name).values(data=value)
+            .execution_options(synchronize_session=False)
+        )
+
+    def get(self, name):
+        return db.session.query(File.data).filter(File.encrypted_name == name).scalar()
+
+    def size(self, name):
+        return db.session.query(func.length(File.data)).filter(File.encrypted_name == name).scalar()
+
+    def stream(self, name, start=0, end=None, chunk_size=4 * STREAM_CHUNK_SIZE):
+        if end is None:
+            end = self.size(name) or 0
+        # substr() is 1-based on both Postgres and SQLite; each chunk is its own small fetch
+        pos = start
+        while pos < end:
+            length = min(chunk_size, end - pos)
+            chunk = db.session.query(func.substr(File.data, pos + 1, length))\
+                .filter(File.encrypted_name == name).scalar()
+            if not chunk:
+                break
+            yield bytes(chunk)
+            pos += len(chunk)
+
+    def delete(self, name):
+        db.session.execute(
+            update(File).where(File.encrypted_name == name).values(data=None)
+            .execution_options(synchronize_session=False)
+        )
+
+
+class FilesystemBlobStore(BlobStore):
+    """One file per blob under root/ab/cd/<encrypted_name>, reads served from mmap."""
+    name = 'filesystem'
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, name):
+        digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], name)
+
+    def put(self, name, chunks):
+        path = self.path_for(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        written = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    written += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            # Atomic: readers see either nothing or the complete blob
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return written
+
+    def get(self, name):
+        path = self.path_for(name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def size(self, name):
+        path = self.path_for(name)
+        return os.path.getsize(path) if os.path.exists(path) else None
+
+    def stream(self, name, start=0, end=None, chunk_size=STREAM_CHUNK_SIZE):
+        path = self.path_for(name)
+        with open(path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            end = file_size if end is None else min(end, file_size)
+            if start >= end:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for pos in range(start, end, chunk_size):
+                    yield mapped[pos:min(pos + chunk_size, end)]
+
+    def delete(self, name):
+        path = self.path_for(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_blob_store(name=None):
+    """Backend by name (defaults to BLOB_STORAGE); instances are cached per app."""
+    name = name or current_app.config.get('BLOB_STORAGE', DEFAULT_BACKEND)
+    stores = current_app.extensions.setdefault('blob_stores', {})
+    if name not in stores:
+        if name == DatabaseBlobStore.name:
+            stores[name] = DatabaseBlobStore(current_app.config.get('BLOB_DB_WRITE_SIZE', DB_WRITE_SIZE))
+        elif name == FilesystemBlobStore.name:
+            stores[name] = FilesystemBlobStore(current_app.config['BLOB_STORAGE_PATH'])
+        else:
+            raise ValueError(f"Unknown blob storage backend: {name}")
+    return stores[name]
+
+
+def store_for(file_record):
+    return get_blob_store(file_record.storage or DEFAULT_BACKEND)
+
+
+def _hashing(chunks, digest):
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+def put_new_blob(file_record, chunks):
+    """Add a new File row and write its ciphertext to the configured backend.
+
+    The row is flushed (the DB backend updates it in place) but not committed; on any
+    failure the partial blob is removed and the exception re-raised.
+    """
+    return put_new_blobs([(file_record, chunks)])
+
+
+def put_new_blobs(items):
+    """put_new_blob() for several (file_record, chunks) pairs, with a single flush.
+
+    All or nothing: if any write fails, every blob written so far is removed and the
+    session rolled back before the exception is re-raised.
+    """
+    store = get_blob_store()
+    for file_record, _ in items:
+        file_record.storage = store.name
+        db.session.add(file_record)
+    written = []
+    try:
+        db.session.flush()
+        for file_record, chunks in items:
+            written.append(file_record.encrypted_name)
+            # The ciphertext digest is the file's HTTP validator (ETag), see streaming.py
+            digest = hashlib.sha256()
+            file_record.encrypted_size = store.put(file_record.encrypted_name, _hashing(chunks, digest))
+            file_record.content_digest = digest.hexdigest()
+    except Exception:
+        db.session.rollback()
+        for name in written:
+            store.delete(name)
+        raise
+    return store
+
+
+def discard_blob(storage, name):
+    """Remove the ciphertext of a deleted File row (DB blobs already went with the row)."""
+    store = get_blob_store(storage or DEFAULT_BACKEND)
+    if store.name != DatabaseBlobStore.name:
+        store.delete(name)
+
+
+def move_blob(file_record, target):
+    """Copy one file's ciphertext to another backend and repoint the row.
+
+    Returns the source store, or None if the file already lives in target. The caller
+    commits and only then calls source.delete() for filesystem sources, so a failed
+    commit never loses the only copy (DB sources are cleared in the same transaction).
+    """
+    source = store_for(file_record)
+    destination = get_blob_store(target)
+    if source.name == destination.name:
+        return None
+    destination.put(file_record.encrypted_name, source.stream(file_record.encrypted_name))
+    if source.name == DatabaseBlobStore.name:
+        source.delete(file_record.encrypted_name)
+    file_record.storage = destination.name
+    return source
@@ -0,0 +1,131 @@
+"""Streaming decrypt-and-send responses for stored files, with HTTP Range and conditional GET support."""
+import mimetypes
+import unicodedata
+from datetime import timezone
+from itertools import chain
+from urllib.parse import quote
+
+from flask import Response, request, stream_with_context
+
+from vault.crypto_utils import is_segmented, iter_decrypt, iter_decrypt_range, new_decryptor, plaintext_size
+from vault.storage import store_for
+
+
+def guess_mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def content_disposition(disposition, filename):
+    """(value, params) for a Content-Disposition header, to pass to response.headers.set().
+
+    Same filename encoding as flask.send_file (RFC 6266 / 5987): non-ASCII names get an ASCII
+    fallback plus a UTF-8 filename* parameter.
+    """
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(filename, safe="!#$&+^`|~")
+        return disposition, {'filename': simple, 'filename*': f"UTF-8''{quoted}"}
+    return disposition, {'filename': filename}
+
+
+def file_validators(file_record):
+    """(ETag, Last-Modified) for a stored file; neither changes while the row exists.
+
+    Files uploaded before content_digest existed fall back to encrypted_name, which is
+    unique per stored ciphertext and so just as stable.
+    """
+    etag = file_record.content_digest[:32] if file_record.content_digest else file_record.encrypted_name
+    last_modified = file_record.upload_date.replace(microsecond=0, tzinfo=timezone.utc) if file_record.upload_date else None
+    return etag, last_modified
+
+
+def is_not_modified(file_record):
+    """Whether the request's If-None-Match / If-Modified-Since still match file_record."""
+    etag, last_modified = file_validators(file_record)
+    if request.if_none_match:
+        # If-None-Match wins over If-Modified-Since when both are sent (RFC 9110 13.2.2)
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def _if_range_matches(file_record):
+    """A Range request with a stale If-Range gets the whole file (RFC 9110 13.1.5)."""
+    if_range = request.if_range
+    etag, last_modified = file_validators(file_record)
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return if_range.date == last_modified
+    return True
+
+
+def _set_validators(response, file_record):
+    etag, last_modified = file_validators(file_record)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Browsers keep the decrypted copy but ask again every time, so access checks still run
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def encrypted_file_response(file_record, private_key_pem, user_id=None, as_attachment=True, mimetype=None):
+    """Build a streaming response that decrypts file_record chunk by chunk.
+
+    Segmented (v2) files advertise Accept-Ranges and answer Range requests by decrypting
+    only the covering segments. Legacy CBC files are always sent whole (with Content-Length
+    once their size has been corrected).
+    Key unwrap and the first chunk happen before returning, so a wrong key or missing
+    blob raises here (where the route can still flash an error) instead of mid-stream.
+    A conditional request the browser's copy still satisfies gets a 304 before the blob
+    or the key is touched; the caller has already checked access.
+    """
+    if is_not_modified(file_record):
+        return _set_validators(Response(status=304), file_record)
+
+    store = store_for(file_record)
+    name = file_record.encrypted_name
+    ciphertext_size = file_record.encrypted_size or store.size(name)
+    if not ciphertext_size:
+        raise FileNotFoundError('File content not found.')
+
+    decryptor = new_decryptor(file_record.encrypted_aes_key, file_record.iv, private_key_pem, user_id)
+    status = 200
+    headers = {}
+
+    if is_segmented(file_record.iv):
+        size = plaintext_size(ciphertext_size)
+        start, end = 0, size
+        headers['Accept-Ranges'] = 'bytes'
+        if request.range is not None and _if_range_matches(file_record):
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                return Response(status=416, headers={'Content-Range': f'bytes */{size}', 'Accept-Ranges': 'bytes'})
+            start, end = byte_range
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        headers['Content-Length'] = str(end - start)
+        body = iter_decrypt_range(
+            decryptor, lambda offset, stop: store.stream(name, offset, stop), ciphertext_size, start, end
+        )
+    else:
+        headers['Accept-Ranges'] = 'none'
+        # Padding adds 1-16 bytes; a size outside that range wasn't corrected by a9d4b7e1c352
+        if file_record.size is not None and ciphertext_size - 16 <= file_record.size < ciphertext_size:
+            headers['Content-Length'] = str(file_record.size)
+        body = iter_decrypt(decryptor, store.stream(name))
+
+    first = next(body, b'')
+    response = Response(
+        stream_with_context(chain([first], body)),
+        status=status,
+        mimetype=mimetype or guess_mimetype(file_record.filename),
+        headers=headers,
+        direct_passthrough=True
+    )
+    disposition, names = content_disposition('attachment' if as_attachment else 'inline', file_record.filename)
+    response.headers.set('Content-Disposition', disposition, **names)
+    return _set_validators(response, file_record)
@@ -0,0 +1,136 @@
+"""Multi-file uploads: encrypt in a thread pool, store every File row in one transaction.
+
+Worker threads only run the crypto (RSA key wrap + AES-GCM), writing ciphertext into
+spooled temp files; the cryptography calls release the GIL, so files encrypt in parallel.
+Everything that touches the DB session stays on the request thread.
+"""
+import os
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from vault.activity_log import truncate_action
+from vault.crypto_utils import FileEncryptor, READ_CHUNK_SIZE
+from vault.main.forms import ALLOWED_EXTENSIONS
+from vault.models import File
+from vault.storage import put_new_blobs
+
+# Ciphertext beyond this many bytes per file spills from memory to a temp file
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+def _validate(filename):
+    if not filename:
+        return 'No file selected.'
+    _, ext = os.path.splitext(filename)
+    if ext.lower().lstrip('.') not in ALLOWED_EXTENSIONS:
+        return 'File type not allowed. Allowed: PDF, TXT, DOCX, PNG, JPG'
+    return None
+
+
+def _encrypt_upload(file_storage, public_key_pem, user_id):
+    """Runs on a pool thread: no app context, no DB session."""
+    encryptor = FileEncryptor(public_key_pem, user_id=user_id)
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    try:
+        for chunk in encryptor.iter_encrypt(file_storage.stream):
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return encryptor, spool
+
+
+def _iter_spool(spool):
+    return iter(lambda: spool.read(READ_CHUNK_SIZE), b'')
+
+
+def store_uploads(file_storages, user, company_id=None):
+    """Encrypt and store several uploads for user, in company_id or the personal vault.
+
+    Returns (results, stored): one result dict per upload in request order, and the File
+    rows added to the session (flushed, not committed). A file that fails validation or
+    encryption is reported on its own; a storage failure fails the whole batch.
+    """
+    results, accepted = [], []
+    for file_storage in file_storages:
+        result = {'filename': file_storage.filename or ''}
+        error = _validate(result['filename'])
+        if error:
+            result.update(status='rejected', error=error)
+        else:
+            accepted.append((result, file_storage))
+        results.append(result)
+    if not accepted:
+        return results, []
+
+    # current_user is context-local, so hand the workers plain values
+    public_key_pem, user_id = user.rsa_public_key, user.id
+    encrypted = []
+    workers = max(1, min(current_app.config['UPLOAD_WORKERS'], len(accepted)))
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload-encrypt') as pool:
+            futures = [
+                (result, pool.submit(_encrypt_upload, file_storage, public_key_pem, user_id))
+                for result, file_storage in accepted
+            ]
+            for result, future in futures:
+                try:
+                    encryptor, spool = future.result()
+                except Exception as e:
+                    print(f"[UPLOAD ERROR] Could not encrypt {result['filename']!r}: {e}")
+                    result.update(status='failed', error='Encryption failed.')
+                    continue
+                encrypted.append((result, encryptor, spool))
+
+        items = []
+        for result, encryptor, spool in encrypted:
+            new_file = File(
+                filename=result['filename'],
+                encrypted_name=str(uuid.uuid4()),
+                encrypted_aes_key=encryptor.encrypted_aes_key,
+                iv=encryptor.iv,
+                size=encryptor.plaintext_size,
+                user_id=user_id,
+                company_id=company_id
+            )
+            items.append((new_file, _iter_spool(spool)))
+        try:
+            put_new_blobs(items)
+        except Exception as e:
+            print(f"[UPLOAD ERROR] Storing a batch of {len(items)} file(s) failed: {e}")
+            for result, _, _ in encrypted:
+                result.update(status='failed', error='Storage failed; no file from this batch was saved.')
+            return results, []
+    finally:
+        for _, _, spool in encrypted:
+            spool.close()
+
+    for (result, _, _), (new_file, _) in zip(encrypted, items):
+        result.update(status='uploaded', id=new_file.id, size=new_file.size)
+    return results, [new_file for new_file, _ in items]
+
+
+def upload_log_action(stored):
+    """One activity log line for a batch, e.g. "Uploaded files (3): a.pdf, b.txt, c.png"."""
+    if len(stored) == 1:
+        action = f"Uploaded file: {stored[0].filename}"
+    else:
+        action = f"Uploaded files ({len(stored)}): " + ", ".join(f.filename for f in stored)
+    return truncate_action(action)
+
+
+def upload_summary(results):
+    """(JSON payload, status): 200 if anything was stored, 500 on failures, 400 if all were rejected."""
+    counts = {status: sum(1 for r in results if r['status'] == status)
+              for status in ('uploaded', 'rejected', 'failed')}
+    if counts['uploaded']:
+        status = 200
+    elif counts['failed']:
+        status = 500
+    else:
+        status = 400
+    return dict(counts, files=results), status